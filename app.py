@@ -1,166 +1,231 @@
-from flask import Flask, render_template, request, jsonify, session
-import random
+from flask import Flask, Response, get_template_attribute, render_template, request, jsonify, session
+from markupsafe import Markup
+import functools
+import hashlib
+import json
+import os
+import time
+import metrics
+import pubsub
+from batch import MAX_OPERATIONS, run_batch
 from database import FarmDatabase
-from game_models import CropType, AnimalType, BuildingType, GameEconomy
+from farm_grid import MAX_FOOTPRINT, footprint_for, grid_size_for
+from farm_state import NEW_FARM_STATE, Farm, FarmStateCache, RESOURCE_KEYS
+from game_models import CATALOG, CropType, AnimalType, BuildingType, can_afford, deduct
+from sharding import ShardedFarmDatabase
+from simulation import Simulation
+import snapshot
 
 app = Flask(__name__)
 app.secret_key = 'farming_simulation_secret_key'
-db = FarmDatabase()
+# FARM_DB_POOLED=0 switches back to opening a connection per call (for benchmarking)
+pooled = os.environ.get('FARM_DB_POOLED', '1') != '0'
+# FARM_DB_SHARDS=N spreads farms over N database files (see sharding.py)
+shards = int(os.environ.get('FARM_DB_SHARDS', 0))
+db = ShardedFarmDatabase(shards=shards, pooled=pooled) if shards else FarmDatabase(pooled=pooled)
+# FARM_DB_WRITE_BEHIND=1 queues farm writes and group-commits them from a background thread
+if os.environ.get('FARM_DB_WRITE_BEHIND', '0') == '1':
+    db.enable_write_behind(
+        interval=int(os.environ.get('FARM_DB_FLUSH_MS', 50)) / 1000,
+        max_ops=int(os.environ.get('FARM_DB_FLUSH_OPS', 1000)),
+        durability=os.environ.get('FARM_DB_DURABILITY', 'buffered'))
+farms = FarmStateCache(db, max_entries=int(os.environ.get('FARM_CACHE_ENTRIES', 1000)),
+                       max_bytes=int(os.environ.get('FARM_CACHE_MB', 64)) * 1024 * 1024)
+# Pushes every committed farm change to the farm's /api/stream clients
+broker = pubsub.FarmBroker()
+farms.listeners.append(broker.publish_commit)
+simulation = Simulation()
+MAX_VIEWPORT_CELLS = 128 * 128  # largest area one /api/grid call may ask for
+MAX_SAVE_SLOTS = 3
+MAX_ADVANCE_DAYS = 3650  # most days one /api/advance_day call may skip
+PROVISION_ATTEMPTS = 3
+EXPORT_CHUNK_BYTES = 64 * 1024
+# FARM_SNAPSHOT_KEY signs exported snapshots; without it export and import are refused
+SNAPSHOT_KEY = os.environ.get('FARM_SNAPSHOT_KEY', '').encode('utf-8') or None
+# What a visitor sees before their first action creates their farm; read-only
+NEW_FARM = Farm.from_rows(0, NEW_FARM_STATE, [], {})
+metrics.instrument_app(app)
+# The catalog never changes while the app runs: serialize it once and name it by its content
+CATALOG_JSON = json.dumps({
+    'crop': CropType.get_all_crops(),
+    'animal': AnimalType.get_all_animals(),
+    'building': BuildingType.get_all_buildings()
+}, separators=(',', ':')).encode('utf-8')
+CATALOG_ETAG = hashlib.sha256(CATALOG_JSON).hexdigest()[:16]
+
+
+def cache_metrics():
+    stats = farms.stats()
+    return [('farm_cache_hits_total', 'counter', 'Farm cache lookups served from memory', stats['hits']),
+            ('farm_cache_misses_total', 'counter', 'Farm cache lookups that loaded rows', stats['misses']),
+            ('farm_cache_evictions_total', 'counter', 'Farms evicted from the cache', stats['evictions']),
+            ('farm_cache_conflicts_total', 'counter', 'Transactions retried because another writer changed the farm',
+             stats['conflicts']),
+            ('farm_cache_entries', 'gauge', 'Farms held in the cache', stats['entries']),
+            ('farm_cache_bytes', 'gauge', 'Estimated bytes held by the cache', stats['bytes'])]
+
+
+def journal_metrics():
+    if db.journal is None:
+        return []
+    stats = db.journal.stats()
+    return [('farm_journal_queue_depth', 'gauge', 'Journal entries waiting to be written', stats['queue_depth']),
+            ('farm_journal_commits_total', 'counter', 'Group commits by the journal writer', stats['commits']),
+            ('farm_journal_conflicts_total', 'counter', 'Farms whose journaled writes lost the version check',
+             stats['conflicts'])]
+
+
+def stream_metrics():
+    stats = broker.stats()
+    return [('farm_stream_subscribers', 'gauge', 'Open /api/stream connections', stats['subscribers']),
+            ('farm_stream_events_total', 'counter', 'Events published to stream clients', stats['published']),
+            ('farm_stream_overflows_total', 'counter', 'Stream clients resynced after their buffer filled',
+             stats['overflows'])]
+
+
+metrics.add_collector(cache_metrics)
+metrics.add_collector(journal_metrics)
+metrics.add_collector(stream_metrics)
+
+
+def provision_user():
+    """The session's user id, creating the user on its first mutating request
+
+    Visitors who only look (including health checks and crawlers) are
+    shown NEW_FARM from memory and never get a database row.
+    """
+    user_id = session.get('user_id')
+    if not user_id:
+        # create_user() answers None if the name it picked was taken meanwhile
+        for _ in range(PROVISION_ATTEMPTS):
+            user_id = db.create_user()
+            if user_id:
+                break
+        else:
+            raise RuntimeError('Could not create a farm, please try again')
+        session['user_id'] = user_id
+    return user_id
+
+
+def grid_cell(data, user_id):
+    """(grid_x, grid_y) from a request body and an error message, which is
+    None when both are ints (not bools) on the user's farm grid"""
+    grid_x, grid_y = data.get('grid_x'), data.get('grid_y')
+    if type(grid_x) is not int or type(grid_y) is not int:
+        return None, 'grid_x and grid_y must be integers'
+    farm = farms.get(user_id)
+    if farm is None or not farm.grid.in_bounds(grid_x, grid_y):
+        return None, 'Location is outside the farm'
+    return (grid_x, grid_y), None
+
+
+def session_farm(load=farms.get):
+    """The session's farm, or NEW_FARM for a visitor who has not played yet"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return NEW_FARM
+    return load(user_id)
 
 
 @app.route('/')
 def home():
-    # Initialize or get user
-    if 'user_id' not in session:
-        # Create default user for this session
-        username = f"player_{random.randint(1000, 9999)}"
-        user_id = db.create_user(username)
-        if not user_id:
-            user_id = db.get_user_id(username)
-        session['user_id'] = user_id
+    farm = session_farm()
+    if farm is None:
+        # The session points at a farm that no longer exists; start afresh
+        session.pop('user_id', None)
+        farm = NEW_FARM
+
+    game_state = farm.game_state()
+    animals = dict(farm.animals)
 
-    user_id = session['user_id']
-
-    # Get game state from database
-    game_state = db.get_game_state(user_id)
-    if not game_state:
-        game_state = {
-            'gold': 100,
-            'wood': 50,
-            'stone': 25,
-            'food': 0,
-            'seeds': 10,
-            'water': 100,
-            'day': 1,
-            'season': 'Spring',
-            'farm_level': 1,
-            'land_size': 100
-        }
-        db.update_game_state(user_id, game_state)
-
-    # Get grid placements
-    placements = db.get_grid_placements(user_id)
-
-    # Get animals
-    animals = db.get_animals(user_id)
     if not animals:
         animals = {'cow': 0, 'chicken': 0, 'sheep': 0, 'pig': 0, 'horse': 0}
 
-    resources = {
-        'gold': game_state['gold'],
-        'wood': game_state['wood'],
-        'stone': game_state['stone'],
-        'food': game_state['food'],
-        'seeds': game_state['seeds'],
-        'water': game_state['water']
-    }
-
     game_info = {
         'day': game_state['day'],
         'season': game_state['season'],
         'farm_level': game_state['farm_level'],
-        'land_size': game_state['land_size']
+        'land_size': game_state['land_size'],
+        'version': farm.version,  # where /api/stream picks up from
+        # Placements are fetched per visible chunk from /api/grid
+        'grid_size': grid_size_for(game_state['farm_level'])
     }
 
-    # Get all available items for the UI
-    crops = CropType.get_all_crops()
-    animals_data = AnimalType.get_all_animals()
-    buildings = BuildingType.get_all_buildings()
-
+    # Only the farm is rendered per view; the catalog comes pre-rendered and from /api/catalog
     return render_template('index.html',
-                         resources=resources,
                          animals=animals,
                          game_info=game_info,
-                         placements=placements,
-                         crops=crops,
-                         animals_data=animals_data,
-                         buildings=buildings)
+                         menus=catalog_menus(),
+                         catalog_version=CATALOG_ETAG)
+
+
+@functools.cache
+def catalog_menus():
+    """The catalog's menu buttons (templates/catalog_menus.html), rendered once per process"""
+    return {
+        'building_buttons': Markup(get_template_attribute('catalog_menus.html', 'building_buttons')(
+            BuildingType.get_all_buildings())),
+        'animal_buttons': Markup(get_template_attribute('catalog_menus.html', 'animal_buttons')(
+            AnimalType.get_all_animals())),
+        'crop_buttons': Markup(get_template_attribute('catalog_menus.html', 'crop_buttons')(
+            CropType.get_all_crops()))
+    }
 
 
 @app.route('/api/place_object', methods=['POST'])
 def place_object():
     """API endpoint to place an object on the grid"""
     try:
-        user_id = session.get('user_id')
-        if not user_id:
-            return jsonify({'success': False, 'error': 'No user session'})
+        user_id = provision_user()
 
         data = request.json
-        grid_x = data.get('grid_x')
-        grid_y = data.get('grid_y')
+        cell, error = grid_cell(data, user_id)
+        if error:
+            return jsonify({'success': False, 'error': error})
+        grid_x, grid_y = cell
         object_type = data.get('object_type')  # 'crop', 'animal', 'building'
         object_name = data.get('object_name')
 
-        # Get current game state
-        game_state = db.get_game_state(user_id)
-        resources = {
-            'gold': game_state['gold'],
-            'wood': game_state['wood'],
-            'stone': game_state['stone'],
-            'food': game_state['food'],
-            'seeds': game_state['seeds'],
-            'water': game_state['water']
-        }
-
-        # Get object data and check costs
-        cost = {}
-        land_required = 1
-
-        if object_type == 'crop':
-            crop_data = CropType.get_crop(object_name)
-            if not crop_data:
-                return jsonify({'success': False, 'error': 'Invalid crop type'})
-            cost = crop_data['cost']
-            land_required = crop_data['land_required']
-
-        elif object_type == 'animal':
-            animal_data = AnimalType.get_animal(object_name)
-            if not animal_data:
-                return jsonify({'success': False, 'error': 'Invalid animal type'})
-            cost = animal_data['cost']
-            land_required = animal_data['land_required']
-
-        elif object_type == 'building':
-            building_data = BuildingType.get_building(object_name)
-            if not building_data:
-                return jsonify({'success': False, 'error': 'Invalid building type'})
-            cost = building_data['cost']
-            land_required = building_data['land_required']
-
-        # Check if player can afford
-        if not GameEconomy.can_afford(resources, cost):
-            return jsonify({'success': False, 'error': 'Insufficient resources'})
-
-        # Check land availability
-        placements = db.get_grid_placements(user_id)
-        land_used = GameEconomy.calculate_land_usage(placements)
-        if land_used + land_required > game_state['land_size']:
-            return jsonify({'success': False, 'error': 'Insufficient land'})
-
-        # Deduct cost
-        resources = GameEconomy.deduct_cost(resources, cost)
-
-        # Save placement
-        placement_data = {
-            'land_required': land_required,
-            'planted_day': game_state['day']
-        }
-        db.save_grid_placement(user_id, grid_x, grid_y, object_type, object_name, placement_data)
-
-        # Update resources
-        game_state['gold'] = resources['gold']
-        game_state['wood'] = resources['wood']
-        game_state['stone'] = resources['stone']
-        game_state['food'] = resources['food']
-        game_state['seeds'] = resources['seeds']
-        game_state['water'] = resources['water']
-        db.update_game_state(user_id, game_state)
-
-        # If animal, update animal count
-        if object_type == 'animal':
-            animals = db.get_animals(user_id)
-            current_count = animals.get(object_name, 0)
-            db.update_animals(user_id, object_name, current_count + 1)
+        # Read, validate and write inside one transaction; if another writer
+        # changed the farm first, the whole block runs again on fresh state
+        for attempt in farms.attempts(user_id, 'place'):
+            with attempt as repo:
+                resources = {key: repo.farm.resources[key] for key in RESOURCE_KEYS}
+
+                # Get object data and check costs
+                item = CATALOG.get(object_type, object_name)
+                if not item:
+                    return jsonify({'success': False, 'error': f'Invalid {object_type} type'})
+                land_required = item.land_required
+
+                # Check if player can afford
+                if not can_afford(resources, item.cost):
+                    return jsonify({'success': False, 'error': 'Insufficient resources'})
+
+                # Check land availability and that the whole footprint is free
+                grid = repo.farm.grid
+                width, height = footprint_for(land_required)
+                if grid.land_used + land_required > repo.farm.land_size:
+                    return jsonify({'success': False, 'error': 'Insufficient land'})
+                if not grid.in_bounds(grid_x, grid_y, width, height):
+                    return jsonify({'success': False, 'error': 'Does not fit on the farm'})
+                if not grid.fits(grid_x, grid_y, width, height):
+                    return jsonify({'success': False, 'error': 'Space is occupied'})
+
+                # Deduct cost
+                resources = deduct(resources, item.cost)
+
+                # Save placement
+                repo.save_grid_placement(grid_x, grid_y, object_type, object_name,
+                                         planted_day=repo.farm.day,
+                                         land_required=land_required)
+
+                # Update resources, as deltas so the row's balance is never overwritten
+                repo.add_resources({key: -amount for key, amount in zip(RESOURCE_KEYS, item.cost)})
+
+                # If animal, update animal count
+                if object_type == 'animal':
+                    repo.update_animals(object_name, repo.farm.animals.get(object_name, 0) + 1)
 
         return jsonify({
             'success': True,
@@ -169,7 +234,9 @@ def place_object():
                 'grid_x': grid_x,
                 'grid_y': grid_y,
                 'object_type': object_type,
-                'object_name': object_name
+                'object_name': object_name,
+                'width': width,
+                'height': height
             }
         })
 
@@ -181,15 +248,25 @@ def place_object():
 def remove_object():
     """API endpoint to remove an object from the grid"""
     try:
-        user_id = session.get('user_id')
-        if not user_id:
-            return jsonify({'success': False, 'error': 'No user session'})
-
-        data = request.json
-        grid_x = data.get('grid_x')
-        grid_y = data.get('grid_y')
-
-        db.remove_grid_placement(user_id, grid_x, grid_y)
+        user_id = provision_user()
+
+        cell, error = grid_cell(request.json, user_id)
+        if error:
+            return jsonify({'success': False, 'error': error})
+        grid_x, grid_y = cell
+
+        for attempt in farms.attempts(user_id, 'remove'):
+            with attempt as repo:
+                # Any cell of a multi-cell object removes the whole object
+                placement = repo.farm.placement_at(grid_x, grid_y)
+                if not placement:
+                    return jsonify({'success': False, 'error': 'Nothing to remove at this location'})
+                repo.remove_grid_placement(placement.grid_x, placement.grid_y)
+
+                # Removing an animal takes it out of the herd as well
+                if placement.object_type == 'animal':
+                    count = repo.get_animals().get(placement.object_name, 0)
+                    repo.update_animals(placement.object_name, max(count - 1, 0))
 
         return jsonify({'success': True})
 
@@ -199,37 +276,252 @@ def remove_object():
 
 @app.route('/api/get_state', methods=['GET'])
 def get_state():
-    """API endpoint to get current game state"""
+    """API endpoint to get current game state
+
+    Pass ?since=<version> to receive only what changed after that version
+    (or a full snapshot if it is too old). The ETag is the farm version, so
+    If-None-Match gets a 304 when nothing has changed.
+    """
     try:
-        user_id = session.get('user_id')
-        if not user_id:
-            return jsonify({'success': False, 'error': 'No user session'})
+        farm = session_farm()
+        if not farm:
+            return jsonify({'success': False, 'error': 'No game state'})
+
+        etag = f'{farm.user_id}-{farm.version}'
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            since = request.args.get('since', type=int)
+            delta = farm.delta_since(since) if since is not None else None
+            if delta is not None:
+                response = jsonify({'success': True, 'full': False, **delta})
+            else:
+                response = jsonify({
+                    'success': True,
+                    'full': True,
+                    'version': farm.version,
+                    'game_state': farm.game_state(),
+                    'placements': farm.placement_list(),
+                    'animals': farm.animals
+                })
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-        game_state = db.get_game_state(user_id)
-        placements = db.get_grid_placements(user_id)
-        animals = db.get_animals(user_id)
+
+@app.route('/api/grid', methods=['GET'])
+def get_grid():
+    """API endpoint to get the placements inside one viewport of the grid
+
+    Takes the inclusive rectangle ?x0=&y0=&x1=&y1= and returns every object
+    overlapping it. Served from the cached farm when it is in memory,
+    otherwise with an indexed range query.
+    """
+    try:
+        try:
+            x0, y0, x1, y1 = (int(request.args[key]) for key in ('x0', 'y0', 'x1', 'y1'))
+        except (KeyError, ValueError):
+            return jsonify({'success': False, 'error': 'x0, y0, x1 and y1 are required integers'})
+        x0, x1 = sorted((max(x0, 0), max(x1, 0)))
+        y0, y1 = sorted((max(y0, 0), max(y1, 0)))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_VIEWPORT_CELLS:
+            return jsonify({'success': False, 'error': f'At most {MAX_VIEWPORT_CELLS} cells per request'})
+
+        farm = session_farm(load=farms.peek)
+        if farm:
+            size = farm.grid.width
+            placements = farm.placements_in_rect(x0, y0, x1, y1)
+        else:
+            with db.read(session['user_id']) as repo:
+                game_state = repo.get_game_state()
+                if not game_state:
+                    return jsonify({'success': False, 'error': 'No game state'})
+                size = grid_size_for(game_state['farm_level'])
+                rows = repo.get_grid_placements_in_rect(x0, y0, x1, y1, reach=MAX_FOOTPRINT - 1)
+            # Drop objects anchored just up/left of the rectangle that do not reach into it
+            placements = [p for p in rows
+                          if p['grid_x'] + p['width'] > x0 and p['grid_y'] + p['height'] > y0]
 
         return jsonify({
             'success': True,
-            'game_state': game_state,
-            'placements': placements,
-            'animals': animals
+            'width': size,
+            'height': size,
+            'placements': placements
         })
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 
+def save_slot_arg(value):
+    """Parse a save slot number, raising ValueError when it is out of range"""
+    if isinstance(value, bool) or not 0 <= int(value) < MAX_SAVE_SLOTS:
+        raise ValueError(f'slot must be between 0 and {MAX_SAVE_SLOTS - 1}')
+    return int(value)
+
+
+def take_snapshot(user_id):
+    """Encode the farm as (snapshot bytes, farm version, day), or None if it does not exist
+
+    Taken inside a transaction, so no half-applied write is captured.
+    """
+    with farms.transaction(user_id) as repo:
+        farm = repo.farm
+        if farm is None:
+            return None
+        return snapshot.encode(farm), farm.version, farm.day
+
+
+def restore_snapshot(user_id, saved):
+    """Replace the whole farm with a decoded snapshot in one transaction
+
+    The farm version keeps counting up from where it is rather than going
+    back to the saved one, so clients holding newer versions still resync.
+    Returns the game state as committed, with the version the restore bumped it to.
+    """
+    for attempt in farms.attempts(user_id, 'load'):
+        with attempt as repo:
+            repo.remove_grid_placements(list(repo.farm.placements))
+            repo.update_game_state(saved.game_state)
+            repo.save_grid_placements(saved.placements)
+            for animal_type in set(repo.farm.animals) | set(saved.animals):
+                repo.update_animals(animal_type, saved.animals.get(animal_type, 0))
+    return farms.get(user_id).game_state()
+
+
 @app.route('/api/save_game', methods=['POST'])
 def save_game():
-    """API endpoint to manually save the game"""
+    """API endpoint to save the farm into a save slot ({"slot": N}, default 0)"""
+    try:
+        # Saving is the first thing some visitors do; it creates their farm
+        user_id = provision_user()
+
+        slot = save_slot_arg((request.get_json(silent=True) or {}).get('slot', 0))
+        taken = take_snapshot(user_id)
+        if taken is None:
+            return jsonify({'success': False, 'error': 'No game state'})
+        blob, version, day = taken
+        with db.unit_of_work(user_id) as repo:
+            repo.save_slot(slot, version, day, blob)
+
+        return jsonify({
+            'success': True,
+            'message': 'Game saved successfully',
+            'slot': slot,
+            'version': version,
+            'bytes': len(blob)
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/save_slots', methods=['GET'])
+def save_slots():
+    """API endpoint to list the filled save slots"""
+    try:
+        user_id = session.get('user_id')
+        slots = []
+        if user_id:
+            with db.read(user_id) as repo:
+                slots = repo.get_slots()
+        return jsonify({'success': True, 'max_slots': MAX_SAVE_SLOTS, 'slots': slots})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/load_game', methods=['POST'])
+def load_game():
+    """API endpoint to restore the farm from a save slot ({"slot": N}, default 0)"""
     try:
+        slot = save_slot_arg((request.get_json(silent=True) or {}).get('slot', 0))
+        user_id = session.get('user_id')
+        blob = None
+        if user_id:
+            with db.read(user_id) as repo:
+                blob = repo.get_slot(slot)
+        if blob is None:
+            return jsonify({'success': False, 'error': f'Save slot {slot} is empty'})
+
+        game_state = restore_snapshot(user_id, snapshot.decode(blob))
+        return jsonify({'success': True, 'slot': slot, 'game_state': game_state})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/export', methods=['GET'])
+def export_game():
+    """API endpoint to download a signed snapshot of the farm (or of ?slot=N)"""
+    try:
+        if SNAPSHOT_KEY is None:
+            return jsonify({'success': False, 'error': 'Export is disabled: FARM_SNAPSHOT_KEY is not set'})
         user_id = session.get('user_id')
         if not user_id:
-            return jsonify({'success': False, 'error': 'No user session'})
+            return jsonify({'success': False, 'error': 'No game state'})
+
+        slot = request.args.get('slot')
+        if slot is None:
+            taken = take_snapshot(user_id)
+            blob = taken[0] if taken else None
+        else:
+            with db.read(user_id) as repo:
+                blob = repo.get_slot(save_slot_arg(slot))
+        if blob is None:
+            return jsonify({'success': False, 'error': 'Nothing to export'})
+
+        signed = snapshot.sign(blob, SNAPSHOT_KEY, user_id)
+
+        def chunks():
+            for start in range(0, len(signed), EXPORT_CHUNK_BYTES):
+                yield signed[start:start + EXPORT_CHUNK_BYTES]
+
+        name = f'farm-{user_id}' + (f'-slot{slot}' if slot is not None else '') + '.farm'
+        return app.response_class(chunks(), mimetype='application/octet-stream', headers={
+            'Content-Length': str(len(signed)),
+            'Content-Disposition': f'attachment; filename="{name}"'
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 
-        # Game is auto-saved with every action, so this just confirms
-        return jsonify({'success': True, 'message': 'Game saved successfully'})
+@app.route('/api/import', methods=['POST'])
+def import_game():
+    """API endpoint to upload a snapshot from /api/export into ?slot=N (default 0)
+
+    The request body is the raw file, which must have been exported by
+    the same user. It is only stored; load it with /api/load_game.
+    """
+    try:
+        if SNAPSHOT_KEY is None:
+            return jsonify({'success': False, 'error': 'Import is disabled: FARM_SNAPSHOT_KEY is not set'})
+        user_id = session.get('user_id')
+        if not user_id:
+            # Only a farm's own exports import, so a visitor has none to bring
+            return jsonify({'success': False, 'error': 'Snapshot was exported from another farm'})
+        slot = save_slot_arg(request.args.get('slot', 0))
+        limit = snapshot.MAX_SNAPSHOT_BYTES + snapshot.SIGNATURE_BYTES
+        body = bytearray()
+        while len(body) <= limit:
+            chunk = request.stream.read(EXPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            body += chunk
+        if len(body) > limit:
+            return jsonify({'success': False, 'error': 'Snapshot is too large'})
+
+        blob = snapshot.verify(bytes(body), SNAPSHOT_KEY, user_id)
+        saved = snapshot.decode(blob)  # reject anything this version cannot load
+        with db.unit_of_work(user_id) as repo:
+            repo.save_slot(slot, saved.version, saved.game_state['day'], blob)
+
+        return jsonify({'success': True, 'slot': slot, 'bytes': len(blob)})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -239,80 +531,152 @@ def save_game():
 def calculate_economy():
     """API endpoint to calculate daily revenue and expenses"""
     try:
-        user_id = session.get('user_id')
-        if not user_id:
-            return jsonify({'success': False, 'error': 'No user session'})
+        # Running totals kept up to date on every change, so this is one row
+        farm = session_farm(load=farms.peek)
+        if farm:
+            economy = farm.economy
+        else:
+            with db.read(session['user_id']) as repo:
+                economy = repo.get_economy()
+        if not economy:
+            return jsonify({'success': False, 'error': 'No game state'})
+
+        return jsonify({'success': True, **economy.summary()})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/harvest_crop', methods=['POST'])
+def harvest_crop():
+    """API endpoint to harvest a crop"""
+    try:
+        user_id = provision_user()
+
+        cell, error = grid_cell(request.json, user_id)
+        if error:
+            return jsonify({'success': False, 'error': error})
+        grid_x, grid_y = cell
+
+        for attempt in farms.attempts(user_id, 'harvest'):
+            with attempt as repo:
+                # Get the placement covering this cell
+                crop_placement = repo.farm.placement_at(grid_x, grid_y)
+                if not crop_placement or crop_placement.object_type != 'crop':
+                    return jsonify({'success': False, 'error': 'No crop found at this location'})
+
+                crop = CATALOG.get('crop', crop_placement.object_name)
+                if not crop:
+                    return jsonify({'success': False, 'error': 'Invalid crop'})
+
+                # Check if crop is mature
+                if not repo.farm.is_ready(crop_placement):
+                    return jsonify({'success': False, 'error': 'Crop not ready for harvest'})
 
-        animals = db.get_animals(user_id)
-        placements = db.get_grid_placements(user_id)
+                # Harvest the crop
+                revenue = repo.get_economy().harvest_revenue(crop)
 
-        # Get building types from placements
-        buildings = [p['object_name'] for p in placements if p['object_type'] == 'building']
+                # Remove the crop from grid
+                repo.remove_grid_placement(crop_placement.grid_x, crop_placement.grid_y)
 
-        revenue = GameEconomy.calculate_daily_revenue({}, animals, buildings)
-        expenses = GameEconomy.calculate_daily_expenses(animals)
-        net_income = revenue - expenses
+                # Add the harvest to the stored balances rather than overwriting them
+                repo.add_resources({'gold': revenue, 'food': crop.food_value})
+                game_state = repo.get_game_state()
 
         return jsonify({
             'success': True,
             'revenue': revenue,
-            'expenses': expenses,
-            'net_income': net_income
+            'resources': {
+                'gold': game_state['gold'],
+                'food': game_state['food']
+            }
         })
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 
-@app.route('/api/harvest_crop', methods=['POST'])
-def harvest_crop():
-    """API endpoint to harvest a crop"""
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """API endpoint to apply many grid operations in one request
+
+    Takes {"operations": [...]} where each operation is one of
+    place/remove/harvest (grid_x, grid_y) or fill/clear (x0, y0, x1, y1).
+    Operations are validated in order and applied in a single transaction.
+    """
     try:
-        user_id = session.get('user_id')
-        if not user_id:
-            return jsonify({'success': False, 'error': 'No user session'})
+        user_id = provision_user()
 
-        data = request.json
-        grid_x = data.get('grid_x')
-        grid_y = data.get('grid_y')
-
-        # Get the placement
-        placements = db.get_grid_placements(user_id)
-        crop_placement = None
-        for p in placements:
-            if p['grid_x'] == grid_x and p['grid_y'] == grid_y and p['object_type'] == 'crop':
-                crop_placement = p
-                break
+        operations = (request.get_json(silent=True) or {}).get('operations')
+        if not isinstance(operations, list) or not operations:
+            return jsonify({'success': False, 'error': 'operations must be a non-empty list'})
+        if len(operations) > MAX_OPERATIONS:
+            return jsonify({'success': False, 'error': f'At most {MAX_OPERATIONS} operations per batch'})
 
-        if not crop_placement:
-            return jsonify({'success': False, 'error': 'No crop found at this location'})
+        for attempt in farms.attempts(user_id, 'batch'):
+            with attempt as repo:
+                results, changes, resources, revenue = run_batch(repo, operations)
 
-        crop_data = CropType.get_crop(crop_placement['object_name'])
-        if not crop_data:
-            return jsonify({'success': False, 'error': 'Invalid crop'})
+        return jsonify({
+            'success': True,
+            'results': results,
+            'placed': changes['placed'],
+            'removed': changes['removed'],
+            'revenue': revenue,
+            'resources': resources
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-        # Check if crop is mature
-        game_state = db.get_game_state(user_id)
-        current_day = game_state['day']
-        planted_day = crop_placement.get('planted_day', 0)
-        days_grown = current_day - planted_day
 
-        if days_grown < crop_data['growth_time']:
-            return jsonify({'success': False, 'error': 'Crop not ready for harvest'})
+@app.route('/api/ready_crops', methods=['GET'])
+def ready_crops():
+    """API endpoint to list crops that are ready to harvest"""
+    try:
+        farm = session_farm()
+        if not farm:
+            return jsonify({'success': False, 'error': 'No game state'})
 
-        # Harvest the crop
-        revenue = crop_data['revenue']
-        game_state['gold'] += revenue
-        game_state['food'] += crop_data.get('food_value', 5)
+        return jsonify({
+            'success': True,
+            'day': farm.day,
+            'crops': [
+                {'grid_x': p.grid_x, 'grid_y': p.grid_y, 'object_name': p.object_name}
+                for p in farm.ready_crops()
+            ]
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/harvest_ready', methods=['POST'])
+def harvest_ready():
+    """API endpoint to harvest every crop that is ready"""
+    try:
+        user_id = provision_user()
 
-        # Remove the crop from grid
-        db.remove_grid_placement(user_id, grid_x, grid_y)
+        for attempt in farms.attempts(user_id, 'harvest'):
+            with attempt as repo:
+                ready = repo.farm.ready_crops()
 
-        # Update game state
-        db.update_game_state(user_id, game_state)
+                revenue = food = 0
+                harvested = []
+                for placement in ready:
+                    crop = CATALOG.get('crop', placement.object_name)
+                    revenue += repo.get_economy().harvest_revenue(crop)
+                    food += crop.food_value
+                    harvested.append((placement.grid_x, placement.grid_y))
+
+                if harvested:
+                    repo.remove_grid_placements(harvested)
+                    repo.add_resources({'gold': revenue, 'food': food})
+                game_state = repo.get_game_state()
 
         return jsonify({
             'success': True,
+            'harvested': [{'grid_x': x, 'grid_y': y} for x, y in harvested],
             'revenue': revenue,
             'resources': {
                 'gold': game_state['gold'],
@@ -324,5 +688,129 @@ def harvest_crop():
         return jsonify({'success': False, 'error': str(e)})
 
 
+def fast_forward(user_id, days):
+    """Apply `days` simulated days to a farm in one transaction
+
+    A single day uses the per-day tick; longer spans (such as catching up a
+    player who has been away) are computed in closed form.
+    """
+    for attempt in farms.attempts(user_id, 'advance_day'):
+        with attempt as repo:
+            if days == 1:
+                result = simulation.tick(repo.farm)
+            else:
+                result = simulation.fast_forward(repo.farm, days)
+            repo.update_game_state(result['game_state'])
+    return result
+
+
+@app.route('/api/advance_day', methods=['POST'])
+def advance_day():
+    """API endpoint to advance the farm by one or more days"""
+    try:
+        user_id = provision_user()
+
+        data = request.get_json(silent=True) or {}
+        days = data.get('days', 1)
+        if type(days) is not int or not 1 <= days <= MAX_ADVANCE_DAYS:
+            return jsonify({'success': False,
+                            'error': f'days must be an integer from 1 to {MAX_ADVANCE_DAYS}'})
+
+        result = fast_forward(user_id, days)
+
+        game_state = result['game_state']
+        broker.publish(user_id, 'tick', {
+            'day': game_state['day'],
+            'season': game_state['season'],
+            'days': days,
+            'delta': result['delta'],
+            'ready_crops': result['ready_crops']
+        })
+        return jsonify({
+            'success': True,
+            'day': game_state['day'],
+            'season': game_state['season'],
+            'resources': {key: game_state[key] for key in RESOURCE_KEYS},
+            'delta': result['delta'],
+            'ready_crops': result['ready_crops']
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/catalog', methods=['GET'])
+def catalog():
+    """Every crop, animal and building type, as {crop, animal, building}
+
+    The ETag is a hash of the content. The page asks for
+    /api/catalog?v=<that hash>, which may be cached for good because a
+    changed catalog gets a new URL; without a matching v, clients keep it
+    for an hour and then revalidate, getting a 304 if it is unchanged.
+    """
+    response = Response(CATALOG_JSON, mimetype='application/json')
+    response.set_etag(CATALOG_ETAG)
+    if request.args.get('v') == CATALOG_ETAG:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response.make_conditional(request)
+
+
+@app.route('/api/stream', methods=['GET'])
+def stream():
+    """Server-Sent Events with the session's farm changes (see pubsub.py)
+
+    Starts with a sync from the version in Last-Event-ID (sent by a
+    reconnecting EventSource) or ?since=, then pushes change, ready and
+    tick events, with a keep-alive comment when idle. Visitors without a
+    farm get 204, which tells EventSource not to reconnect.
+    """
+    user_id = session.get('user_id')
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    # Subscribe before reading the farm so no change falls between the two
+    subscription = broker.subscribe(user_id) if user_id else None
+    farm = farms.get(user_id) if user_id else None
+    if farm is None:
+        if subscription is not None:
+            broker.unsubscribe(subscription)
+        return app.response_class(status=204)
+    subscription.version = farm.version
+    first = pubsub.sync_event(farm, since)
+
+    def events():
+        try:
+            yield f'retry: {pubsub.RETRY_MS}\n\n' + first
+            deadline = time.monotonic() + pubsub.STREAM_SECONDS
+            while time.monotonic() < deadline:
+                texts = subscription.wait(pubsub.HEARTBEAT_SECONDS)
+                if texts is None:
+                    # Fell too far behind: send what changed since the last version it got
+                    farm = farms.get(user_id)
+                    if farm is None:
+                        return
+                    since, subscription.version = subscription.version, farm.version
+                    yield pubsub.sync_event(farm, since)
+                elif texts:
+                    yield ''.join(texts)
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            broker.unsubscribe(subscription)
+
+    return app.response_class(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # stop proxies such as nginx from buffering the stream
+    })
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Request, query, cache and journal metrics in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5002)
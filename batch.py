@@ -0,0 +1,207 @@
+"""
+Batched grid operations for /api/batch
+
+A batch is planned against a scratch copy of the farm first: every
+operation is validated in order against the resources, land and grid
+left by the operations before it. The net effect is then written in one
+transaction with a couple of executemany calls.
+"""
+from dataclasses import replace
+
+from farm_grid import footprint_for
+from farm_state import RESOURCE_KEYS
+from game_models import CATALOG, can_afford, deduct
+
+
+MAX_OPERATIONS = 500
+COORDINATES = ('grid_x', 'grid_y', 'x0', 'y0', 'x1', 'y1')  # operation keys that must be ints
+
+
+class BatchPlan:
+    """Running state of a batch while its operations are validated"""
+
+    def __init__(self, farm):
+        self.farm = farm
+        self.resources = dict(farm.resources)
+        self.grid = farm.grid.copy()
+        self.economy = replace(farm.economy)  # only its crop bonus is read
+        self.animals = {}  # animal_type -> new count
+        self.changes = {}  # (grid_x, grid_y) -> placement tuple, or None when removed
+        self.revenue = 0
+
+    def placement_at(self, grid_x, grid_y):
+        """(anchor, placement) covering a cell, where placement is a tuple or Placement"""
+        anchor = self.grid.anchor_at(grid_x, grid_y)
+        if anchor is None:
+            return None, None
+        if anchor in self.changes:
+            return anchor, self.changes[anchor]
+        return anchor, self.farm.placements.get(anchor)
+
+    def place(self, grid_x, grid_y, object_type, object_name):
+        item = CATALOG.get(object_type, object_name)
+        if not item:
+            return f'Invalid {object_type} type'
+        if not can_afford(self.resources, item.cost):
+            return 'Insufficient resources'
+
+        land_required = item.land_required
+        width, height = footprint_for(land_required)
+        if self.grid.land_used + land_required > self.farm.land_size:
+            return 'Insufficient land'
+        if not self.grid.in_bounds(grid_x, grid_y, width, height):
+            return 'Does not fit on the farm'
+        if not self.grid.fits(grid_x, grid_y, width, height):
+            return 'Space is occupied'
+
+        deduct(self.resources, item.cost)
+        self.economy.add_placement(object_type, object_name)
+        self.grid.occupy(grid_x, grid_y, width, height, land_required)
+        self.changes[(grid_x, grid_y)] = (grid_x, grid_y, object_type, object_name,
+                                          self.farm.day, land_required, None)
+        if object_type == 'animal':
+            self._add_animal(object_name, 1)
+        return None
+
+    def remove(self, grid_x, grid_y):
+        anchor, placement = self.placement_at(grid_x, grid_y)
+        if placement is None:
+            return 'Nothing to remove at this location'
+        if isinstance(placement, tuple):
+            object_type, object_name = placement[2], placement[3]
+        else:
+            object_type, object_name = placement.object_type, placement.object_name
+        self.economy.add_placement(object_type, object_name, -1)
+        if object_type == 'animal':
+            self._add_animal(object_name, -1)
+        self.grid.vacate(*anchor)
+        self.changes[anchor] = None
+        return None
+
+    def _add_animal(self, animal_type, delta):
+        count = self.animals.get(animal_type, self.farm.animals.get(animal_type, 0))
+        self.animals[animal_type] = max(count + delta, 0)
+
+    def harvest(self, grid_x, grid_y):
+        anchor, placement = self.placement_at(grid_x, grid_y)
+        # Crops planted in this batch are tuples and cannot be ready yet
+        if placement is None or isinstance(placement, tuple) or placement.object_type != 'crop':
+            return 'No crop found at this location'
+        if not self.farm.is_ready(placement):
+            return 'Crop not ready for harvest'
+
+        crop = CATALOG.get('crop', placement.object_name)
+        revenue = self.economy.harvest_revenue(crop)
+        self.revenue += revenue
+        self.resources['gold'] += revenue
+        self.resources['food'] += crop.food_value
+        self.economy.add_placement('crop', placement.object_name, -1)
+        self.grid.vacate(*anchor)
+        self.changes[anchor] = None
+        return None
+
+    def fill(self, x0, y0, x1, y1, object_type, object_name):
+        """Place copies of an object edge to edge across a rectangle"""
+        item = CATALOG.get(object_type, object_name)
+        if not item:
+            return f'Invalid {object_type} type', 0
+        width, height = footprint_for(item.land_required)
+        x0, y0, x1, y1 = self._clip(x0, y0, x1, y1)
+
+        placed, last_error = 0, None
+        for y in range(y0, y1 - height + 2, height):
+            for x in range(x0, x1 - width + 2, width):
+                error = self.place(x, y, object_type, object_name)
+                if error is None:
+                    placed += 1
+                elif error in ('Insufficient resources', 'Insufficient land'):
+                    # Nothing further can succeed; keep what already fit
+                    return (None if placed else error), placed
+                else:
+                    last_error = error
+        if placed:
+            return None, placed
+        return last_error or 'Nothing fits in this area', 0
+
+    def clear(self, x0, y0, x1, y1):
+        """Remove every object anchored inside a rectangle"""
+        x0, y0, x1, y1 = self._clip(x0, y0, x1, y1)
+        removed = 0
+        for (x, y) in list(self.grid.footprints):
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                self.remove(x, y)
+                removed += 1
+        return None, removed
+
+    def _clip(self, x0, y0, x1, y1):
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        return (max(x0, 0), max(y0, 0),
+                min(x1, self.grid.width - 1), min(y1, self.grid.height - 1))
+
+    def apply(self, session):
+        """Write the net effect of the batch through a FarmSession"""
+        removed = [cell for cell, change in self.changes.items()
+                   if change is None and cell in self.farm.placements]
+        saved = [change for change in self.changes.values() if change is not None]
+
+        if removed:
+            session.remove_grid_placements(removed)
+        if saved:
+            session.save_grid_placements(saved)
+        deltas = {key: self.resources[key] - self.farm.resources[key] for key in RESOURCE_KEYS}
+        if any(deltas.values()):
+            session.add_resources(deltas)
+        for animal_type, count in self.animals.items():
+            session.update_animals(animal_type, count)
+
+
+def run_batch(session, operations):
+    """Validate and apply a list of operations, returning one result per operation"""
+    plan = BatchPlan(session.farm)
+    results = []
+
+    for op in operations:
+        kind = op.get('op') if isinstance(op, dict) else None
+        count = None
+        try:
+            # bool is an int subclass, so check the exact type
+            if kind and any(type(op[key]) is not int for key in COORDINATES if key in op):
+                raise TypeError('coordinates must be integers')
+            if kind == 'place':
+                error = plan.place(op['grid_x'], op['grid_y'], op['object_type'], op['object_name'])
+            elif kind == 'remove':
+                error = plan.remove(op['grid_x'], op['grid_y'])
+            elif kind == 'harvest':
+                error = plan.harvest(op['grid_x'], op['grid_y'])
+            elif kind == 'fill':
+                error, count = plan.fill(op['x0'], op['y0'], op['x1'], op['y1'],
+                                         op['object_type'], op['object_name'])
+            elif kind == 'clear':
+                error, count = plan.clear(op['x0'], op['y0'], op['x1'], op['y1'])
+            else:
+                error = f'Unknown operation: {kind}'
+        except (KeyError, TypeError) as e:
+            error = f'Malformed operation: {e}'
+
+        result = {'op': kind, 'success': error is None}
+        if error:
+            result['error'] = error
+        if count is not None:
+            result['count'] = count
+        results.append(result)
+
+    plan.apply(session)
+
+    changes = {
+        'placed': [
+            {'grid_x': c[0], 'grid_y': c[1], 'object_type': c[2], 'object_name': c[3]}
+            for c in plan.changes.values() if c is not None
+        ],
+        'removed': [
+            {'grid_x': x, 'grid_y': y}
+            for (x, y), c in plan.changes.items() if c is None
+        ]
+    }
+    resources = {key: plan.resources[key] for key in RESOURCE_KEYS}
+    return results, changes, resources, plan.revenue
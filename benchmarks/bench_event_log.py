@@ -0,0 +1,86 @@
+"""
+Event log size and replay time
+
+Applies random place/remove/animal/advance-day transactions to one farm
+through FarmStateCache, then:
+  * checks that replaying the log gives exactly the farm's rows
+  * compares the average event size with the game_state row each
+    transaction used to rewrite
+  * times replay from a new farm against replay from the latest periodic
+    snapshot plus the events after it
+Run from the repository root:
+    python benchmarks/bench_event_log.py [transactions]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import event_log
+from database import FarmDatabase
+from farm_state import FarmStateCache
+from game_models import CATALOG
+from simulation import Simulation
+
+
+def play(farms, user_id, transactions, seed=0):
+    rng = random.Random(seed)
+    sim = Simulation()
+    crops = [c.key for c in CATALOG.crops]
+    animals = [a.key for a in CATALOG.animals]
+    for _ in range(transactions):
+        kind = rng.random()
+        x, y = rng.randrange(40), rng.randrange(40)
+        if kind < 0.5:
+            with farms.transaction(user_id, 'place') as repo:
+                repo.save_grid_placement(x, y, 'crop', rng.choice(crops), repo.farm.day, 1)
+                state = repo.get_game_state()
+                state['gold'] -= 1
+                repo.update_game_state(state)
+        elif kind < 0.7:
+            with farms.transaction(user_id, 'remove') as repo:
+                repo.remove_grid_placement(x, y)
+        elif kind < 0.8:
+            with farms.transaction(user_id, 'update') as repo:
+                repo.update_animals(rng.choice(animals), rng.randint(0, 5))
+        else:
+            with farms.transaction(user_id, 'advance_day') as repo:
+                repo.update_game_state(sim.tick(repo.farm)['game_state'])
+
+
+def timed(fn, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 2050
+    db = FarmDatabase(os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    farms = FarmStateCache(db)
+    user_id = db.create_user('bench')
+    with farms.transaction(user_id) as repo:
+        repo.update_game_state({**repo.get_game_state(), 'gold': 10 ** 9})
+    play(farms, user_id, transactions)
+
+    with db.read(user_id) as repo:
+        events = repo.get_events()
+        snapshot_version, blob = repo.get_farm_snapshot()
+        replayed = event_log.load(repo)
+        assert event_log.matches(repo, replayed), 'replay does not match the rows'
+    print(f'{len(events)} events: replay from snapshot {snapshot_version} matches the rows')
+
+    with db.connection() as conn:
+        row = conn.execute('SELECT * FROM game_state WHERE user_id = ?', (user_id,)).fetchone()
+    row_bytes = sum(len(str(value)) for value in row)
+    event_bytes = sum(len(payload) for _, payload in events) / len(events)
+    print(f'average event {event_bytes:.1f} bytes; a game_state row is ~{row_bytes} bytes')
+
+    tail = [event for event in events if event[0] > snapshot_version]
+    print(f'replay all {len(events)} events:        {timed(lambda: event_log.replay(None, events)):7.2f} ms')
+    print(f'replay snapshot + {len(tail):>3} events:     '
+          f'{timed(lambda: event_log.replay(blob, tail)):7.2f} ms')
@@ -0,0 +1,69 @@
+"""
+Check Simulation.advance against repeated step() calls and time both
+
+Every random farm is fast-forwarded in closed form and day by day; the two
+end states must match exactly. Run from the repository root:
+    python benchmarks/bench_fast_forward.py [farms]
+"""
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_tick import build_farm
+from simulation import FarmVectors, Simulation
+
+
+def random_farm(rng):
+    farm = build_farm(rng.randint(0, 300), seed=rng.random())
+    # Small stocks so food and water actually run out inside the window
+    farm.resources.update(gold=rng.randint(0, 500), food=rng.randint(0, 200),
+                          water=rng.randint(0, 300))
+    farm.animals = {name: rng.randint(0, 3) for name in farm.animals}
+    return farm
+
+
+def check(farms, seed=0):
+    rng = random.Random(seed)
+    sim = Simulation()
+    for _ in range(farms):
+        farm = random_farm(rng)
+        days = rng.randint(1, 60)
+
+        stepped = FarmVectors.from_farm(farm)
+        for _ in range(days):
+            sim.step(stepped)
+        closed = FarmVectors.from_farm(farm)
+        sim.advance(closed, days)
+
+        if stepped.day != closed.day or not np.array_equal(stepped.resources, closed.resources):
+            raise AssertionError(f'mismatch after {days} days: '
+                                 f'{stepped.resources.tolist()} != {closed.resources.tolist()}')
+    print(f'{farms} random farms: closed form matches day-by-day stepping')
+
+
+def bench(placements=2000, days=(1, 30, 365, 3650)):
+    farm = build_farm(placements)
+    sim = Simulation()
+    for n in days:
+        vectors = FarmVectors.from_farm(farm)
+        start = time.perf_counter()
+        for _ in range(n):
+            sim.step(vectors)
+        stepped = time.perf_counter() - start
+
+        vectors = FarmVectors.from_farm(farm)
+        start = time.perf_counter()
+        sim.advance(vectors, n)
+        closed = time.perf_counter() - start
+        print(f'{n:>5} days, {placements} placements: step loop {stepped * 1e3:8.2f} ms   '
+              f'closed form {closed * 1e3:6.2f} ms')
+
+
+if __name__ == '__main__':
+    check(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
+    bench()
@@ -0,0 +1,58 @@
+"""
+Overhead of the metrics layer on database calls
+
+Times the same repository reads and writes with the instrumented methods
+and with the plain methods underneath them (and no statement trace), and
+prints the cost per call. Run from the repository root:
+    python benchmarks/bench_metrics.py [calls]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+from database import FarmDatabase, FarmRepository
+
+
+def timed(repo, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        repo.get_game_state()
+        repo.get_economy()
+        repo.bump_version()
+    return (time.perf_counter() - start) / (calls * 3) * 1e6
+
+
+def best(conn, repo, trace, calls, repeat=5):
+    conn.set_trace_callback(trace)
+    return min(timed(repo, calls) for _ in range(repeat))
+
+
+class PlainRepository(FarmRepository):
+    """FarmRepository with the metrics wrappers taken off"""
+
+
+for name in ('get_game_state', 'get_economy', 'bump_version'):
+    setattr(PlainRepository, name, getattr(FarmRepository, name).__wrapped__)
+
+
+if __name__ == '__main__':
+    if not metrics.ENABLED:
+        sys.exit('Unset FARM_METRICS=0 to measure the metrics overhead')
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    db = FarmDatabase(os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    user_id = db.create_user('bench')
+    with db.connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        # Alternate the two so neither gets the warm caches
+        plain, instrumented = [], []
+        for _ in range(3):
+            plain.append(best(conn, PlainRepository(conn, user_id), None, calls))
+            instrumented.append(best(conn, FarmRepository(conn, user_id), metrics.trace, calls))
+        conn.rollback()
+    plain, instrumented = min(plain), min(instrumented)
+    print(f'plain:        {plain:6.2f} us per call')
+    print(f'instrumented: {instrumented:6.2f} us per call (+{instrumented - plain:.2f} us)')
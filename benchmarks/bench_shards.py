@@ -0,0 +1,70 @@
+"""
+Write throughput against 1, 2, 4 and 8 shard files
+
+Worker processes each own a set of farms and commit one game_state update
+per transaction through FarmDatabase.unit_of_work, which is what every
+mutating request does. With one file all workers queue on a single SQLite
+write lock; with N shards they only queue behind writers on the same
+shard, so throughput grows with shards up to the number of cores. Run from
+the repository root:
+    python benchmarks/bench_shards.py [processes] [seconds per run]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DEFAULT_PRAGMAS
+from sharding import ShardedFarmDatabase
+
+
+# fsync every commit, as a deployment that cannot lose acknowledged writes would
+PRAGMAS = dict(DEFAULT_PRAGMAS, synchronous='FULL')
+
+
+def worker(db_name, shards, user_ids, stop, counts, index):
+    db = ShardedFarmDatabase(db_name, shards=shards, pragmas=PRAGMAS)
+    writes = 0
+    while time.time() < stop:
+        user_id = user_ids[writes % len(user_ids)]
+        with db.unit_of_work(user_id) as repo:
+            state = repo.get_game_state()
+            state['gold'] += 1
+            repo.update_game_state(state)
+        writes += 1
+    counts[index] = writes
+    db.close()
+
+
+def run(shards, processes, seconds):
+    db_name = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    db = ShardedFarmDatabase(db_name, shards=shards, pragmas=PRAGMAS)
+    user_ids = [db.create_user(f'bench_{i}') for i in range(processes * 8)]
+    counts = multiprocessing.Array('l', processes)
+    stop = time.time() + seconds
+
+    workers = [multiprocessing.Process(target=worker, args=(db_name, shards, user_ids[p::processes],
+                                                            stop, counts, p))
+               for p in range(processes)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    total = sum(db.get_game_state(user_id)['gold'] - 100 for user_id in user_ids)
+    assert total == sum(counts), 'lost updates'
+    db.close()
+    return total / seconds
+
+
+if __name__ == '__main__':
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() * 2
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    baseline = None
+    for shards in (1, 2, 4, 8):
+        rate = run(shards, processes, seconds)
+        baseline = baseline or rate
+        print(f'{shards} shard(s), {processes} processes: {rate:8.0f} writes/s  ({rate / baseline:.2f}x)')
@@ -0,0 +1,78 @@
+"""
+Snapshot size and load time against the farm's rows
+
+For farms of increasing size, compares the bytes a snapshot takes with the
+bytes of its game_state / grid_placements / farm_animals rows, checks the
+snapshot round-trips, and times loading the farm from its rows (three
+queries) against reading and decoding one save slot into the same Farm.
+Run from the repository root:
+    python benchmarks/bench_snapshots.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshot
+from bench_tick import build_farm
+from database import FarmDatabase
+from farm_state import Farm, FarmStateCache, Placement
+
+
+def row_bytes(db, user_id):
+    with db.connection() as conn:
+        total = 0
+        for table in ('game_state', 'grid_placements', 'farm_animals'):
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            total += conn.execute(
+                f'SELECT COALESCE(SUM({" + ".join(f"COALESCE(LENGTH(CAST({c} AS BLOB)), 0)" for c in columns)}), 0) '
+                f'FROM {table} WHERE user_id = ?', (user_id,)).fetchone()[0]
+    return total
+
+
+def timed(fn, repeat=50):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    db = FarmDatabase(os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    farms = FarmStateCache(db, max_entries=0)  # never keep a farm, so every get() loads it
+    print(f'{"placements":>10} {"rows":>9} {"snapshot":>9} {"load rows":>10} {"load slot":>10}')
+    for size in (10, 100, 1000, 5000):
+        user_id = db.create_user(f'bench_{size}')
+        built = build_farm(size)
+        with db.unit_of_work(user_id) as repo:
+            repo.update_game_state(built.game_state())
+            repo.save_grid_placements([(p.grid_x, p.grid_y, p.object_type, p.object_name,
+                                        p.planted_day, p.land_required, p.data)
+                                       for p in built.placements.values()])
+            for animal_type, count in built.animals.items():
+                repo.update_animals(animal_type, count)
+
+        farm = farms.get(user_id)
+        blob = snapshot.encode(farm)
+        with db.unit_of_work(user_id) as repo:
+            repo.save_slot(0, farm.version, farm.day, blob)
+
+        saved = snapshot.decode(blob)
+        assert sorted(saved.placements) == sorted(
+            (p.grid_x, p.grid_y, p.object_type, p.object_name, p.planted_day, p.land_required, p.data)
+            for p in farm.placements.values()), 'placements did not round-trip'
+        assert saved.animals == farm.animals and saved.game_state['gold'] == farm.resources['gold']
+
+        def load_slot():
+            with db.read(user_id) as repo:
+                saved = snapshot.decode(repo.get_slot(0))
+            # Build the same in-memory Farm the row path builds
+            restored = Farm.from_rows(user_id, saved.game_state, [], saved.animals)
+            for x, y, object_type, object_name, planted_day, land_required, data in saved.placements:
+                restored.add_placement(Placement(x, y, object_type, object_name, planted_day=planted_day,
+                                                 land_required=land_required, data=data))
+
+        print(f'{size:>10} {row_bytes(db, user_id):>9} {len(blob):>9} '
+              f'{timed(lambda: farms.get(user_id)):>8.2f}ms {timed(load_slot):>8.2f}ms')
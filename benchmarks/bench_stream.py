@@ -0,0 +1,70 @@
+"""
+Cost of pushing farm changes to /api/stream subscribers
+
+Commits the same transaction on a farm with no subscribers, then with 1,
+10 and 100 idle subscribers that drain their buffers in threads, and
+prints the cost per commit. Then checks that a subscriber which stops
+reading is resynced once instead of buffering without bound. Run from the
+repository root:
+    python benchmarks/bench_stream.py [transactions]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pubsub
+from database import FarmDatabase
+from farm_state import FarmStateCache
+
+
+def drain(subscription, stop):
+    while not stop.is_set():
+        subscription.wait(0.05)
+
+
+def timed(farms, user_id, transactions):
+    start = time.perf_counter()
+    for _ in range(transactions):
+        with farms.transaction(user_id, 'harvest') as repo:
+            repo.add_resources({'gold': 1})
+    return (time.perf_counter() - start) / transactions * 1e6
+
+
+if __name__ == '__main__':
+    transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    db = FarmDatabase(os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    broker = pubsub.FarmBroker()
+    farms = FarmStateCache(db)
+    farms.listeners.append(broker.publish_commit)
+    user_id = db.create_user('bench')
+    farms.get(user_id)
+
+    for count in (0, 1, 10, 100):
+        stop = threading.Event()
+        subscriptions = [broker.subscribe(user_id) for _ in range(count)]
+        threads = [threading.Thread(target=drain, args=(s, stop)) for s in subscriptions]
+        for thread in threads:
+            thread.start()
+        cost = timed(farms, user_id, transactions)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        for subscription in subscriptions:
+            broker.unsubscribe(subscription)
+        print(f'{count:4d} subscribers: {cost:7.1f} us per commit')
+
+    # A client that stops reading holds at most MAX_BUFFER events, then needs one sync
+    stalled = broker.subscribe(user_id)
+    overflows = broker.overflows
+    timed(farms, user_id, pubsub.MAX_BUFFER * 3)
+    assert len(stalled._events) == 0 and broker.overflows == overflows + 1
+    assert stalled.wait(0) is None, 'overflowed subscriber should be resynced'
+    farm = farms.get(user_id)
+    assert f'id: {farm.version}\n' in pubsub.sync_event(farm, farm.version - pubsub.MAX_BUFFER * 3)
+    broker.unsubscribe(stalled)
+    print(f'stalled subscriber: resynced after {pubsub.MAX_BUFFER} buffered events')
+    db.close()
@@ -0,0 +1,62 @@
+"""
+Time Simulation.tick for farms with thousands of placements
+
+Run from the repository root:
+    python benchmarks/bench_tick.py [placements ...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from farm_grid import FarmGrid
+from farm_state import Farm, Placement, RESOURCE_KEYS
+from game_models import CropType, AnimalType
+from simulation import FarmVectors, Simulation
+
+
+def build_farm(placements, seed=0):
+    """A farm with `placements` crops/buildings scattered over a large grid"""
+    rng = random.Random(seed)
+    side = int((placements * 10) ** 0.5) + 1
+    farm = Farm(1, {key: 10_000 for key in RESOURCE_KEYS}, day=rng.randint(1, 10),
+                grid=FarmGrid(side, side))
+    crops = list(CropType.CROPS)
+    # Mostly plain buildings; a few bonus buildings so multipliers stay realistic
+    buildings = ['well', 'fence', 'house'] * 20 + ['barn', 'silo', 'windmill']
+    while len(farm.placements) < placements:
+        x, y = rng.randrange(side), rng.randrange(side)
+        if (x, y) in farm.placements:
+            continue
+        if rng.random() < 0.9:
+            p = Placement(x, y, 'crop', rng.choice(crops), planted_day=rng.randint(1, 10))
+        else:
+            p = Placement(x, y, 'building', rng.choice(buildings))
+        farm.placements[(x, y)] = p
+    farm.animals = {name: rng.randint(0, 50) for name in AnimalType.ANIMALS}
+    return farm
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench(placements, repeat=200):
+    farm = build_farm(placements)
+    sim = Simulation()
+    vectors = FarmVectors.from_farm(farm)
+    tick = timed(lambda: sim.tick(farm), repeat)
+    # step() alone is the per-day cost once a farm is already vectorized
+    step = timed(lambda: sim.step(vectors), repeat)
+    print(f'{placements:>7} placements: tick {tick:9.1f} us   step {step:7.1f} us')
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 5000, 20000]
+    for size in sizes:
+        bench(size)
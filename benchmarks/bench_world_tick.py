@@ -0,0 +1,108 @@
+"""
+Time a world tick over many farms and check it against the per-farm simulation
+
+Builds a throwaway database of random farms, then:
+  * interrupts a tick part way through (one partition ticked by hand) and
+    lets world_tick.run() resume it
+  * checks every farm against Simulation.fast_forward() on the farm as it
+    was before the tick, so a farm ticked twice or not at all shows up, and
+    its running economy totals against FarmEconomy.compute() on the new day
+  * times full ticks with 1, 2 and 4 worker processes
+Run from the repository root:
+    python benchmarks/bench_world_tick.py [farms] [days]
+"""
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import world_tick
+from database import FarmDatabase, FarmRepository
+from farm_state import FarmStateCache
+from game_models import CATALOG, FarmEconomy
+from simulation import Simulation
+
+
+def build(path, farms, seed=0):
+    rng = random.Random(seed)
+    db = FarmDatabase(path, pooled=False)
+    crops = [c.key for c in CATALOG.crops]
+    buildings = [b.key for b in CATALOG.buildings]
+    animals = [a.key for a in CATALOG.animals]
+    conn = sqlite3.connect(path)
+    conn.execute('BEGIN')
+    for user_id in range(1, farms + 1):
+        conn.execute('INSERT INTO users (user_id, username) VALUES (?, ?)', (user_id, f'farm_{user_id}'))
+        day = rng.randint(1, 40)
+        conn.execute('INSERT INTO game_state (user_id, gold, food, water, day) VALUES (?, ?, ?, ?, ?)',
+                     (user_id, rng.randint(0, 5000), rng.randint(0, 500), rng.randint(0, 500), day))
+        cells = rng.sample(range(400), rng.randint(0, 60))
+        placements = [(cell % 20, cell // 20, *(('crop', rng.choice(crops)) if rng.random() < 0.8
+                                                else ('building', rng.choice(buildings))),
+                       rng.randint(0, 40)) for cell in cells]
+        conn.executemany('''
+            INSERT INTO grid_placements (user_id, grid_x, grid_y, object_type, object_name, planted_day)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(user_id, *placement) for placement in placements])
+        herd = {name: rng.randint(0, 5) for name in animals}
+        conn.executemany('INSERT INTO farm_animals (user_id, animal_type, count) VALUES (?, ?, ?)',
+                         [(user_id, name, count) for name, count in herd.items()])
+        FarmRepository(conn, user_id).save_economy(
+            FarmEconomy.compute([p[2:] for p in placements], herd, day))
+    conn.commit()
+    conn.close()
+    return db
+
+
+def expected_states(path, days):
+    farms = FarmStateCache(FarmDatabase(path, pooled=False))
+    sim = Simulation()
+    with sqlite3.connect(path) as conn:
+        user_ids = [row[0] for row in conn.execute('SELECT user_id FROM game_state')]
+    return {user_id: sim.fast_forward(farms.get(user_id), days)['game_state'] for user_id in user_ids}
+
+
+def check(path, expected):
+    db = FarmDatabase(path, pooled=False)
+    for user_id, state in expected.items():
+        actual = db.get_game_state(user_id)
+        for key in ('gold', 'food', 'water', 'wood', 'stone', 'seeds', 'day', 'season'):
+            assert actual[key] == state[key], f'farm {user_id}: {key} {actual[key]} != {state[key]}'
+        assert actual['version'] == 1, f'farm {user_id} ticked {actual["version"]} times'
+        placements = [(p['object_type'], p['object_name'], p['planted_day'])
+                      for p in db.get_grid_placements(user_id)]
+        economy = FarmEconomy.compute(placements, db.get_animals(user_id), actual['day'])
+        assert db.get_economy(user_id).as_row() == economy.as_row(), f'farm {user_id}: economy drifted'
+
+
+if __name__ == '__main__':
+    farms = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    workdir = tempfile.mkdtemp()
+    base = os.path.join(workdir, 'base.db')
+    build(base, farms)
+    expected = expected_states(base, days)
+
+    path = os.path.join(workdir, 'resume.db')
+    shutil.copy(base, path)
+    tick_id, _, _ = world_tick.plan(FarmDatabase(path, pooled=False), days, farms // 4 or 1)
+    world_tick.tick_partition(path, tick_id, 1, chunk_size=100)
+    print('-- resuming after one partition was ticked by hand')
+    world_tick.run([path], days, partition_size=farms // 4 or 1)
+    check(path, expected)
+    print(f'{farms} farms match Simulation.fast_forward after an interrupted tick\n')
+
+    for workers in (1, 2, 4):
+        path = os.path.join(workdir, f'workers{workers}.db')
+        shutil.copy(base, path)
+        print(f'-- {workers} worker(s)')
+        start = time.perf_counter()
+        world_tick.run([path], days, workers=workers, partition_size=max(farms // 8, 1))
+        elapsed = time.perf_counter() - start
+        check(path, expected)
+        print(f'{workers} worker(s): {farms / elapsed:.0f} farms/s end to end\n')
@@ -0,0 +1,90 @@
+"""
+Readers of cached farms while batch transactions change them
+
+One thread fills and clears the same rectangle of a farm in batch
+transactions while reader threads list its placements and deltas, as
+/api/grid, /api/state and /api/stream do. Every farm a reader gets from
+the cache must be one that was committed: the rectangle completely full
+or completely empty, and never a change from an attempt that rolled
+back. Run from the repository root:
+    python benchmarks/check_cache_reads.py [batches] [readers]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch import run_batch
+from database import FarmDatabase
+from farm_state import FarmStateCache
+
+
+WIDTH, HEIGHT = 8, 4
+
+
+class RolledBack(Exception):
+    pass
+
+
+def writer(farms, user_id, batches, done):
+    for i in range(batches):
+        with farms.transaction(user_id, 'batch') as session:
+            session.add_resources({'gold': 1000, 'seeds': 100})
+            run_batch(session, [{'op': 'fill', 'x0': 0, 'y0': 0, 'x1': WIDTH - 1, 'y1': HEIGHT - 1,
+                                 'object_type': 'crop', 'object_name': 'wheat'}])
+        # Half-applied and rolled-back changes must never be seen either
+        try:
+            with farms.transaction(user_id, 'batch') as session:
+                run_batch(session, [{'op': 'clear', 'x0': 0, 'y0': 0, 'x1': 1, 'y1': 1}])
+                raise RolledBack
+        except RolledBack:
+            pass
+        with farms.transaction(user_id, 'batch') as session:
+            run_batch(session, [{'op': 'clear', 'x0': 0, 'y0': 0, 'x1': WIDTH - 1, 'y1': HEIGHT - 1}])
+    done.set()
+
+
+def reader(farms, user_id, done, counts):
+    while not done.is_set():
+        farm = farms.get(user_id)
+        try:
+            placed = len(farm.placement_list())
+            farm.delta_since(max(farm.version - 10, 0))
+            farm.ready_crops()
+        except RuntimeError:
+            counts['errors'] += 1
+            continue
+        counts['reads'] += 1
+        if placed not in (0, WIDTH * HEIGHT):
+            counts['partial'] += 1
+
+
+if __name__ == '__main__':
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    db = FarmDatabase(os.path.join(tempfile.mkdtemp(), 'check.db'))
+    farms = FarmStateCache(db)
+    user_id = db.create_user('check')
+    with farms.transaction(user_id, 'update') as session:
+        session.update_game_state({**session.get_game_state(), 'land_size': 1000})
+
+    done = threading.Event()
+    counts = {'reads': 0, 'errors': 0, 'partial': 0}
+    threads = [threading.Thread(target=reader, args=(farms, user_id, done, counts))
+               for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    writer(farms, user_id, batches, done)
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    db.close()
+
+    print(f'{batches * 3} transactions in {elapsed:.2f}s, {counts["reads"]} reads, '
+          f'{counts["errors"]} iteration errors, {counts["partial"]} partial grids')
+    if counts['errors'] or counts['partial']:
+        sys.exit(1)
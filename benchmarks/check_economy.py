@@ -0,0 +1,107 @@
+"""
+Check the running economy totals against a full recompute
+
+Drives random place/remove/harvest/batch/advance requests through the app
+against a throwaway database and, after every request, compares both the
+cached and the persisted FarmEconomy with FarmEconomy.compute() over the
+farm's rows. Pass a database path to only check the farms already in it.
+Run from the repository root:
+    python benchmarks/check_economy.py [requests | path/to/farm_game.db]
+"""
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from database import FarmDatabase
+from game_models import CATALOG, ECONOMY_FIELDS, FarmEconomy
+
+
+def recompute(db, user_id):
+    placements = [(p['object_type'], p['object_name'], p['planted_day'])
+                  for p in db.get_grid_placements(user_id)]
+    return FarmEconomy.compute(placements, db.get_animals(user_id), db.get_game_state(user_id)['day'])
+
+
+def same(a, b):
+    return all(math.isclose(getattr(a, name), getattr(b, name), abs_tol=1e-6)
+               for name in ECONOMY_FIELDS)
+
+
+def check_database(path):
+    db = FarmDatabase(path, pooled=False)
+    with db.connection() as conn:
+        user_ids = [row[0] for row in conn.execute('SELECT user_id FROM game_state')]
+    bad = [user_id for user_id in user_ids
+           if not same(db.get_economy(user_id), recompute(db, user_id))]
+    print(f'{len(user_ids)} farms checked, {len(bad)} out of date: {bad[:20]}')
+    return not bad
+
+
+def random_request(client, rng):
+    x, y = rng.randrange(20), rng.randrange(20)
+    kind = rng.random()
+    if kind < 0.45:
+        object_type = rng.choice(['crop', 'animal', 'building'])
+        items = {'crop': CATALOG.crops, 'animal': CATALOG.animals,
+                 'building': CATALOG.buildings}[object_type]
+        client.post('/api/place_object', json={'grid_x': x, 'grid_y': y, 'object_type': object_type,
+                                               'object_name': rng.choice(items).key})
+    elif kind < 0.6:
+        client.post('/api/remove_object', json={'grid_x': x, 'grid_y': y})
+    elif kind < 0.7:
+        client.post('/api/harvest_crop', json={'grid_x': x, 'grid_y': y})
+    elif kind < 0.8:
+        client.post('/api/harvest_ready')
+    elif kind < 0.9:
+        client.post('/api/advance_day', json={'days': rng.randint(1, 5)})
+    else:
+        x1, y1 = rng.randrange(20), rng.randrange(20)
+        if rng.random() < 0.5:
+            op = {'op': 'clear'}
+        else:
+            op = {'op': 'fill', 'object_type': 'crop', 'object_name': rng.choice(CATALOG.crops).key}
+        op.update(x0=x, y0=y, x1=x1, y1=y1)
+        client.post('/api/batch', json={'operations': [op]})
+
+
+def check_requests(requests, seed=0):
+    rng = random.Random(seed)
+    os.chdir(tempfile.mkdtemp())  # app opens farm_game.db in the working directory
+    import app
+
+    client = app.app.test_client()
+    client.post('/api/advance_day')  # the first mutating request creates the farm
+    with client.session_transaction() as s:
+        user_id = s['user_id']
+
+    with app.farms.transaction(user_id) as repo:
+        state = repo.get_game_state()
+        state.update(gold=10 ** 7, wood=10 ** 6, stone=10 ** 6, seeds=10 ** 5, food=10 ** 5)
+        repo.update_game_state(state)
+
+    for i in range(requests):
+        random_request(client, rng)
+        expected = recompute(app.db, user_id)
+        assert same(app.db.get_economy(user_id), expected), f'persisted totals drifted at request {i}'
+        farm = app.farms.peek(user_id)
+        if farm is not None:
+            assert same(farm.economy, expected), f'cached totals drifted at request {i}'
+    print(f'{requests} random requests: running totals match a full recompute')
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        client.get('/api/calculate_economy')
+    print(f'calculate_economy: {(time.perf_counter() - start) * 1e3:.3f} us per call '
+          f'with {len(app.db.get_grid_placements(user_id))} placements')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+        sys.exit(0 if check_database(sys.argv[1]) else 1)
+    check_requests(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
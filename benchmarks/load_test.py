@@ -0,0 +1,426 @@
+"""
+Load test: many simulated players against the app, plus micro-benchmarks
+
+Each player is one session (its own cookie) that visits the home page,
+gets a farm of --farm-size crops (signed for the player, imported as a
+snapshot and loaded into the farm, as a returning player's save would be),
+then performs
+--actions weighted actions: place crops, animals and buildings, harvest
+ready crops, poll /api/get_state with its ETag and version, check the
+economy and advance days. --concurrency threads play --players sessions
+between them.
+
+By default the app runs in-process through Flask's test client on a fresh
+database in a temporary directory, honouring the usual FARM_DB_* settings;
+--url points the same sessions at a running server instead (start it on a
+fresh database, and the same FARM_SNAPSHOT_KEY in both environments).
+Micro-benchmarks time the GameEconomy helpers and every
+FarmDatabase method on a database of their own.
+
+Results are printed and, with --out, written as JSON; --baseline compares
+against an earlier JSON file and exits with status 1 if any latency or
+micro-benchmark got more than --tolerance percent slower. Run from the
+repository root:
+    python benchmarks/load_test.py [--players 1000] [--concurrency 32] [--out results.json]
+    python benchmarks/load_test.py --url http://localhost:5002 --baseline results.json
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshot
+from farm_grid import GRID_SIZE
+from game_models import CATALOG, NEW_FARM_STATE, GameEconomy, FarmEconomy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Signs the seed farms; also read by the in-process app, which must check them with the same key
+SNAPSHOT_KEY = os.environ.setdefault('FARM_SNAPSHOT_KEY', 'load-test-snapshot-key').encode('utf-8')
+
+# Relative weights of what a player does after loading their farm
+ACTIONS = {
+    'place_crop': 30,
+    'place_animal': 6,
+    'place_building': 4,
+    'harvest': 12,
+    'poll_state': 25,
+    'grid': 5,
+    'economy': 10,
+    'ready_crops': 5,
+    'advance_day': 3,
+}
+
+
+class InProcessClient:
+    """One player's session against the app through Flask's test client"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, data=None, headers=None):
+        response = self.client.open(path, method=method, json=body, data=data, headers=headers)
+        return response.status_code, response.get_json(silent=True), response.headers
+
+
+class HttpClient:
+    """One player's session against a running server, keeping its cookie"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, body=None, data=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req) as response:
+                status, payload, response_headers = response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            status, payload, response_headers = e.code, e.read(), e.headers
+        try:
+            parsed = json.loads(payload) if payload else None
+        except ValueError:
+            parsed = None
+        return status, parsed, response_headers
+
+
+class Recorder:
+    """Latencies and outcomes per endpoint, shared by every player thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # endpoint -> [seconds]
+        self.errors = {}  # endpoint -> server errors and exceptions
+        self.rejected = {}  # endpoint -> success: false answers (game rules said no)
+
+    def call(self, client, method, path, body=None, data=None, headers=None):
+        endpoint = f'{method} {path.split("?")[0]}'
+        start = time.perf_counter()
+        try:
+            status, payload, response_headers = client.request(method, path, body, data, headers)
+        except Exception:
+            status, payload, response_headers = 0, None, {}
+        elapsed = time.perf_counter() - start
+        error = status not in (200, 304)
+        rejected = not error and isinstance(payload, dict) and payload.get('success') is False
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if error:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            if rejected:
+                self.rejected[endpoint] = self.rejected.get(endpoint, 0) + 1
+        return status, payload, response_headers
+
+
+def seed_farm(size, seed=0):
+    """A snapshot of a farm with `size` crops at various stages, to sign for each player"""
+    rng = random.Random(seed)
+    level = 1
+    while (GRID_SIZE * level) ** 2 < size * 2:
+        level += 1
+    side = GRID_SIZE * level
+    day = 10
+    game_state = dict(NEW_FARM_STATE, gold=1_000_000, wood=100_000, stone=100_000, seeds=100_000,
+                      water=100_000, food=10_000, day=day, farm_level=level, land_size=side * side)
+    crops = [c.key for c in CATALOG.crops]
+    cells = rng.sample(range(side * side), size)
+    placements = [(cell % side, cell // side, 'crop', rng.choice(crops), rng.randint(1, day), 1, None)
+                  for cell in cells]
+    animals = {a.key: rng.randint(0, 5) for a in CATALOG.animals}
+    return snapshot.encode_state(game_state, placements, animals, 0)
+
+
+def play(client, recorder, seed_blob, actions, rng):
+    """One player's session"""
+    call = recorder.call
+    call(client, 'GET', '/')
+    if seed_blob is not None:
+        # Imports only take a farm's own exports: create the farm, read its id
+        # off an export and sign the seed for it
+        call(client, 'POST', '/api/advance_day', {'days': 1})
+        _, _, headers = call(client, 'GET', '/api/export')
+        owner = re.search(r'farm-(\d+)', headers.get('Content-Disposition', ''))
+        if owner:
+            call(client, 'POST', '/api/import?slot=0',
+                 data=snapshot.sign(seed_blob, SNAPSHOT_KEY, int(owner.group(1))),
+                 headers={'Content-Type': 'application/octet-stream'})
+            call(client, 'POST', '/api/load_game', {'slot': 0})
+
+    _, state, headers = call(client, 'GET', '/api/get_state')
+    version = state.get('version', 0) if state else 0
+    etag = headers.get('ETag')
+    level = state['game_state']['farm_level'] if state and state.get('full') else 1
+    side = GRID_SIZE * level
+    ready = []
+    crops = [c.key for c in CATALOG.crops]
+    animals = [a.key for a in CATALOG.animals]
+    buildings = [b.key for b in CATALOG.buildings]
+    names, weights = list(ACTIONS), list(ACTIONS.values())
+
+    for action in rng.choices(names, weights, k=actions):
+        x, y = rng.randrange(side), rng.randrange(side)
+        if action == 'place_crop':
+            call(client, 'POST', '/api/place_object',
+                 {'grid_x': x, 'grid_y': y, 'object_type': 'crop', 'object_name': rng.choice(crops)})
+        elif action == 'place_animal':
+            call(client, 'POST', '/api/place_object',
+                 {'grid_x': x, 'grid_y': y, 'object_type': 'animal', 'object_name': rng.choice(animals)})
+        elif action == 'place_building':
+            call(client, 'POST', '/api/place_object',
+                 {'grid_x': x, 'grid_y': y, 'object_type': 'building', 'object_name': rng.choice(buildings)})
+        elif action == 'harvest':
+            if ready:
+                crop = ready.pop(rng.randrange(len(ready)))
+                x, y = crop['grid_x'], crop['grid_y']
+            call(client, 'POST', '/api/harvest_crop', {'grid_x': x, 'grid_y': y})
+        elif action == 'poll_state':
+            status, state, headers = call(client, 'GET', f'/api/get_state?since={version}',
+                                          headers={'If-None-Match': etag} if etag else None)
+            if status == 200 and state:
+                version = state.get('version', version)
+                etag = headers.get('ETag', etag)
+        elif action == 'grid':
+            x0, y0 = rng.randrange(0, side, 16), rng.randrange(0, side, 16)
+            call(client, 'GET', f'/api/grid?x0={x0}&y0={y0}&x1={x0 + 15}&y1={y0 + 15}')
+        elif action == 'economy':
+            call(client, 'GET', '/api/calculate_economy')
+        elif action == 'ready_crops':
+            _, payload, _ = call(client, 'GET', '/api/ready_crops')
+            if payload and payload.get('success'):
+                ready = payload['crops']
+        elif action == 'advance_day':
+            call(client, 'POST', '/api/advance_day', {'days': 1})
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def run_load(args):
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+        shutdown = lambda: None
+    else:
+        # The app opens farm_game.db in the working directory at import
+        os.chdir(tempfile.mkdtemp())
+        import app as farm_app
+        make_client = lambda: InProcessClient(farm_app.app)
+        shutdown = lambda: farm_app.db.journal and farm_app.db.journal.close()
+
+    seed_blob = seed_farm(args.farm_size) if args.farm_size else None
+    recorder = Recorder()
+
+    def session(index):
+        play(make_client(), recorder, seed_blob, args.actions, random.Random(args.seed + index))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(session, range(args.players)))
+    elapsed = time.perf_counter() - start
+    shutdown()
+
+    endpoints = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        ordered = sorted(latencies)
+        endpoints[endpoint] = {
+            'count': len(ordered),
+            'errors': recorder.errors.get(endpoint, 0),
+            'rejected': recorder.rejected.get(endpoint, 0),
+            'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p50_ms': percentile(ordered, 0.50) * 1000,
+            'p95_ms': percentile(ordered, 0.95) * 1000,
+            'p99_ms': percentile(ordered, 0.99) * 1000,
+            'max_ms': ordered[-1] * 1000,
+        }
+    requests = sum(e['count'] for e in endpoints.values())
+    return {
+        'duration_s': elapsed,
+        'players': args.players,
+        'requests': requests,
+        'requests_per_s': requests / elapsed,
+        'errors': sum(e['errors'] for e in endpoints.values()),
+        'endpoints': endpoints,
+    }
+
+
+def best_of(fn, calls, repeat=3):
+    """Microseconds per call of fn(i), best of `repeat` runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(calls):
+            fn(i)
+        per_call = (time.perf_counter() - start) / calls * 1e6
+        best = per_call if best is None else min(best, per_call)
+    return best
+
+
+def run_micro(args):
+    calls = args.micro_calls
+    rng = random.Random(args.seed)
+    crops = [c.key for c in CATALOG.crops]
+    placement_dicts = [{'object_type': 'crop', 'object_name': rng.choice(crops)}
+                       for _ in range(args.farm_size or 100)]
+    triples = [(p['object_type'], p['object_name'], 1) for p in placement_dicts]
+    animals = {a.key: rng.randint(0, 20) for a in CATALOG.animals}
+    resources = dict(NEW_FARM_STATE)
+    cost = {'gold': 10, 'seeds': 1}
+
+    results = {
+        'GameEconomy.calculate_daily_revenue': best_of(
+            lambda i: GameEconomy.calculate_daily_revenue([], animals, []), calls),
+        'GameEconomy.calculate_daily_expenses': best_of(
+            lambda i: GameEconomy.calculate_daily_expenses(animals), calls),
+        'GameEconomy.can_afford': best_of(lambda i: GameEconomy.can_afford(resources, cost), calls),
+        'GameEconomy.deduct_cost': best_of(lambda i: GameEconomy.deduct_cost(dict(resources), cost), calls),
+        'GameEconomy.get_season': best_of(lambda i: GameEconomy.get_season(i), calls),
+        'GameEconomy.get_object': best_of(lambda i: GameEconomy.get_object('crop', 'wheat'), calls),
+        'GameEconomy.calculate_land_usage': best_of(
+            lambda i: GameEconomy.calculate_land_usage(placement_dicts), max(1, calls // 10)),
+        'FarmEconomy.compute': best_of(
+            lambda i: FarmEconomy.compute(triples, animals, 1), max(1, calls // 10)),
+    }
+
+    from database import FarmDatabase
+    from farm_state import FarmStateCache
+    db = FarmDatabase(os.path.join(tempfile.mkdtemp(), 'micro.db'))
+    user_id = db.create_user('micro')
+    with FarmStateCache(db).transaction(user_id) as repo:
+        repo.update_game_state({**repo.get_game_state(), 'gold': 10 ** 9})
+        repo.save_grid_placements([(i % 100, 50 + i // 100, 'crop', 'wheat', 1, 1, None)
+                                   for i in range(args.farm_size or 100)])
+    db_calls = max(1, calls // 10)
+    results.update({
+        'FarmDatabase.create_user': best_of(lambda i: db.create_user(), db_calls, repeat=1),
+        'FarmDatabase.get_user_id': best_of(lambda i: db.get_user_id('micro'), db_calls),
+        'FarmDatabase.get_game_state': best_of(lambda i: db.get_game_state(user_id), db_calls),
+        'FarmDatabase.get_grid_placements': best_of(lambda i: db.get_grid_placements(user_id), db_calls),
+        'FarmDatabase.get_animals': best_of(lambda i: db.get_animals(user_id), db_calls),
+        'FarmDatabase.get_economy': best_of(lambda i: db.get_economy(user_id), db_calls),
+    })
+    db.close()
+    return {name: {'us': us} for name, us in results.items()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    load = results.get('load')
+    if load:
+        print(f'{load["players"]} players, {load["requests"]} requests in {load["duration_s"]:.1f}s: '
+              f'{load["requests_per_s"]:.0f} req/s, {load["errors"]} errors')
+        print(f'{"endpoint":<28} {"count":>7} {"rejected":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        for endpoint, e in load['endpoints'].items():
+            print(f'{endpoint:<28} {e["count"]:>7} {e["rejected"]:>8} '
+                  f'{e["p50_ms"]:>8.2f} {e["p95_ms"]:>8.2f} {e["p99_ms"]:>8.2f}')
+    if results.get('micro'):
+        print(f'\n{"micro-benchmark":<40} {"us/call":>9}')
+        for name, m in results['micro'].items():
+            print(f'{name:<40} {m["us"]:>9.2f}')
+
+
+def compare(results, baseline, tolerance):
+    """Print changes against a baseline; returns the names that regressed beyond tolerance"""
+    before, after = baseline.get('meta', {}), results['meta']
+    for key in ('target', 'cpus'):
+        if before.get(key) != after.get(key):
+            print(f'\nwarning: baseline {key} was {before.get(key)!r}, this run {after.get(key)!r}')
+    for key in ('players', 'concurrency', 'actions', 'farm_size'):
+        if before.get('options', {}).get(key) != after['options'][key]:
+            print(f'\nwarning: baseline --{key.replace("_", "-")} was '
+                  f'{before.get("options", {}).get(key)!r}, this run {after["options"][key]!r}')
+
+    pairs = []
+    if 'load' in results and 'load' in baseline:
+        pairs.append(('throughput req/s', baseline['load']['requests_per_s'],
+                      results['load']['requests_per_s'], False))
+        for endpoint, e in results['load']['endpoints'].items():
+            old = baseline['load']['endpoints'].get(endpoint)
+            if old:
+                for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                    pairs.append((f'{endpoint} {key}', old[key], e[key], True))
+    for name, m in results.get('micro', {}).items():
+        old = baseline.get('micro', {}).get(name)
+        if old:
+            pairs.append((f'{name} us', old['us'], m['us'], True))
+
+    print(f'\n{"against baseline":<44} {"before":>10} {"after":>10} {"change":>8}')
+    regressed = []
+    for name, before, after, lower_is_better in pairs:
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        if worse:
+            regressed.append(name)
+        print(f'{name:<44} {before:>10.2f} {after:>10.2f} {change:>+7.1f}%{"  !" if worse else ""}')
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate concurrent players and time the app')
+    parser.add_argument('--players', type=int, default=1000, help='player sessions to run')
+    parser.add_argument('--concurrency', type=int, default=32, help='sessions in flight at once')
+    parser.add_argument('--actions', type=int, default=20, help='actions per player after loading')
+    parser.add_argument('--farm-size', type=int, default=100, help='crops on each player\'s farm')
+    parser.add_argument('--url', help='run against a server at this URL instead of in-process')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--micro-calls', type=int, default=10000, help='calls per micro-benchmark')
+    parser.add_argument('--skip-load', action='store_true')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=20.0,
+                        help='percent slowdown against the baseline that counts as a regression')
+    args = parser.parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    results = {'meta': {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'target': args.url or 'in-process',
+        'options': vars(args),
+        'env': {key: value for key, value in os.environ.items() if key.startswith('FARM_')},
+    }}
+    if not args.skip_micro:
+        results['micro'] = run_micro(args)
+    if not args.skip_load:
+        results['load'] = run_load(args)
+    report(results)
+
+    if out:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nWrote {out}')
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            print(f'{len(regressed)} regressed by more than {args.tolerance:g}%')
+            sys.exit(1)
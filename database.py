@@ -1,120 +1,641 @@
+import queue
 import sqlite3
 import json
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+from farm_grid import footprint_for
+from game_models import ECONOMY_FIELDS, RESOURCES, AnimalType, BuildingType, CropType, FarmEconomy
+import metrics
+from journal import WriteBehindJournal
+from snapshot import encode_state
+
+
+# Name given to users created without one; the dash keeps these apart from
+# the player_NNNN names handed out before ids were used
+PLAYER_NAME = 'player-{}'
+
+# Pragmas applied to every pooled connection. WAL lets readers proceed while a
+# writer holds the lock, and NORMAL sync is durable across crashes in WAL mode.
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,  # negative means KiB, so ~16MB of page cache
+    'mmap_size': 268435456,  # 256MB
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # ms to wait on a locked database
+}
+
+
+def _migrate_unique_indexes(cursor):
+    """Collapse duplicate rows and add unique lookup indexes"""
+    # Keep the most recently written row for each cell / animal type
+    cursor.execute('''
+        DELETE FROM grid_placements WHERE placement_id NOT IN (
+            SELECT MAX(placement_id) FROM grid_placements
+            GROUP BY user_id, grid_x, grid_y
+        )
+    ''')
+    cursor.execute('''
+        DELETE FROM farm_animals WHERE animal_id NOT IN (
+            SELECT MAX(animal_id) FROM farm_animals
+            GROUP BY user_id, animal_type
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_grid_placements_cell
+        ON grid_placements (user_id, grid_x, grid_y)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_farm_animals_type
+        ON farm_animals (user_id, animal_type)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_game_state_user
+        ON game_state (user_id)
+    ''')
+
+
+def _migrate_state_version(cursor):
+    """Give every farm a version number that each mutating transaction bumps"""
+    cursor.execute('ALTER TABLE game_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+
+def _migrate_placement_columns(cursor):
+    """Move land_required/planted_day out of the JSON data column into typed columns"""
+    cursor.execute('ALTER TABLE grid_placements ADD COLUMN land_required INTEGER NOT NULL DEFAULT 1')
+    cursor.execute('ALTER TABLE grid_placements ADD COLUMN width INTEGER NOT NULL DEFAULT 1')
+    cursor.execute('ALTER TABLE grid_placements ADD COLUMN height INTEGER NOT NULL DEFAULT 1')
+
+    # Rows without JSON take their size from the catalog
+    catalog = (('crop', CropType.get_all_crops()), ('animal', AnimalType.get_all_animals()),
+               ('building', BuildingType.get_all_buildings()))
+    cursor.executemany('''
+        UPDATE grid_placements SET land_required = ? WHERE object_type = ? AND object_name = ?
+    ''', [(item['land_required'], object_type, name)
+          for object_type, items in catalog for name, item in items.items()])
+
+    # Back-fill from the JSON written by place_object, then drop the promoted keys
+    cursor.execute('''
+        UPDATE grid_placements
+        SET planted_day = COALESCE(json_extract(data, '$.planted_day'), planted_day),
+            land_required = COALESCE(json_extract(data, '$.land_required'), land_required),
+            growth_stage = COALESCE(json_extract(data, '$.growth_stage'), growth_stage)
+        WHERE json_valid(data)
+    ''')
+    cursor.execute('''
+        UPDATE grid_placements
+        SET data = NULLIF(json_remove(data, '$.planted_day', '$.land_required', '$.growth_stage'), '{}')
+        WHERE json_valid(data)
+    ''')
+
+    cursor.execute('SELECT DISTINCT land_required FROM grid_placements')
+    for (land_required,) in cursor.fetchall():
+        width, height = footprint_for(land_required)
+        cursor.execute('''
+            UPDATE grid_placements SET width = ?, height = ? WHERE land_required = ?
+        ''', (width, height, land_required))
+
+
+def _migrate_economy_totals(cursor):
+    """Keep each farm's running economy totals on its game_state row"""
+    # The columns as this step adds them, whatever ECONOMY_FIELDS grows into later
+    columns = ('animal_revenue', 'animal_upkeep', 'food_per_day', 'water_supply',
+               'crop_water', 'crop_bonus', 'production_speed')
+    for name in columns:
+        if name in ('crop_bonus', 'production_speed'):
+            cursor.execute(f'ALTER TABLE game_state ADD COLUMN {name} REAL NOT NULL DEFAULT 1.0')
+        else:
+            cursor.execute(f'ALTER TABLE game_state ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0')
+
+    # The totals as this step defined them, kept apart from FarmEconomy as it changes
+    # (every crop drew water until _migrate_growing_crop_water)
+    crops = CropType.get_all_crops()
+    animal_types = AnimalType.get_all_animals()
+    buildings = BuildingType.get_all_buildings()
+    cursor.execute('SELECT user_id FROM game_state')
+    for (user_id,) in cursor.fetchall():
+        totals = dict.fromkeys(columns, 0)
+        totals['crop_bonus'] = totals['production_speed'] = 1.0
+        cursor.execute('''
+            SELECT object_type, object_name FROM grid_placements WHERE user_id = ?
+        ''', (user_id,))
+        for object_type, object_name in cursor.fetchall():
+            if object_type == 'crop' and object_name in crops:
+                totals['crop_water'] += crops[object_name]['water_per_day']
+            elif object_type == 'building' and object_name in buildings:
+                building = buildings[object_name]
+                totals['water_supply'] += building['provides'].get('water', 0)
+                totals['crop_bonus'] = round(
+                    totals['crop_bonus'] * building['bonus'].get('crop_revenue', 1.0), 9)
+                totals['production_speed'] = round(
+                    totals['production_speed'] * building['bonus'].get('production_speed', 1.0), 9)
+        cursor.execute('''
+            SELECT animal_type, count FROM farm_animals WHERE user_id = ?
+        ''', (user_id,))
+        for animal_type, count in cursor.fetchall():
+            animal = animal_types.get(animal_type)
+            if animal:
+                totals['animal_revenue'] += animal['production_value'] * count
+                totals['animal_upkeep'] += animal['upkeep'] * count
+                totals['food_per_day'] += animal['food_per_day'] * count
+        cursor.execute(f'''
+            UPDATE game_state SET {', '.join(f'{name} = ?' for name in columns)} WHERE user_id = ?
+        ''', (*(totals[name] for name in columns), user_id))
+
+
+def _migrate_world_ticks(cursor):
+    """Track world tick runs and how far each partition got, so a run can resume"""
+    cursor.execute('''
+        CREATE TABLE world_ticks (
+            tick_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            days INTEGER NOT NULL,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE world_tick_partitions (
+            tick_id INTEGER NOT NULL,
+            partition INTEGER NOT NULL,
+            first_user_id INTEGER NOT NULL,
+            last_user_id INTEGER NOT NULL,
+            next_user_id INTEGER NOT NULL,
+            farms INTEGER NOT NULL DEFAULT 0,
+            seconds REAL NOT NULL DEFAULT 0,
+            finished_at TIMESTAMP,
+            PRIMARY KEY (tick_id, partition),
+            FOREIGN KEY (tick_id) REFERENCES world_ticks (tick_id)
+        )
+    ''')
+
+
+def _migrate_save_slots(cursor):
+    """Add a table of saved farm snapshots (see snapshot.py), a few per user"""
+    cursor.execute('''
+        CREATE TABLE save_slots (
+            user_id INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            farm_version INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            saved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            snapshot BLOB NOT NULL,
+            PRIMARY KEY (user_id, slot),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+
+def _migrate_event_log(cursor):
+    """Add the append-only farm event log and per-farm snapshots (see event_log.py)
+
+    Every existing farm gets a snapshot at its current version, so its
+    history starts from there.
+    """
+    cursor.execute('''
+        CREATE TABLE farm_events (
+            user_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            action INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            payload BLOB NOT NULL,
+            PRIMARY KEY (user_id, version)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE farm_snapshots (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            snapshot BLOB NOT NULL
+        )
+    ''')
+
+    # Read the rows with this step's own SQL, so later schema changes can't break it
+    keys = ('gold', 'wood', 'stone', 'food', 'seeds', 'water',
+            'day', 'season', 'farm_level', 'land_size', 'version')
+    cursor.execute(f'SELECT user_id, {", ".join(keys)} FROM game_state')
+    for user_id, *values in cursor.fetchall():
+        state = dict(zip(keys, values))
+        cursor.execute('''
+            SELECT grid_x, grid_y, object_type, object_name, planted_day, land_required, data
+            FROM grid_placements WHERE user_id = ?
+        ''', (user_id,))
+        placements = [(*row[:6], json.loads(row[6]) if row[6] else None) for row in cursor.fetchall()]
+        cursor.execute('SELECT animal_type, count FROM farm_animals WHERE user_id = ?', (user_id,))
+        animals = dict(cursor.fetchall())
+        cursor.execute('INSERT INTO farm_snapshots (user_id, version, snapshot) VALUES (?, ?, ?)',
+                       (user_id, state['version'],
+                        encode_state(state, placements, animals, state['version'])))
+
+
+def _migrate_growing_crop_water(cursor):
+    """Recount crop_water from the crops still growing; ripe crops draw no water"""
+    crops = CropType.get_all_crops()
+    cursor.execute('SELECT user_id, day FROM game_state')
+    days = dict(cursor.fetchall())
+    water = dict.fromkeys(days, 0)
+    cursor.execute('''
+        SELECT user_id, object_name, planted_day FROM grid_placements WHERE object_type = 'crop'
+    ''')
+    for user_id, object_name, planted_day in cursor.fetchall():
+        crop = crops.get(object_name)
+        if crop and user_id in days and planted_day + crop['growth_time'] > days[user_id]:
+            water[user_id] += crop['water_per_day']
+    cursor.executemany('UPDATE game_state SET crop_water = ? WHERE user_id = ?',
+                       [(amount, user_id) for user_id, amount in water.items()])
+
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Only ever append to this list; the position of a step is its version.
+MIGRATIONS = [
+    _migrate_unique_indexes,
+    _migrate_state_version,
+    _migrate_placement_columns,
+    _migrate_economy_totals,
+    _migrate_world_ticks,
+    _migrate_save_slots,
+    _migrate_event_log,
+    _migrate_growing_crop_water,
+]
+
+
+class ConnectionPool:
+    """Pool of reusable SQLite connections shared between request threads"""
+
+    def __init__(self, db_name, max_size=8, pragmas=None, max_age=300,
+                 max_uses=10000, health_check_interval=30):
+        self.db_name = db_name
+        self.max_size = max_size
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        self.max_age = max_age  # seconds before a connection is recycled
+        self.max_uses = max_uses  # checkouts before a connection is recycled
+        self.health_check_interval = health_check_interval  # idle seconds before a ping
+        self._idle = queue.LifoQueue()
+        self._meta = {}  # id(conn) -> [opened_at, last_used, uses]
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.recycled = 0
+
+    def _open(self):
+        """Open a new connection with the pool pragmas applied"""
+        # isolation_level=None leaves transaction control to unit_of_work()
+        conn = sqlite3.connect(self.db_name, check_same_thread=False,
+                               isolation_level=None)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        metrics.connection_opened(conn)
+        now = time.monotonic()
+        with self._lock:
+            self._meta[id(conn)] = [now, now, 0]
+            self.opened += 1
+        return conn
+
+    def _discard(self, conn):
+        """Close a connection and forget about it"""
+        with self._lock:
+            self._meta.pop(id(conn), None)
+            self.recycled += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _is_expired(self, conn):
+        opened_at, _, uses = self._meta.get(id(conn), (0, 0, 0))
+        return (time.monotonic() - opened_at > self.max_age
+                or uses >= self.max_uses)
+
+    def _is_healthy(self, conn):
+        """Ping connections that have been idle for a while"""
+        _, last_used, _ = self._meta.get(id(conn), (0, 0, 0))
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """Check out a healthy connection, opening one if none are idle"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open()
+                break
+            if self._is_expired(conn) or not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+            break
+
+        with self._lock:
+            meta = self._meta[id(conn)]
+            meta[1] = time.monotonic()
+            meta[2] += 1
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        if self._is_expired(conn) or self._idle.qsize() >= self.max_size:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
 class FarmDatabase:
-    def __init__(self, db_name='farm_game.db'):
+    def __init__(self, db_name='farm_game.db', pooled=True, pool_size=8,
+                 shard_id=0, shard_bits=0, pragmas=None):
         self.db_name = db_name
+        # As one shard of a ShardedFarmDatabase, user ids are (local_id << shard_bits) | shard_id
+        self.shard_id = shard_id
+        self.shard_bits = shard_bits
+        # pooled=False keeps the original open-per-call behaviour for benchmarking
+        self.pool = ConnectionPool(db_name, max_size=pool_size, pragmas=pragmas) if pooled else None
+        self.journal = None  # WriteBehindJournal, when write-behind is enabled
         self.init_database()
 
     def get_connection(self):
         """Create a database connection"""
-        return sqlite3.connect(self.db_name)
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        metrics.connection_opened(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a block"""
+        conn = self.get_connection() if self.pool is None else self.pool.acquire()
+        changes = conn.total_changes
+        try:
+            yield conn
+        finally:
+            metrics.connection_released(conn.total_changes - changes)
+            if self.pool is None:
+                conn.close()
+            else:
+                self.pool.release(conn)
+
+    def close(self):
+        """Close any pooled connections"""
+        if self.pool is not None:
+            self.pool.close_all()
 
     def init_database(self):
         """Initialize the database with required tables"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
 
-        # User profiles table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Game state table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS game_state (
-                state_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                gold INTEGER DEFAULT 100,
-                wood INTEGER DEFAULT 50,
-                stone INTEGER DEFAULT 25,
-                food INTEGER DEFAULT 0,
-                seeds INTEGER DEFAULT 10,
-                water INTEGER DEFAULT 100,
-                day INTEGER DEFAULT 1,
-                season TEXT DEFAULT 'Spring',
-                farm_level INTEGER DEFAULT 1,
-                land_size INTEGER DEFAULT 100,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-
-        # Grid placements table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS grid_placements (
-                placement_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                grid_x INTEGER NOT NULL,
-                grid_y INTEGER NOT NULL,
-                object_type TEXT NOT NULL,
-                object_name TEXT NOT NULL,
-                growth_stage INTEGER DEFAULT 0,
-                planted_day INTEGER DEFAULT 0,
-                data TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-
-        # Animals table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS farm_animals (
-                animal_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                animal_type TEXT NOT NULL,
-                count INTEGER DEFAULT 0,
-                total_production INTEGER DEFAULT 0,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
-
-    def create_user(self, username):
-        """Create a new user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('INSERT INTO users (username) VALUES (?)', (username,))
-            user_id = cursor.lastrowid
+            # User profiles table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
 
-            # Initialize game state for new user
+            # Game state table
             cursor.execute('''
-                INSERT INTO game_state (user_id) VALUES (?)
-            ''', (user_id,))
+                CREATE TABLE IF NOT EXISTS game_state (
+                    state_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    gold INTEGER DEFAULT 100,
+                    wood INTEGER DEFAULT 50,
+                    stone INTEGER DEFAULT 25,
+                    food INTEGER DEFAULT 0,
+                    seeds INTEGER DEFAULT 10,
+                    water INTEGER DEFAULT 100,
+                    day INTEGER DEFAULT 1,
+                    season TEXT DEFAULT 'Spring',
+                    farm_level INTEGER DEFAULT 1,
+                    land_size INTEGER DEFAULT 100,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+
+            # Grid placements table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS grid_placements (
+                    placement_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    grid_x INTEGER NOT NULL,
+                    grid_y INTEGER NOT NULL,
+                    object_type TEXT NOT NULL,
+                    object_name TEXT NOT NULL,
+                    growth_stage INTEGER DEFAULT 0,
+                    planted_day INTEGER DEFAULT 0,
+                    data TEXT,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+
+            # Animals table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS farm_animals (
+                    animal_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    animal_type TEXT NOT NULL,
+                    count INTEGER DEFAULT 0,
+                    total_production INTEGER DEFAULT 0,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
 
             conn.commit()
-            return user_id
-        except sqlite3.IntegrityError:
-            return None
-        finally:
-            conn.close()
+
+            self.migrate(conn)
+
+    def migrate(self, conn):
+        """Apply any schema migrations newer than the database's user_version"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                migration(conn.cursor())
+                # user_version is transactional, so a failed step is retried next start
+                conn.execute(f'PRAGMA user_version = {target}')
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def create_user(self, username=None):
+        """Create a new user
+
+        Without a username the user is named after its new id, which needs
+        no uniqueness check or retry.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                if self.shard_bits or username is None:
+                    # The write lock makes MAX(user_id) + 1 safe to claim
+                    cursor.execute('SELECT COALESCE(MAX(user_id), 0) FROM users')
+                    local_id = (cursor.fetchone()[0] >> self.shard_bits) + 1
+                    user_id = (local_id << self.shard_bits) | self.shard_id
+                    if username is None:
+                        username = PLAYER_NAME.format(user_id)
+                    cursor.execute('INSERT INTO users (user_id, username) VALUES (?, ?)',
+                                   (user_id, username))
+                else:
+                    cursor.execute('INSERT INTO users (username) VALUES (?)', (username,))
+                    user_id = cursor.lastrowid
+
+                # Initialize game state for new user
+                cursor.execute('''
+                    INSERT INTO game_state (user_id) VALUES (?)
+                ''', (user_id,))
+
+                conn.commit()
+                return user_id
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return None
 
     def get_user_id(self, username):
         """Get user ID by username"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM users WHERE username = ?', (username,))
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id FROM users WHERE username = ?', (username,))
+            result = cursor.fetchone()
         return result[0] if result else None
 
+    @contextmanager
+    def unit_of_work(self, user_id):
+        """Yield a FarmRepository whose reads and writes share one transaction
+
+        BEGIN IMMEDIATE takes the write lock up front, so two requests for
+        the same farm cannot interleave between reading and writing state.
+        Everything is committed (one fsync) when the block exits normally
+        and rolled back if it raises.
+        """
+        self.settle(user_id)
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield FarmRepository(conn, user_id)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    @contextmanager
+    def read(self, user_id):
+        """Yield a FarmRepository for several reads from one consistent snapshot"""
+        self.settle(user_id)
+        with self.connection() as conn:
+            conn.execute('BEGIN')
+            try:
+                yield FarmRepository(conn, user_id)
+            finally:
+                conn.rollback()
+
+    def enable_write_behind(self, **options):
+        """Send farm writes through a WriteBehindJournal (see journal.py)"""
+        self.journal = WriteBehindJournal(self, **options)
+
+    def settle(self, user_id):
+        """Commit any journaled writes for user_id before touching its rows"""
+        if self.journal is not None:
+            self.journal.settle(user_id)
+
+    def write_batch(self, conn, states, versions, economies, saved, removed, animals,
+                    events=None, snapshots=None):
+        """Apply coalesced journal entries, keyed by user_id, inside the caller's transaction
+
+        versions maps user_id to (expected, version). A farm no longer at
+        its expected version is skipped; returns the ids of those farms.
+        """
+        events = events or {}
+        snapshots = snapshots or {}
+        conflicted = []
+        for user_id in (set(states) | set(versions) | set(economies) | set(saved) | set(removed)
+                        | set(animals) | set(events) | set(snapshots)):
+            repo = FarmRepository(conn, user_id)
+            if user_id in versions:
+                expected, version = versions[user_id]
+                if not repo.set_version(version, expected=expected):
+                    conflicted.append(user_id)
+                    continue
+            for version, action, payload in sorted(events.get(user_id, ())):
+                repo.append_event(version, action, payload)
+            if user_id in snapshots:
+                repo.save_farm_snapshot(*snapshots[user_id])
+            if user_id in removed:
+                repo.remove_grid_placements(removed[user_id])
+            if user_id in saved:
+                repo.save_grid_placements(saved[user_id])
+            for animal_type, count in animals.get(user_id, ()):
+                repo.update_animals(animal_type, count)
+            if user_id in states:
+                repo.update_game_state(states[user_id])
+            if user_id in economies:
+                repo.save_economy(FarmEconomy(*economies[user_id]))
+        return conflicted
+
+    # Read-only helpers. Farms are only written through FarmStateCache.transaction(),
+    # which bumps the version and appends an event for every change
     def get_game_state(self, user_id):
         """Get the current game state for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.read(user_id) as repo:
+            return repo.get_game_state()
+
+    def get_grid_placements(self, user_id):
+        """Get all grid placements for a user"""
+        with self.read(user_id) as repo:
+            return repo.get_grid_placements()
+
+    def get_animals(self, user_id):
+        """Get all animals for a user"""
+        with self.read(user_id) as repo:
+            return repo.get_animals()
+
+    def get_economy(self, user_id):
+        """Get the running economy totals for a user"""
+        with self.read(user_id) as repo:
+            return repo.get_economy()
+
+
+class FarmRepository:
+    """Reads and writes one farm's rows on a single connection
+
+    Obtained from FarmDatabase.unit_of_work(), which wraps every call made
+    through the repository in one transaction.
+    """
+
+    def __init__(self, conn, user_id):
+        self.conn = conn
+        self.user_id = user_id
+
+    def get_game_state(self):
+        """Get the current game state for the farm"""
+        cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT gold, wood, stone, food, seeds, water, day, season, farm_level, land_size
+            SELECT gold, wood, stone, food, seeds, water, day, season, farm_level, land_size, version
             FROM game_state WHERE user_id = ?
-        ''', (user_id,))
+        ''', (self.user_id,))
         result = cursor.fetchone()
-        conn.close()
 
         if result:
             return {
@@ -127,15 +648,14 @@ class FarmDatabase:
                 'day': result[6],
                 'season': result[7],
                 'farm_level': result[8],
-                'land_size': result[9]
+                'land_size': result[9],
+                'version': result[10]
             }
         return None
 
-    def update_game_state(self, user_id, resources):
+    def update_game_state(self, resources):
         """Update game state resources"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+        self.conn.execute('''
             UPDATE game_state
             SET gold = ?, wood = ?, stone = ?, food = ?, seeds = ?, water = ?,
                 day = ?, season = ?, farm_level = ?, land_size = ?, updated_at = ?
@@ -152,109 +672,246 @@ class FarmDatabase:
             resources.get('farm_level', 1),
             resources.get('land_size', 100),
             datetime.now(),
-            user_id
+            self.user_id
         ))
-        conn.commit()
-        conn.close()
 
-    def save_grid_placement(self, user_id, grid_x, grid_y, object_type, object_name, data=None):
-        """Save an object placement on the grid"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_economy(self):
+        """Get the farm's running economy totals as a FarmEconomy"""
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT {', '.join(ECONOMY_FIELDS)} FROM game_state WHERE user_id = ?
+        ''', (self.user_id,))
+        result = cursor.fetchone()
+        return FarmEconomy(*result) if result else None
 
-        # First check if there's already something at this position
-        cursor.execute('''
-            SELECT placement_id FROM grid_placements
-            WHERE user_id = ? AND grid_x = ? AND grid_y = ?
-        ''', (user_id, grid_x, grid_y))
+    def save_economy(self, economy):
+        """Store the farm's running economy totals"""
+        self.conn.execute(f'''
+            UPDATE game_state SET {', '.join(f'{name} = ?' for name in ECONOMY_FIELDS)}
+            WHERE user_id = ?
+        ''', (*economy.as_row(), self.user_id))
 
-        if cursor.fetchone():
-            # Update existing placement
-            cursor.execute('''
-                UPDATE grid_placements
-                SET object_type = ?, object_name = ?, data = ?
-                WHERE user_id = ? AND grid_x = ? AND grid_y = ?
-            ''', (object_type, object_name, json.dumps(data) if data else None, user_id, grid_x, grid_y))
+    def add_resources(self, deltas):
+        """Add signed amounts to resources in place (gold = gold + ?), so the
+        update never rewrites a balance read earlier in the request"""
+        names = [name for name in RESOURCES if deltas.get(name)]
+        if not names:
+            return
+        self.conn.execute(f'''
+            UPDATE game_state SET {', '.join(f'{name} = {name} + ?' for name in names)}, updated_at = ?
+            WHERE user_id = ?
+        ''', (*(deltas[name] for name in names), datetime.now(), self.user_id))
+
+    def bump_version(self, expected=None):
+        """Mark the farm as changed by this transaction
+
+        With `expected`, only if the farm is still at that version (compare
+        and swap); returns False if someone else changed it in the meantime.
+        """
+        if expected is None:
+            cursor = self.conn.execute('''
+                UPDATE game_state SET version = version + 1 WHERE user_id = ?
+            ''', (self.user_id,))
         else:
-            # Insert new placement
-            cursor.execute('''
-                INSERT INTO grid_placements (user_id, grid_x, grid_y, object_type, object_name, data)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, grid_x, grid_y, object_type, object_name, json.dumps(data) if data else None))
+            cursor = self.conn.execute('''
+                UPDATE game_state SET version = version + 1 WHERE user_id = ? AND version = ?
+            ''', (self.user_id, expected))
+        return cursor.rowcount == 1
 
-        conn.commit()
-        conn.close()
+    def set_version(self, version, expected=None):
+        """Store a version number counted elsewhere (by the write-behind journal)
 
-    def get_grid_placements(self, user_id):
-        """Get all grid placements for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        With `expected`, only if the farm is still at that version; returns
+        False if someone else changed it in the meantime.
+        """
+        if expected is None:
+            cursor = self.conn.execute('''
+                UPDATE game_state SET version = ? WHERE user_id = ?
+            ''', (version, self.user_id))
+        else:
+            cursor = self.conn.execute('''
+                UPDATE game_state SET version = ? WHERE user_id = ? AND version = ?
+            ''', (version, self.user_id, expected))
+        return cursor.rowcount == 1
+
+    def save_grid_placement(self, grid_x, grid_y, object_type, object_name,
+                            planted_day=0, land_required=1, data=None):
+        """Save an object placement on the grid, replacing whatever was there"""
+        self.save_grid_placements([
+            (grid_x, grid_y, object_type, object_name, planted_day, land_required, data)
+        ])
+
+    def save_grid_placements(self, placements):
+        """Save several (grid_x, grid_y, object_type, object_name, planted_day,
+        land_required, data) placements at once"""
+        rows = []
+        for grid_x, grid_y, object_type, object_name, planted_day, land_required, data in placements:
+            width, height = footprint_for(land_required)
+            rows.append((self.user_id, grid_x, grid_y, object_type, object_name, planted_day,
+                         land_required, width, height, json.dumps(data) if data else None))
+        self.conn.executemany('''
+            INSERT INTO grid_placements (user_id, grid_x, grid_y, object_type, object_name,
+                                         growth_stage, planted_day, land_required, width, height, data)
+            VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, grid_x, grid_y) DO UPDATE
+            SET object_type = excluded.object_type,
+                object_name = excluded.object_name,
+                growth_stage = excluded.growth_stage,
+                planted_day = excluded.planted_day,
+                land_required = excluded.land_required,
+                width = excluded.width,
+                height = excluded.height,
+                data = excluded.data
+        ''', rows)
+
+    def get_grid_placements(self):
+        """Get all grid placements for the farm"""
+        cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT grid_x, grid_y, object_type, object_name, growth_stage, planted_day, data
+            SELECT grid_x, grid_y, object_type, object_name, growth_stage, planted_day,
+                   land_required, width, height, data
             FROM grid_placements WHERE user_id = ?
-        ''', (user_id,))
-        results = cursor.fetchall()
-        conn.close()
-
-        placements = []
-        for row in results:
-            placements.append({
-                'grid_x': row[0],
-                'grid_y': row[1],
-                'object_type': row[2],
-                'object_name': row[3],
-                'growth_stage': row[4],
-                'planted_day': row[5],
-                'data': json.loads(row[6]) if row[6] else None
-            })
-        return placements
-
-    def remove_grid_placement(self, user_id, grid_x, grid_y):
-        """Remove an object from the grid"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        ''', (self.user_id,))
+        return [self._placement(row) for row in cursor.fetchall()]
+
+    def get_grid_placements_in_rect(self, x0, y0, x1, y1, reach=0):
+        """Get placements anchored inside a rectangle widened up/left by reach cells
+
+        Uses the (user_id, grid_x, grid_y) index, so only the requested
+        columns of the farm are read.
+        """
+        cursor = self.conn.cursor()
         cursor.execute('''
+            SELECT grid_x, grid_y, object_type, object_name, growth_stage, planted_day,
+                   land_required, width, height, data
+            FROM grid_placements
+            WHERE user_id = ? AND grid_x BETWEEN ? AND ? AND grid_y BETWEEN ? AND ?
+        ''', (self.user_id, x0 - reach, x1, y0 - reach, y1))
+        return [self._placement(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _placement(row):
+        return {
+            'grid_x': row[0],
+            'grid_y': row[1],
+            'object_type': row[2],
+            'object_name': row[3],
+            'growth_stage': row[4],
+            'planted_day': row[5],
+            'land_required': row[6],
+            'width': row[7],
+            'height': row[8],
+            # Only free-form extras live here, so it is almost always NULL
+            'data': json.loads(row[9]) if row[9] else None
+        }
+
+    def remove_grid_placement(self, grid_x, grid_y):
+        """Remove an object from the grid"""
+        self.conn.execute('''
             DELETE FROM grid_placements
             WHERE user_id = ? AND grid_x = ? AND grid_y = ?
-        ''', (user_id, grid_x, grid_y))
-        conn.commit()
-        conn.close()
+        ''', (self.user_id, grid_x, grid_y))
+
+    def remove_grid_placements(self, cells):
+        """Remove several objects from the grid in one statement batch"""
+        self.conn.executemany('''
+            DELETE FROM grid_placements
+            WHERE user_id = ? AND grid_x = ? AND grid_y = ?
+        ''', [(self.user_id, grid_x, grid_y) for grid_x, grid_y in cells])
+
+    def update_animals(self, animal_type, count):
+        """Update animal count for the farm"""
+        self.conn.execute('''
+            INSERT INTO farm_animals (user_id, animal_type, count)
+            VALUES (?, ?, ?)
+            ON CONFLICT (user_id, animal_type) DO UPDATE
+            SET count = excluded.count
+        ''', (self.user_id, animal_type, count))
 
-    def update_animals(self, user_id, animal_type, count):
-        """Update animal count for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def append_event(self, version, action, payload):
+        """Append the event that produced `version` of the farm to its log"""
+        self.conn.execute('''
+            INSERT INTO farm_events (user_id, version, action, payload) VALUES (?, ?, ?, ?)
+        ''', (self.user_id, version, action, payload))
 
+    def get_events(self, after=0):
+        """Get (version, payload) for every logged event after a version, oldest first"""
+        cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT animal_id FROM farm_animals
-            WHERE user_id = ? AND animal_type = ?
-        ''', (user_id, animal_type))
+            SELECT version, payload FROM farm_events
+            WHERE user_id = ? AND version > ? ORDER BY version
+        ''', (self.user_id, after))
+        return cursor.fetchall()
 
-        if cursor.fetchone():
-            cursor.execute('''
-                UPDATE farm_animals SET count = ?
-                WHERE user_id = ? AND animal_type = ?
-            ''', (count, user_id, animal_type))
-        else:
-            cursor.execute('''
-                INSERT INTO farm_animals (user_id, animal_type, count)
-                VALUES (?, ?, ?)
-            ''', (user_id, animal_type, count))
+    def delete_events(self, upto):
+        """Drop logged events up to and including a version; returns how many"""
+        return self.conn.execute('''
+            DELETE FROM farm_events WHERE user_id = ? AND version <= ?
+        ''', (self.user_id, upto)).rowcount
 
-        conn.commit()
-        conn.close()
+    def save_farm_snapshot(self, version, snapshot):
+        """Store the farm's latest replay snapshot, taken at `version`"""
+        self.conn.execute('''
+            INSERT INTO farm_snapshots (user_id, version, snapshot) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE
+            SET version = excluded.version, snapshot = excluded.snapshot
+        ''', (self.user_id, version, snapshot))
 
-    def get_animals(self, user_id):
-        """Get all animals for a user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_farm_snapshot(self):
+        """Get (version, snapshot bytes) of the farm's latest replay snapshot, or (0, None)"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT version, snapshot FROM farm_snapshots WHERE user_id = ?
+        ''', (self.user_id,))
+        result = cursor.fetchone()
+        return (result[0], result[1]) if result else (0, None)
+
+    def save_slot(self, slot, farm_version, day, snapshot):
+        """Store a snapshot in one of the farm's save slots, replacing what was there"""
+        self.conn.execute('''
+            INSERT INTO save_slots (user_id, slot, farm_version, day, saved_at, snapshot)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, slot) DO UPDATE
+            SET farm_version = excluded.farm_version,
+                day = excluded.day,
+                saved_at = excluded.saved_at,
+                snapshot = excluded.snapshot
+        ''', (self.user_id, slot, farm_version, day, datetime.now(), snapshot))
+
+    def get_slot(self, slot):
+        """Get the snapshot bytes in a save slot, or None if it is empty"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT snapshot FROM save_slots WHERE user_id = ? AND slot = ?
+        ''', (self.user_id, slot))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    def get_slots(self):
+        """Describe the farm's filled save slots, without their snapshots"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT slot, farm_version, day, saved_at, LENGTH(snapshot)
+            FROM save_slots WHERE user_id = ? ORDER BY slot
+        ''', (self.user_id,))
+        return [{'slot': row[0], 'version': row[1], 'day': row[2], 'saved_at': row[3], 'bytes': row[4]}
+                for row in cursor.fetchall()]
+
+    def get_animals(self):
+        """Get all animals for the farm"""
+        cursor = self.conn.cursor()
         cursor.execute('''
             SELECT animal_type, count FROM farm_animals WHERE user_id = ?
-        ''', (user_id,))
-        results = cursor.fetchall()
-        conn.close()
+        ''', (self.user_id,))
 
         animals = {}
-        for row in results:
+        for row in cursor.fetchall():
             animals[row[0]] = row[1]
         return animals
+
+
+# Time every call that runs SQL; see metrics.py
+metrics.instrument(FarmDatabase, ('create_user', 'get_user_id', 'write_batch'))
+metrics.instrument(FarmRepository, [name for name in vars(FarmRepository)
+                                    if not name.startswith('_')],
+                   rows={'get_animals': len, 'delete_events': lambda deleted: 0})
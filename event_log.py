@@ -0,0 +1,263 @@
+"""
+Append-only log of farm changes, with periodic snapshots to replay from
+
+Every transaction that changes a farm through FarmStateCache (and every
+world tick) appends one event, keyed by the farm version it produced. An
+event records the effect of the action rather than the request, so replay
+needs no game rules and cannot drift when the catalog changes:
+
+    header      flags (B), state field count (B), cell count (H), animal count (H)
+    state       field index (B), new value (q) for each changed field;
+                the season, if it changed, as a string
+    cells       x, y (H each), placed flag (B); for a placement its type and
+                name as strings, planted_day (q), land_required (H) and its
+                JSON data as a long string (empty for none)
+    animals     type as a string, new count (I)
+
+Strings are a length (B, or H for long strings) followed by UTF-8. Events
+written before the WIDE_DAYS flag packed planted_day as i; decode() reads
+both. Every
+SNAPSHOT_EVERY versions the transaction also stores a snapshot (see
+snapshot.py) of the farm, so a farm is rebuilt from its latest snapshot
+plus the events after it. The game_state / grid_placements / farm_animals
+rows stay the state the app reads; the log is the history behind them.
+
+Run as a script to check or rebuild every farm from the log, or to compact
+it (drop events already covered by a snapshot):
+    python event_log.py rebuild farm_game.db [--write]
+    python event_log.py compact farm_game.db [--keep N]
+"""
+import argparse
+import json
+import struct
+
+import snapshot
+from database import FarmDatabase
+from game_models import NEW_FARM_STATE, RESOURCES, FarmEconomy
+
+
+ACTIONS = ('update', 'place', 'remove', 'harvest', 'advance_day', 'batch', 'load', 'tick')
+ACTION_IDS = {name: i for i, name in enumerate(ACTIONS)}
+SNAPSHOT_EVERY = 100  # versions between stored snapshots of a farm
+
+STATE_FIELDS = (*RESOURCES, 'day', 'farm_level', 'land_size')
+HAS_SEASON = 1
+WIDE_DAYS = 2  # planted_day is q rather than i
+
+HEADER = struct.Struct('<BBHH')
+FIELD = struct.Struct('<Bq')
+CELL = struct.Struct('<HHB')
+PLACED = struct.Struct('<qH')
+NARROW_PLACED = struct.Struct('<iH')  # events without WIDE_DAYS
+ANIMAL_COUNT = struct.Struct('<I')
+SHORT = struct.Struct('<B')
+LONG = struct.Struct('<H')
+
+
+def _string(text, length=SHORT):
+    encoded = text.encode('utf-8')
+    return length.pack(len(encoded)) + encoded
+
+
+def _read_string(payload, offset, length=SHORT):
+    (size,) = length.unpack_from(payload, offset)
+    offset += length.size
+    return payload[offset:offset + size].decode('utf-8'), offset + size
+
+
+def encode(state=None, cells=(), animals=None):
+    """Pack one event
+
+    state is {field: new value} for changed STATE_FIELDS and/or 'season';
+    cells are (grid_x, grid_y, placement) with placement None for a removal
+    or (object_type, object_name, planted_day, land_required, data);
+    animals is {animal_type: new count}.
+    """
+    state = state or {}
+    animals = animals or {}
+    fields = [(i, state[name]) for i, name in enumerate(STATE_FIELDS) if name in state]
+    flags = WIDE_DAYS | (HAS_SEASON if 'season' in state else 0)
+
+    parts = [HEADER.pack(flags, len(fields), len(cells), len(animals))]
+    parts.extend(FIELD.pack(*field) for field in fields)
+    if flags & HAS_SEASON:
+        parts.append(_string(state['season']))
+    for grid_x, grid_y, placement in cells:
+        parts.append(CELL.pack(grid_x, grid_y, placement is not None))
+        if placement is not None:
+            object_type, object_name, planted_day, land_required, data = placement
+            parts.append(_string(object_type) + _string(object_name)
+                         + PLACED.pack(planted_day, land_required)
+                         + _string(json.dumps(data) if data else '', LONG))
+    for animal_type, count in animals.items():
+        parts.append(_string(animal_type) + ANIMAL_COUNT.pack(count))
+    return b''.join(parts)
+
+
+def encode_session(session):
+    """The event for everything a FarmSession changed"""
+    farm = session.farm
+    state = {}
+    if session.changed_state:
+        after = farm.game_state()
+        state = {key: after[key] for key in (*STATE_FIELDS, 'season')
+                 if after[key] != session.before.get(key)}
+    cells = []
+    for cell in sorted(session.changed_cells):
+        p = farm.placements.get(cell)
+        cells.append((*cell, None if p is None else
+                      (p.object_type, p.object_name, p.planted_day, p.land_required, p.data)))
+    animals = {animal_type: farm.animals.get(animal_type, 0)
+               for animal_type in session.changed_animals}
+    return encode(state, cells, animals)
+
+
+def decode(payload):
+    """Unpack an event into (state, cells, animals), the arguments encode() took"""
+    flags, field_count, cell_count, animal_count = HEADER.unpack_from(payload)
+    offset = HEADER.size
+    placed_layout = PLACED if flags & WIDE_DAYS else NARROW_PLACED
+    state = {}
+    for _ in range(field_count):
+        index, value = FIELD.unpack_from(payload, offset)
+        offset += FIELD.size
+        state[STATE_FIELDS[index]] = value
+    if flags & HAS_SEASON:
+        state['season'], offset = _read_string(payload, offset)
+
+    cells = []
+    for _ in range(cell_count):
+        grid_x, grid_y, placed = CELL.unpack_from(payload, offset)
+        offset += CELL.size
+        placement = None
+        if placed:
+            object_type, offset = _read_string(payload, offset)
+            object_name, offset = _read_string(payload, offset)
+            planted_day, land_required = placed_layout.unpack_from(payload, offset)
+            offset += placed_layout.size
+            data, offset = _read_string(payload, offset, LONG)
+            placement = (object_type, object_name, planted_day, land_required,
+                         json.loads(data) if data else None)
+        cells.append((grid_x, grid_y, placement))
+
+    animals = {}
+    for _ in range(animal_count):
+        animal_type, offset = _read_string(payload, offset)
+        (animals[animal_type],) = ANIMAL_COUNT.unpack_from(payload, offset)
+        offset += ANIMAL_COUNT.size
+    return state, cells, animals
+
+
+def replay(snapshot_blob, events):
+    """Rebuild a farm as a FarmSnapshot from a snapshot (None: a new farm)
+    and the (version, payload) events after it, oldest first"""
+    if snapshot_blob is None:
+        game_state = {key: value for key, value in NEW_FARM_STATE.items() if key != 'version'}
+        placements, animals, version = {}, {}, 0
+    else:
+        saved = snapshot.decode(snapshot_blob)
+        game_state, animals, version = saved.game_state, saved.animals, saved.version
+        placements = {(p[0], p[1]): p for p in saved.placements}
+
+    for version, payload in events:
+        state, cells, counts = decode(payload)
+        game_state.update(state)
+        for grid_x, grid_y, placement in cells:
+            if placement is None:
+                placements.pop((grid_x, grid_y), None)
+            else:
+                placements[(grid_x, grid_y)] = (grid_x, grid_y, *placement)
+        animals.update(counts)
+    return snapshot.FarmSnapshot(game_state, list(placements.values()), animals, version)
+
+
+def load(repo):
+    """Replay one farm from its latest snapshot and the events after it"""
+    version, blob = repo.get_farm_snapshot()
+    return replay(blob, repo.get_events(after=version))
+
+
+def _rows(repo):
+    """The farm as its rows hold it, in FarmSnapshot's shapes, for comparison"""
+    state = repo.get_game_state()
+    placements = sorted((p['grid_x'], p['grid_y'], p['object_type'], p['object_name'],
+                         p['planted_day'], p['land_required'], p['data'])
+                        for p in repo.get_grid_placements())
+    animals = {name: count for name, count in repo.get_animals().items() if count}
+    return state, placements, animals
+
+
+def matches(repo, replayed):
+    """Whether a replayed farm equals the farm's rows"""
+    state, placements, animals = _rows(repo)
+    return (all(replayed.game_state[key] == state[key] for key in (*STATE_FIELDS, 'season'))
+            and replayed.version == state['version']
+            and sorted(replayed.placements) == placements
+            and {name: count for name, count in replayed.animals.items() if count} == animals)
+
+
+def write_rows(repo, replayed):
+    """Overwrite a farm's rows with a replayed farm, in the caller's transaction"""
+    repo.remove_grid_placements([(p['grid_x'], p['grid_y']) for p in repo.get_grid_placements()])
+    repo.save_grid_placements(replayed.placements)
+    for animal_type in set(repo.get_animals()) | set(replayed.animals):
+        repo.update_animals(animal_type, replayed.animals.get(animal_type, 0))
+    repo.update_game_state(replayed.game_state)
+    repo.save_economy(FarmEconomy.compute([(p[2], p[3], p[4]) for p in replayed.placements],
+                                          replayed.animals, replayed.game_state['day']))
+    repo.set_version(replayed.version)
+
+
+def _user_ids(db):
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute('SELECT user_id FROM game_state ORDER BY user_id')]
+
+
+def rebuild(db, write=False):
+    """Replay every farm and compare it with its rows; with write=True,
+    overwrite the rows of farms that differ. Returns the differing user ids."""
+    differing = []
+    for user_id in _user_ids(db):
+        with db.unit_of_work(user_id) as repo:
+            replayed = load(repo)
+            if not matches(repo, replayed):
+                differing.append(user_id)
+                if write:
+                    write_rows(repo, replayed)
+    return differing
+
+
+def compact(db, keep=0):
+    """Snapshot every farm at its latest version and drop all but the last
+    `keep` events before that snapshot. Returns the number of events dropped."""
+    dropped = 0
+    for user_id in _user_ids(db):
+        with db.unit_of_work(user_id) as repo:
+            version, blob = repo.get_farm_snapshot()
+            events = repo.get_events(after=version)
+            if events:
+                replayed = replay(blob, events)
+                repo.save_farm_snapshot(replayed.version, snapshot.encode_state(
+                    replayed.game_state, replayed.placements, replayed.animals, replayed.version))
+                version = replayed.version
+            dropped += repo.delete_events(upto=version - keep)
+    return dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check, rebuild or compact the farm event log')
+    parser.add_argument('command', choices=('rebuild', 'compact'))
+    parser.add_argument('database')
+    parser.add_argument('--write', action='store_true',
+                        help='rebuild: overwrite farms whose rows differ from the log')
+    parser.add_argument('--keep', type=int, default=0,
+                        help='compact: events to keep before each snapshot')
+    args = parser.parse_args()
+
+    db = FarmDatabase(args.database, pooled=False)
+    if args.command == 'rebuild':
+        differing = rebuild(db, write=args.write)
+        action = 'rewritten' if args.write else 'differ from the log'
+        print(f'{len(differing)} farms {action}: {differing[:20]}')
+    else:
+        print(f'Dropped {compact(db, keep=args.keep)} events')
@@ -0,0 +1,244 @@
+"""
+Compact occupancy grid for one farm
+"""
+import math
+from array import array
+
+
+GRID_SIZE = 20  # cells per side at farm level 1
+CHUNK_SIZE = 16  # cells per side of one storage chunk
+MAX_FOOTPRINT = 3  # widest/tallest object in the catalog (3x3 barn)
+
+
+def grid_size_for(farm_level):
+    """Cells per side of a farm grid, which grows with the farm level"""
+    return GRID_SIZE * max(1, farm_level or 1)
+
+
+def footprint_for(land_required):
+    """Width and height in cells of an object needing land_required cells
+
+    Square areas become squares (4 -> 2x2, 9 -> 3x3); anything else is laid
+    out as a single row.
+    """
+    side = math.isqrt(land_required)
+    if side * side == land_required:
+        return side, side
+    return land_required, 1
+
+
+def chunk_of(x, y):
+    return x // CHUNK_SIZE, y // CHUNK_SIZE
+
+
+class CellMap:
+    """Dict keyed by (x, y) cell, stored in CHUNK_SIZE x CHUNK_SIZE chunks
+
+    copy() shares every chunk with the original, so it costs one entry per
+    chunk rather than one per cell; whichever map writes to a shared chunk
+    first copies just that chunk. Cached farms are copied for every
+    transaction, so their per-cell indexes live in these.
+    """
+    __slots__ = ('chunks', 'owned', 'size')
+
+    def __init__(self):
+        self.chunks = {}  # (chunk_x, chunk_y) -> {(x, y): value}
+        self.owned = set()  # chunks no other map shares, so they can be written in place
+        self.size = 0
+
+    def copy(self):
+        other = CellMap()
+        other.chunks = dict(self.chunks)
+        other.size = self.size
+        self.owned = set()
+        return other
+
+    def _writable(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None or key not in self.owned:
+            chunk = self.chunks[key] = dict(chunk or ())
+            self.owned.add(key)
+        return chunk
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, cell):
+        chunk = self.chunks.get(chunk_of(*cell))
+        return chunk is not None and cell in chunk
+
+    def __getitem__(self, cell):
+        chunk = self.chunks.get(chunk_of(*cell))
+        if chunk is None:
+            raise KeyError(cell)
+        return chunk[cell]
+
+    def get(self, cell, default=None):
+        chunk = self.chunks.get(chunk_of(*cell))
+        return default if chunk is None else chunk.get(cell, default)
+
+    def __setitem__(self, cell, value):
+        chunk = self._writable(chunk_of(*cell))
+        if cell not in chunk:
+            self.size += 1
+        chunk[cell] = value
+
+    def pop(self, cell, *default):
+        key = chunk_of(*cell)
+        chunk = self.chunks.get(key)
+        if chunk is None or cell not in chunk:
+            if default:
+                return default[0]
+            raise KeyError(cell)
+        chunk = self._writable(key)
+        value = chunk.pop(cell)
+        self.size -= 1
+        if not chunk:
+            del self.chunks[key]
+            self.owned.discard(key)
+        return value
+
+    def __iter__(self):
+        for chunk in self.chunks.values():
+            yield from chunk
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for chunk in self.chunks.values():
+            yield from chunk.values()
+
+    def items(self):
+        for chunk in self.chunks.values():
+            yield from chunk.items()
+
+    def chunk(self, chunk_x, chunk_y):
+        """The cells of one chunk as a dict, which must not be changed"""
+        return self.chunks.get((chunk_x, chunk_y), {})
+
+
+class FarmGrid:
+    """Cell occupancy for one farm, stored in CHUNK_SIZE x CHUNK_SIZE chunks
+
+    Each cell holds 0 when empty, otherwise 1 + the flat index of the anchor
+    (top-left) cell of the object covering it, so finding what sits on any
+    cell is a single array read. Chunks are only allocated once something is
+    placed in them, so a large, mostly empty farm stays small, and anchors
+    are kept in a CellMap chunked the same way, so a viewport can be
+    answered without scanning the whole farm. The land_used counter is kept
+    up to date on every occupy/vacate instead of being recounted from the
+    placements. Like a CellMap, a copy shares its chunks until one is written.
+    """
+
+    def __init__(self, width=GRID_SIZE, height=GRID_SIZE):
+        self.width = width
+        self.height = height
+        self.chunks = {}  # (chunk_x, chunk_y) -> array of cells
+        self.owned = set()  # chunks no copy shares, so they can be written in place
+        self.footprints = CellMap()  # (x, y) anchor -> (width, height, land)
+        self.land_used = 0
+
+    def copy(self):
+        grid = FarmGrid(self.width, self.height)
+        grid.chunks = dict(self.chunks)
+        self.owned = set()
+        grid.footprints = self.footprints.copy()
+        grid.land_used = self.land_used
+        return grid
+
+    def resize(self, width, height):
+        """Grow or shrink the grid, re-placing everything already on it"""
+        if (width, height) == (self.width, self.height):
+            return
+        footprints = self.footprints
+        self.__init__(width, height)
+        for (x, y), (w, h, land) in footprints.items():
+            self.occupy(x, y, w, h, land)
+
+    def nbytes(self):
+        return sum(len(chunk) * chunk.itemsize for chunk in self.chunks.values())
+
+    def _get(self, x, y):
+        chunk = self.chunks.get((x // CHUNK_SIZE, y // CHUNK_SIZE))
+        if chunk is None:
+            return 0
+        return chunk[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE]
+
+    def _set(self, x, y, value):
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            if not value:
+                return
+            chunk = self.chunks[key] = array('i', bytes(4 * CHUNK_SIZE * CHUNK_SIZE))
+            self.owned.add(key)
+        elif key not in self.owned:
+            chunk = self.chunks[key] = array('i', chunk)
+            self.owned.add(key)
+        chunk[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE] = value
+
+    def in_bounds(self, x, y, w=1, h=1):
+        return 0 <= x and 0 <= y and x + w <= self.width and y + h <= self.height
+
+    def anchor_at(self, x, y):
+        """Anchor cell of the object covering (x, y), or None"""
+        if not self.in_bounds(x, y):
+            return None
+        value = self._get(x, y)
+        if not value:
+            return None
+        return (value - 1) % self.width, (value - 1) // self.width
+
+    def fits(self, x, y, w, h):
+        """True if a w x h object anchored at (x, y) is in bounds and unobstructed"""
+        if not self.in_bounds(x, y, w, h):
+            return False
+        for row in range(y, y + h):
+            for col in range(x, x + w):
+                if self._get(col, row):
+                    return False
+        return True
+
+    def occupy(self, x, y, w, h, land):
+        """Mark a w x h object anchored at (x, y) as placed"""
+        if (x, y) in self.footprints:
+            self.vacate(x, y)
+        # Clip rather than fail so rows saved before footprints existed still load
+        if self.in_bounds(x, y):
+            w = min(w, self.width - x)
+            h = min(h, self.height - y)
+        else:
+            w = h = 0
+        value = y * self.width + x + 1
+        for row in range(y, y + h):
+            for col in range(x, x + w):
+                self._set(col, row, value)
+        self.footprints[(x, y)] = (w, h, land)
+        self.land_used += land
+
+    def vacate(self, x, y):
+        """Clear the object anchored at (x, y)"""
+        footprint = self.footprints.pop((x, y), None)
+        if footprint is None:
+            return
+        w, h, land = footprint
+        value = y * self.width + x + 1
+        for row in range(y, y + h):
+            for col in range(x, x + w):
+                # Only clear cells this object still owns
+                if self._get(col, row) == value:
+                    self._set(col, row, 0)
+        self.land_used -= land
+
+    def anchors_in_rect(self, x0, y0, x1, y1):
+        """Anchors of every object overlapping the inclusive rectangle (x0, y0)-(x1, y1)"""
+        # Objects anchored up to MAX_FOOTPRINT - 1 cells up/left can still reach in
+        reach = MAX_FOOTPRINT - 1
+        anchors = []
+        for chunk_y in range(max(y0 - reach, 0) // CHUNK_SIZE, y1 // CHUNK_SIZE + 1):
+            for chunk_x in range(max(x0 - reach, 0) // CHUNK_SIZE, x1 // CHUNK_SIZE + 1):
+                for (x, y), (w, h, _) in self.footprints.chunk(chunk_x, chunk_y).items():
+                    if x <= x1 and y <= y1 and x + max(w, 1) > x0 and y + max(h, 1) > y0:
+                        anchors.append((x, y))
+        return anchors
@@ -0,0 +1,556 @@
+"""
+In-memory farm state and the write-through cache that sits in front of FarmDatabase
+"""
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+
+import snapshot
+from event_log import ACTION_IDS, SNAPSHOT_EVERY, encode_session
+from farm_grid import CellMap, FarmGrid, footprint_for, grid_size_for
+from game_models import CATALOG, NEW_FARM_STATE, RESOURCES, FarmEconomy
+from journal import JournalWriter
+from maturity import MaturityIndex
+
+
+RESOURCE_KEYS = RESOURCES
+CHANGE_LOG_SIZE = 64  # versions a client can lag behind before it gets a full snapshot
+MAX_RETRIES = 3  # times FarmStateCache.attempts() reruns a transaction that lost a race
+WRITE_LOCK_BITS = 6  # 64 locks serialise write-behind transactions
+
+
+class VersionConflict(Exception):
+    """Raised when a transaction's farm was changed by another writer before it committed"""
+
+
+@dataclass(slots=True)
+class Placement:
+    """An object placed on one farm grid cell"""
+    grid_x: int
+    grid_y: int
+    object_type: str
+    object_name: str
+    growth_stage: int = 0
+    planted_day: int = 0
+    land_required: int = 0
+    width: int = 0
+    height: int = 0
+    data: dict = None
+
+    def __post_init__(self):
+        # Placements built outside the database take their size from the catalog
+        if not self.land_required:
+            item = CATALOG.get(self.object_type, self.object_name)
+            self.land_required = item.land_required if item else 1
+        if not self.width or not self.height:
+            self.width, self.height = footprint_for(self.land_required)
+
+    def to_dict(self):
+        return {
+            'grid_x': self.grid_x,
+            'grid_y': self.grid_y,
+            'object_type': self.object_type,
+            'object_name': self.object_name,
+            'growth_stage': self.growth_stage,
+            'planted_day': self.planted_day,
+            'land_required': self.land_required,
+            'width': self.width,
+            'height': self.height,
+            'data': self.data
+        }
+
+
+@dataclass(slots=True)
+class FarmChange:
+    """What one committed transaction changed on a farm"""
+    version: int
+    cells: frozenset  # anchor cells whose placement was added, replaced or removed
+    state: bool  # resources or day/season changed
+    animals: frozenset  # animal types whose count changed
+
+
+@dataclass(slots=True)
+class Farm:
+    """Everything the handlers need to know about one player's farm
+
+    A farm in FarmStateCache is never changed once stored: transactions
+    change a copy() and store that once they commit. Placements are
+    replaced rather than changed, so copies share them, and the placement,
+    grid and maturity maps are copied chunk by chunk on first write, so a
+    copy costs O(chunks) rather than O(placements).
+    """
+    user_id: int
+    resources: dict
+    day: int = 1
+    season: str = 'Spring'
+    farm_level: int = 1
+    land_size: int = 100
+    placements: CellMap = field(default_factory=CellMap)  # (grid_x, grid_y) -> Placement
+    animals: dict = field(default_factory=dict)  # animal_type -> count
+    grid: FarmGrid = field(default_factory=FarmGrid)
+    maturity: MaturityIndex = field(default_factory=MaturityIndex)
+    economy: FarmEconomy = field(default_factory=FarmEconomy)
+    version: int = 0
+    changes: deque = field(default_factory=lambda: deque(maxlen=CHANGE_LOG_SIZE))
+
+    @classmethod
+    def from_rows(cls, user_id, game_state, placements, animals):
+        """Build a farm from the dicts FarmRepository returns"""
+        farm = cls(user_id, {key: game_state[key] for key in RESOURCE_KEYS})
+        farm.apply_game_state(game_state)
+        farm.version = game_state.get('version', 0)
+        for p in placements:
+            farm.add_placement(Placement(**p))
+        for animal_type, count in animals.items():
+            farm.set_animal_count(animal_type, count)
+        return farm
+
+    def apply_game_state(self, game_state):
+        for key in RESOURCE_KEYS:
+            self.resources[key] = game_state.get(key, 0)
+        self.day = game_state.get('day', 1)
+        self.season = game_state.get('season', 'Spring')
+        self.farm_level = game_state.get('farm_level', 1)
+        self.land_size = game_state.get('land_size', 100)
+        size = grid_size_for(self.farm_level)
+        self.grid.resize(size, size)
+        if self.day < self.maturity.day:
+            # Back to an earlier day (a loaded save): ripe crops may be growing again
+            crops = [p for p in self.placements.values() if p.object_type == 'crop']
+            for p in crops:
+                self.remove_placement(p.grid_x, p.grid_y)
+            self.maturity = MaturityIndex()
+            for p in crops:
+                self.add_placement(p)
+        # Kept at the farm's day so reading ready crops never changes the
+        # index; crops stop drawing water as they ripen
+        for cell in self.maturity.advance(self.day):
+            self.economy.ripen(self.placements[cell].object_name)
+
+    def copy(self):
+        """A copy a transaction can change without readers of this farm seeing it"""
+        return Farm(self.user_id, dict(self.resources), self.day, self.season,
+                    self.farm_level, self.land_size, self.placements.copy(),
+                    dict(self.animals), self.grid.copy(), self.maturity.copy(),
+                    replace(self.economy), self.version,
+                    deque(self.changes, maxlen=CHANGE_LOG_SIZE))
+
+    def game_state(self):
+        """Game state in the same shape as FarmDatabase.get_game_state"""
+        state = dict(self.resources)
+        state.update({
+            'day': self.day,
+            'season': self.season,
+            'farm_level': self.farm_level,
+            'land_size': self.land_size,
+            'version': self.version
+        })
+        return state
+
+    def add_placement(self, placement):
+        """Place an object, replacing anything anchored on the same cell"""
+        cell = (placement.grid_x, placement.grid_y)
+        replaced = self.placements.get(cell)
+        if replaced is not None:
+            self.economy.add_placement(replaced.object_type, replaced.object_name, -1,
+                                       growing=cell not in self.maturity.ready)
+        self.grid.occupy(placement.grid_x, placement.grid_y, placement.width,
+                         placement.height, placement.land_required)
+        self.placements[cell] = placement
+
+        crop = CATALOG.get('crop', placement.object_name) if placement.object_type == 'crop' else None
+        if crop:
+            self.maturity.add(cell, placement.planted_day + crop.growth_time)
+        else:
+            self.maturity.discard(cell)
+        self.economy.add_placement(placement.object_type, placement.object_name,
+                                   growing=cell not in self.maturity.ready)
+
+    def remove_placement(self, grid_x, grid_y):
+        """Remove the object anchored at (grid_x, grid_y) and return it"""
+        growing = (grid_x, grid_y) not in self.maturity.ready
+        self.grid.vacate(grid_x, grid_y)
+        self.maturity.discard((grid_x, grid_y))
+        placement = self.placements.pop((grid_x, grid_y), None)
+        if placement is not None:
+            self.economy.add_placement(placement.object_type, placement.object_name, -1,
+                                       growing=growing)
+        return placement
+
+    def add_resources(self, deltas):
+        for key, amount in deltas.items():
+            self.resources[key] = self.resources.get(key, 0) + amount
+
+    def set_animal_count(self, animal_type, count):
+        self.economy.add_animals(animal_type, count - self.animals.get(animal_type, 0))
+        self.animals[animal_type] = count
+
+    def placement_at(self, grid_x, grid_y):
+        """Object covering (grid_x, grid_y), whichever of its cells that is"""
+        anchor = self.grid.anchor_at(grid_x, grid_y)
+        return self.placements.get(anchor) if anchor else None
+
+    def ready_crops(self):
+        """Crop placements that can be harvested today"""
+        return [self.placements[cell] for cell in self.maturity.ready_cells(self.day)]
+
+    def is_ready(self, placement):
+        return self.maturity.is_ready((placement.grid_x, placement.grid_y), self.day)
+
+    def record_change(self, cells, state, animals):
+        self.version += 1
+        self.changes.append(FarmChange(self.version, frozenset(cells), state, frozenset(animals)))
+
+    def delta_since(self, version):
+        """Changes made after `version`, or None if the log no longer reaches back that far"""
+        if version > self.version:
+            return None
+        if version < self.version and (not self.changes or self.changes[0].version > version + 1):
+            return None
+
+        cells, state, animals = set(), False, set()
+        for change in self.changes:
+            if change.version > version:
+                cells |= change.cells
+                state = state or change.state
+                animals |= change.animals
+
+        delta = {
+            'version': self.version,
+            'cells': [
+                self.placements[cell].to_dict() if cell in self.placements
+                else {'grid_x': cell[0], 'grid_y': cell[1], 'removed': True}
+                for cell in cells
+            ],
+            'animals': {name: self.animals.get(name, 0) for name in animals}
+        }
+        if state:
+            delta['game_state'] = self.game_state()
+        return delta
+
+    def placement_list(self):
+        return [p.to_dict() for p in self.placements.values()]
+
+    def placements_in_rect(self, x0, y0, x1, y1):
+        """Placements overlapping the inclusive rectangle (x0, y0)-(x1, y1)"""
+        return [self.placements[anchor].to_dict()
+                for anchor in self.grid.anchors_in_rect(x0, y0, x1, y1)
+                if anchor in self.placements]
+
+    def approx_size(self):
+        """Rough number of bytes this farm keeps alive, for the cache budget"""
+        return (1024 + self.grid.nbytes()
+                + 320 * len(self.placements) + 96 * len(self.animals))
+
+
+class FarmSession:
+    """Transaction-scoped view of a farm that writes through to SQLite
+
+    Exposes the same methods as FarmRepository. Every write goes to the
+    repository first and is then applied to the transaction's own copy of
+    the farm, which replaces the cached one only once the transaction has
+    committed, so readers never see a change that is not committed.
+    """
+
+    def __init__(self, repo, farm):
+        self.repo = repo
+        self.farm = farm
+        self.before = farm.game_state() if farm else None  # to log only the fields that changed
+        self.economy_before = replace(farm.economy) if farm else None  # saved on commit if it changed
+        # What this transaction touched, recorded in the farm's change log on commit
+        self.changed_cells = set()
+        self.changed_state = False
+        self.changed_animals = set()
+
+    @property
+    def dirty(self):
+        return bool(self.changed_cells or self.changed_state or self.changed_animals)
+
+    def get_game_state(self):
+        return self.farm.game_state() if self.farm else None
+
+    def get_grid_placements(self):
+        return self.farm.placement_list()
+
+    def get_animals(self):
+        return dict(self.farm.animals)
+
+    def get_economy(self):
+        return self.farm.economy
+
+    def update_game_state(self, resources):
+        self.repo.update_game_state(resources)
+        self.farm.apply_game_state(resources)
+        self.changed_state = True
+
+    def add_resources(self, deltas):
+        self.repo.add_resources(deltas)
+        self.farm.add_resources(deltas)
+        self.changed_state = True
+
+    def save_grid_placement(self, grid_x, grid_y, object_type, object_name,
+                            planted_day=0, land_required=1, data=None):
+        self.repo.save_grid_placement(grid_x, grid_y, object_type, object_name,
+                                      planted_day, land_required, data)
+        self.farm.add_placement(Placement(grid_x, grid_y, object_type, object_name,
+                                          planted_day=planted_day,
+                                          land_required=land_required, data=data))
+        self.changed_cells.add((grid_x, grid_y))
+
+    def remove_grid_placement(self, grid_x, grid_y):
+        self.repo.remove_grid_placement(grid_x, grid_y)
+        self.farm.remove_placement(grid_x, grid_y)
+        self.changed_cells.add((grid_x, grid_y))
+
+    def save_grid_placements(self, placements):
+        self.repo.save_grid_placements(placements)
+        for grid_x, grid_y, object_type, object_name, planted_day, land_required, data in placements:
+            self.farm.add_placement(Placement(grid_x, grid_y, object_type, object_name,
+                                              planted_day=planted_day,
+                                              land_required=land_required, data=data))
+            self.changed_cells.add((grid_x, grid_y))
+
+    def remove_grid_placements(self, cells):
+        self.repo.remove_grid_placements(cells)
+        for grid_x, grid_y in cells:
+            self.farm.remove_placement(grid_x, grid_y)
+        self.changed_cells.update(cells)
+
+    def update_animals(self, animal_type, count):
+        self.repo.update_animals(animal_type, count)
+        self.farm.set_animal_count(animal_type, count)
+        self.changed_animals.add(animal_type)
+
+
+class FarmStateCache:
+    """LRU cache of Farm objects in front of FarmDatabase
+
+    Farms are evicted least-recently-used first once either max_entries or
+    the approximate max_bytes budget is exceeded. Every mutating
+    transaction() checks the farm's version with a compare-and-swap, so a
+    cached farm that another process (or a world tick) changed is never
+    written back over; run the transaction through attempts() to reload
+    and retry it. With write-behind the check only happens when the
+    journal flushes, and a conflicting farm's writes are dropped instead
+    (see journal.py). Reads may be served from a stale copy until then. A
+    stored farm is never changed (see Farm), so readers need no lock.
+    """
+
+    def __init__(self, db, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.db = db
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._farms = OrderedDict()  # user_id -> Farm, least recently used first
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Serialise write-behind transactions per farm; without the journal
+        # BEGIN IMMEDIATE does this
+        self._write_locks = [threading.Lock() for _ in range(1 << WRITE_LOCK_BITS)]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conflicts = 0
+        # Called as listener(farm, session, action) after each committed change
+        self.listeners = []
+        if db.journal is not None:
+            db.journal.on_conflict.append(self._journal_conflict)
+
+    def _lookup(self, user_id):
+        with self._lock:
+            farm = self._farms.get(user_id)
+            if farm is None:
+                self.misses += 1
+                return None
+            self._farms.move_to_end(user_id)
+            self.hits += 1
+            return farm
+
+    def _store(self, farm):
+        size = farm.approx_size()
+        with self._lock:
+            cached = self._farms.get(farm.user_id)
+            if cached is not None and cached.version > farm.version:
+                return  # a transaction stored a newer version since this one was read
+            self._bytes += size - self._sizes.get(farm.user_id, 0)
+            self._farms[farm.user_id] = farm
+            self._sizes[farm.user_id] = size
+            self._farms.move_to_end(farm.user_id)
+            while self._farms and (len(self._farms) > self.max_entries
+                                   or self._bytes > self.max_bytes):
+                evicted, _ = self._farms.popitem(last=False)
+                self._bytes -= self._sizes.pop(evicted)
+                self.evictions += 1
+
+    @staticmethod
+    def _load(repo):
+        game_state = repo.get_game_state()
+        if game_state is None:
+            return None
+        return Farm.from_rows(repo.user_id, game_state,
+                              repo.get_grid_placements(), repo.get_animals())
+
+    def peek(self, user_id):
+        """Return the cached farm for user_id without loading it on a miss"""
+        return self._lookup(user_id)
+
+    def get(self, user_id):
+        """Return the farm for user_id, loading it on a miss (None if unknown)"""
+        farm = self._lookup(user_id)
+        if farm is not None:
+            return farm
+
+        with self.db.read(user_id) as repo:
+            farm = self._load(repo)
+        if farm is not None:
+            self._store(farm)
+        return farm
+
+    @contextmanager
+    def transaction(self, user_id, action='update'):
+        """Yield a FarmSession inside one FarmDatabase unit of work
+
+        The farm comes from the cache (or is read inside the transaction on
+        a miss) and copied, and the version bump at the end only succeeds if the row
+        is still at the version the farm was read at; otherwise the
+        transaction rolls back and raises VersionConflict. The farm's running
+        economy totals are written back once, just before commit, if they
+        changed, and what changed is appended to the
+        event log as one `action` event (see event_log.py). After commit
+        the copy replaces the cached farm and every listener is told about
+        the change. If anything fails the cached farm is dropped and
+        reloaded on next use.
+
+        When the database has a write-behind journal, the writes are
+        recorded and handed to the journal instead, and a per-farm lock
+        takes the place of the SQLite write lock. The version is then only
+        checked when the journal flushes, after the request has returned
+        (see journal.py).
+        """
+        if self.db.journal is not None:
+            with self._journal_transaction(user_id, action) as session:
+                yield session
+            return
+
+        try:
+            with self.db.unit_of_work(user_id) as repo:
+                cached = self._lookup(user_id)
+                farm = cached.copy() if cached is not None else self._load(repo)
+                session = FarmSession(repo, farm)
+                yield session
+                if farm is not None and farm.economy != session.economy_before:
+                    repo.save_economy(farm.economy)
+                if session.dirty:
+                    if not repo.bump_version(expected=farm.version):
+                        with self._lock:
+                            self.conflicts += 1
+                        raise VersionConflict(f'Farm {user_id} changed since version {farm.version}')
+                    self._log(repo, session, action)
+        except BaseException:
+            self.invalidate(user_id)
+            raise
+        if farm is not None:
+            if session.dirty:
+                farm.record_change(session.changed_cells, session.changed_state,
+                                   session.changed_animals)
+            self._store(farm)
+            if session.dirty:
+                self._notify(farm, session, action)
+
+    def _notify(self, farm, session, action):
+        for listener in self.listeners:
+            listener(farm, session, action)
+
+    @staticmethod
+    def _log(writer, session, action):
+        """Append the session's event, and every SNAPSHOT_EVERY versions a snapshot"""
+        farm = session.farm
+        version = farm.version + 1  # the version this transaction produces
+        writer.append_event(version, ACTION_IDS[action], encode_session(session))
+        if version % SNAPSHOT_EVERY == 0:
+            writer.save_farm_snapshot(version, snapshot.encode(farm, version))
+
+    def _write_lock(self, user_id):
+        # Sharded ids keep the shard in their low bits and unsharded ones count
+        # up, so take the top bits of a multiplicative hash rather than a modulus
+        mixed = (user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        return self._write_locks[mixed >> (64 - WRITE_LOCK_BITS)]
+
+    @contextmanager
+    def _journal_transaction(self, user_id, action):
+        with self._write_lock(user_id):
+            farm = self.get(user_id)
+            if farm is not None:
+                farm = farm.copy()
+            writer = JournalWriter(user_id, farm)
+            session = FarmSession(writer, farm)
+            try:
+                yield session
+                if farm is not None and session.dirty:
+                    if farm.economy != session.economy_before:
+                        writer.save_economy(farm.economy)
+                    self._log(writer, session, action)
+                    farm.record_change(session.changed_cells, session.changed_state,
+                                       session.changed_animals)
+                    writer.set_version(farm.version, expected=farm.version - 1)
+                    self.db.journal.submit(writer)
+            except BaseException:
+                self.invalidate(user_id)
+                raise
+            if farm is not None:
+                self._store(farm)
+                if session.dirty:
+                    self._notify(farm, session, action)
+
+    def attempts(self, user_id, action='update', retries=MAX_RETRIES):
+        """Transactions to run one block in until it commits without a VersionConflict
+
+            for attempt in farms.attempts(user_id, 'place'):
+                with attempt as repo:
+                    ...
+
+        A conflicting attempt is rolled back, the stale farm dropped and the
+        block run again against a fresh one, up to `retries` more times
+        before the conflict is raised.
+        """
+        for attempt in range(retries + 1):
+            conflicted = []
+            yield self._attempt(user_id, action, conflicted, attempt == retries)
+            if not conflicted:
+                return
+
+    @contextmanager
+    def _attempt(self, user_id, action, conflicted, last):
+        try:
+            with self.transaction(user_id, action) as session:
+                yield session
+        except VersionConflict:
+            if last:
+                raise
+            conflicted.append(True)
+
+    def _journal_conflict(self, user_id):
+        # The journal dropped writes this farm made on top of a stale version
+        with self._lock:
+            self.conflicts += 1
+        self.invalidate(user_id)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._farms.pop(user_id, None) is not None:
+                self._bytes -= self._sizes.pop(user_id)
+
+    def stats(self):
+        """Hit/miss counters and current occupancy"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'conflicts': self.conflicts,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._farms),
+                'bytes': self._bytes
+            }
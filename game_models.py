@@ -1,6 +1,21 @@
 """
 Game models for crops, animals, and buildings with their properties
 """
+from array import array
+from dataclasses import dataclass
+
+SEASONS = ['Spring', 'Summer', 'Fall', 'Winter']
+DAYS_PER_SEASON = 28
+
+# Every resource a farm holds, in the order used by cost and resource vectors
+RESOURCES = ('gold', 'wood', 'stone', 'food', 'seeds', 'water')
+RESOURCE_IDS = {name: i for i, name in enumerate(RESOURCES)}
+
+# A new farm's game state, matching the game_state column defaults
+NEW_FARM_STATE = {
+    'gold': 100, 'wood': 50, 'stone': 25, 'food': 0, 'seeds': 10, 'water': 100,
+    'day': 1, 'season': 'Spring', 'farm_level': 1, 'land_size': 100, 'version': 0
+}
 
 class CropType:
     """Defines different crop types with their properties"""
@@ -209,51 +224,251 @@ class GameEconomy:
     @staticmethod
     def calculate_daily_revenue(crops, animals, buildings):
         """Calculate total daily revenue from all sources"""
-        revenue = 0
-
-        # Calculate animal revenue
-        for animal_type, count in animals.items():
-            animal_data = AnimalType.get_animal(animal_type)
-            if animal_data:
-                revenue += animal_data['production_value'] * count
-
-        # Apply building bonuses
-        crop_bonus = 1.0
-        for building_type in buildings:
-            building_data = BuildingType.get_building(building_type)
-            if building_data and 'crop_revenue' in building_data.get('bonus', {}):
-                crop_bonus *= building_data['bonus']['crop_revenue']
-
-        return revenue
+        return CATALOG.animal_revenue(CATALOG.animal_counts(animals))
 
     @staticmethod
     def calculate_daily_expenses(animals):
         """Calculate total daily expenses (upkeep)"""
-        expenses = 0
-
-        for animal_type, count in animals.items():
-            animal_data = AnimalType.get_animal(animal_type)
-            if animal_data:
-                expenses += animal_data['upkeep'] * count
-
-        return expenses
+        return CATALOG.animal_upkeep(CATALOG.animal_counts(animals))
 
     @staticmethod
     def can_afford(resources, cost):
         """Check if player has enough resources"""
-        for resource, amount in cost.items():
-            if resources.get(resource, 0) < amount:
-                return False
-        return True
+        return can_afford(resources, resource_vector(cost))
 
     @staticmethod
     def deduct_cost(resources, cost):
         """Deduct cost from resources"""
-        for resource, amount in cost.items():
-            resources[resource] = resources.get(resource, 0) - amount
-        return resources
+        return deduct(resources, resource_vector(cost))
+
+    @staticmethod
+    def get_season(day):
+        """Season name for an absolute day number (day 1 is the first of Spring)"""
+        return SEASONS[((day - 1) // DAYS_PER_SEASON) % len(SEASONS)]
+
+    @staticmethod
+    def get_object(object_type, object_name):
+        """Get catalog data for a placeable crop, animal or building"""
+        if object_type == 'crop':
+            return CropType.get_crop(object_name)
+        if object_type == 'animal':
+            return AnimalType.get_animal(object_name)
+        if object_type == 'building':
+            return BuildingType.get_building(object_name)
+        return None
 
     @staticmethod
     def calculate_land_usage(placements):
         """Calculate total land used"""
-        return len(placements)
+        land_used = 0
+        for p in placements:
+            object_data = GameEconomy.get_object(p['object_type'], p['object_name'])
+            land_used += object_data['land_required'] if object_data else 1
+        return land_used
+
+
+def resource_vector(amounts):
+    """A {resource: amount} dict as a tuple in RESOURCES order"""
+    return tuple(amounts.get(name, 0) for name in RESOURCES)
+
+
+def can_afford(resources, cost):
+    """True if a resources dict covers a cost vector"""
+    return all(resources.get(name, 0) >= amount for name, amount in zip(RESOURCES, cost))
+
+
+def deduct(resources, cost):
+    """Subtract a cost vector from a resources dict in place"""
+    for name, amount in zip(RESOURCES, cost):
+        if amount:
+            resources[name] = resources.get(name, 0) - amount
+    return resources
+
+
+@dataclass(slots=True, frozen=True)
+class CatalogItem:
+    """One compiled crop, animal or building type"""
+    id: int  # index within its kind
+    kind: str  # 'crop', 'animal' or 'building'
+    key: str
+    name: str
+    icon: str
+    cost: tuple  # amount of each resource, in RESOURCES order
+    land_required: int
+    # Crops
+    growth_time: int = 0
+    revenue: int = 0
+    food_value: int = 0
+    water_per_day: int = 0
+    # Animals
+    production_value: int = 0
+    upkeep: int = 0
+    food_per_day: int = 0
+    # Buildings
+    water_provided: int = 0
+    crop_revenue_bonus: float = 1.0
+    production_speed: float = 1.0
+
+
+class Catalog:
+    """The crop, animal and building tables compiled into items and per-type arrays
+
+    Items of each kind get dense integer ids, so per-farm counts can be kept
+    as fixed-length vectors and summed against the coefficient arrays here
+    instead of looking up nested dicts by name.
+    """
+
+    __slots__ = ('crops', 'animals', 'buildings', '_items', '_ids',
+                 'crop_growth_time', 'crop_revenue', 'crop_water_per_day',
+                 'animal_production_value', 'animal_upkeep_cost', 'animal_food_per_day',
+                 'building_water', 'building_crop_revenue_bonus', 'building_production_speed')
+
+    def __init__(self, crops, animals, buildings):
+        self.crops = tuple(
+            CatalogItem(i, 'crop', key, c['name'], c['icon'], resource_vector(c['cost']),
+                        c['land_required'], growth_time=c['growth_time'],
+                        revenue=c['revenue'], food_value=c.get('food_value', 5),
+                        water_per_day=c['water_per_day'])
+            for i, (key, c) in enumerate(crops.items()))
+        self.animals = tuple(
+            CatalogItem(i, 'animal', key, a['name'], a['icon'], resource_vector(a['cost']),
+                        a['land_required'], production_value=a['production_value'],
+                        upkeep=a['upkeep'], food_per_day=a['food_per_day'])
+            for i, (key, a) in enumerate(animals.items()))
+        self.buildings = tuple(
+            CatalogItem(i, 'building', key, b['name'], b['icon'], resource_vector(b['cost']),
+                        b['land_required'], water_provided=b['provides'].get('water', 0),
+                        crop_revenue_bonus=b['bonus'].get('crop_revenue', 1.0),
+                        production_speed=b['bonus'].get('production_speed', 1.0))
+            for i, (key, b) in enumerate(buildings.items()))
+
+        self._items = {}  # (kind, key) -> CatalogItem
+        self._ids = {'crop': {}, 'animal': {}, 'building': {}}  # kind -> key -> id
+        for item in self.crops + self.animals + self.buildings:
+            self._items[(item.kind, item.key)] = item
+            self._ids[item.kind][item.key] = item.id
+
+        self.crop_growth_time = array('l', (c.growth_time for c in self.crops))
+        self.crop_revenue = array('l', (c.revenue for c in self.crops))
+        self.crop_water_per_day = array('l', (c.water_per_day for c in self.crops))
+        self.animal_production_value = array('l', (a.production_value for a in self.animals))
+        self.animal_upkeep_cost = array('l', (a.upkeep for a in self.animals))
+        self.animal_food_per_day = array('l', (a.food_per_day for a in self.animals))
+        self.building_water = array('l', (b.water_provided for b in self.buildings))
+        self.building_crop_revenue_bonus = array('d', (b.crop_revenue_bonus for b in self.buildings))
+        self.building_production_speed = array('d', (b.production_speed for b in self.buildings))
+
+    def get(self, kind, key):
+        """Compiled item for a placeable type, or None"""
+        return self._items.get((kind, key))
+
+    def ids(self, kind):
+        return self._ids[kind]
+
+    def animal_counts(self, animals):
+        """An {animal_type: count} dict as a vector indexed by animal id"""
+        counts = [0] * len(self.animals)
+        ids = self._ids['animal']
+        for key, count in animals.items():
+            if key in ids:
+                counts[ids[key]] = count
+        return counts
+
+    def animal_revenue(self, counts):
+        return sum(map(int.__mul__, self.animal_production_value, counts))
+
+    def animal_upkeep(self, counts):
+        return sum(map(int.__mul__, self.animal_upkeep_cost, counts))
+
+
+# Compiled once at import; the dict tables above stay the source of truth
+CATALOG = Catalog(CropType.CROPS, AnimalType.ANIMALS, BuildingType.BUILDINGS)
+
+
+ECONOMY_FIELDS = ('animal_revenue', 'animal_upkeep', 'food_per_day', 'water_supply',
+                  'crop_water', 'crop_bonus', 'production_speed')
+
+
+@dataclass(slots=True)
+class FarmEconomy:
+    """Running daily totals for one farm
+
+    Updated by a constant amount whenever an animal count changes, a crop
+    or building is placed or removed, or a crop ripens, so reading a farm's
+    economy never walks its animals or placements. compute() rebuilds the
+    same totals from scratch and is used to back-fill and check them.
+    """
+    animal_revenue: int = 0  # production_value of every animal, before bonuses
+    animal_upkeep: int = 0
+    food_per_day: int = 0  # food the herd eats each day
+    water_supply: int = 0  # water wells add each day
+    crop_water: int = 0  # water the crops not yet ready to harvest draw each day
+    crop_bonus: float = 1.0  # multiplier on crop revenue (silos)
+    production_speed: float = 1.0  # multiplier on animal production (windmills)
+
+    @classmethod
+    def compute(cls, placements, animals, day=None):
+        """Totals for (object_type, object_name, planted_day) placements and an
+        {animal_type: count} dict on `day`; crops ready by then draw no water
+        (day=None counts every crop as growing)"""
+        economy = cls()
+        for object_type, object_name, planted_day in placements:
+            crop = CATALOG.get('crop', object_name) if object_type == 'crop' else None
+            growing = day is None or crop is None or planted_day + crop.growth_time > day
+            economy.add_placement(object_type, object_name, growing=growing)
+        for animal_type, count in animals.items():
+            economy.add_animals(animal_type, count)
+        return economy
+
+    def add_animals(self, animal_type, count):
+        """Account for `count` more (or, if negative, fewer) animals of a type"""
+        item = CATALOG.get('animal', animal_type)
+        if item is None:
+            return
+        self.animal_revenue += item.production_value * count
+        self.animal_upkeep += item.upkeep * count
+        self.food_per_day += item.food_per_day * count
+
+    def add_placement(self, object_type, object_name, count=1, growing=True):
+        """Account for a crop or building being placed (count=1) or removed (count=-1)
+
+        A crop that is no longer growing draws no water. Animals are counted
+        through add_animals, from the farm's herd counts.
+        """
+        item = CATALOG.get(object_type, object_name)
+        if item is None:
+            return
+        if object_type == 'crop':
+            if growing:
+                self.crop_water += item.water_per_day * count
+        elif object_type == 'building':
+            self.water_supply += item.water_provided * count
+            # Rounded so repeated multiply/divide cannot drift away from the recompute
+            self.crop_bonus = round(self.crop_bonus * item.crop_revenue_bonus ** count, 9)
+            self.production_speed = round(self.production_speed * item.production_speed ** count, 9)
+
+    def ripen(self, crop_name):
+        """Account for a crop becoming ready to harvest, after which it draws no water"""
+        item = CATALOG.get('crop', crop_name)
+        if item is not None:
+            self.crop_water -= item.water_per_day
+
+    def harvest_revenue(self, crop):
+        """Gold a harvested CatalogItem crop earns with the silo bonus applied"""
+        return int(crop.revenue * self.crop_bonus)
+
+    def as_row(self):
+        return tuple(getattr(self, name) for name in ECONOMY_FIELDS)
+
+    def summary(self):
+        """Daily figures as reported by /api/calculate_economy"""
+        revenue = int(self.animal_revenue * self.production_speed)
+        return {
+            'revenue': revenue,
+            'expenses': self.animal_upkeep,
+            'net_income': revenue - self.animal_upkeep,
+            'crop_revenue_bonus': self.crop_bonus,
+            'production_speed': self.production_speed,
+            'food_per_day': -self.food_per_day,
+            'water_per_day': self.water_supply - self.crop_water
+        }
@@ -0,0 +1,306 @@
+"""
+Write-behind journal that group-commits farm writes from a background thread
+
+With the journal enabled, FarmStateCache.transaction() no longer writes to
+SQLite itself. It records what the transaction wrote as journal entries and
+returns. Entries are coalesced per row in memory; for example, only the
+last game_state written for a farm survives. A writer thread then flushes
+everything pending in one transaction, every `interval` seconds or as soon
+as `max_ops` entries are waiting, so many requests share one commit.
+
+The flush checks each farm's version with a compare-and-swap, as
+transaction() does without the journal. By then the request has already
+returned, so a farm that another process or a world tick changed in the
+meantime cannot be retried: its pending writes are dropped, logged and
+counted, and the on_conflict callbacks evict it from the cache. Run
+write-behind in a single process to avoid losing writes this way.
+
+A failed flush puts its entries back to be retried with the next one. With
+group durability, a request whose writes have been through FLUSH_ATTEMPTS
+failed flushes stops waiting and raises the error; its writes stay queued.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from game_models import RESOURCES
+
+
+log = logging.getLogger(__name__)
+
+
+# buffered: a request returns once its writes are queued (a crash loses at most one interval)
+# group:    a request waits until the batch holding its writes has committed; the
+#           writer commits back to back instead of on a timer
+DURABILITY_MODES = ('buffered', 'group')
+FLUSH_ATTEMPTS = 3  # failed flushes a group-durability request waits through before giving up
+
+
+class JournalWriter:
+    """Stands in for FarmRepository inside a write-behind transaction
+
+    Has the same write methods, but only records the calls as entries
+    keyed by the row they touch.
+    """
+
+    def __init__(self, user_id, farm=None):
+        self.user_id = user_id
+        self.farm = farm  # the cached farm being written, before this call applies
+        self.entries = {}  # row key -> value, last write wins
+        self.ops = 0
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.ops += 1
+
+    def update_game_state(self, resources):
+        state = {key: resources.get(key, 0) for key in RESOURCES}
+        for key, default in (('day', 1), ('season', 'Spring'), ('farm_level', 1), ('land_size', 100)):
+            state[key] = resources.get(key, default)
+        self._put(('state', self.user_id), state)
+
+    def add_resources(self, deltas):
+        # Entries are whole rows, so record the state the deltas leave the farm in;
+        # the per-farm lock already keeps other writers in this process out
+        state = self.farm.game_state()
+        for key, amount in deltas.items():
+            state[key] += amount
+        self.update_game_state(state)
+
+    def save_grid_placement(self, grid_x, grid_y, object_type, object_name,
+                            planted_day=0, land_required=1, data=None):
+        self._put(('cell', self.user_id, grid_x, grid_y),
+                  (grid_x, grid_y, object_type, object_name, planted_day, land_required, data))
+
+    def save_grid_placements(self, placements):
+        for placement in placements:
+            self.save_grid_placement(*placement)
+
+    def remove_grid_placement(self, grid_x, grid_y):
+        self._put(('cell', self.user_id, grid_x, grid_y), None)
+
+    def remove_grid_placements(self, cells):
+        for grid_x, grid_y in cells:
+            self.remove_grid_placement(grid_x, grid_y)
+
+    def update_animals(self, animal_type, count):
+        self._put(('animal', self.user_id, animal_type), count)
+
+    def save_economy(self, economy):
+        self._put(('economy', self.user_id), economy.as_row())
+
+    def set_version(self, version, expected):
+        self._put(('version', self.user_id), (expected, version))
+
+    def append_event(self, version, action, payload):
+        self._put(('event', self.user_id, version), (action, payload))
+
+    def save_farm_snapshot(self, version, snapshot):
+        self._put(('farm_snapshot', self.user_id), (version, snapshot))
+
+
+def merge(older, newer):
+    """Lay newer entries over older ones; a farm keeps the version its oldest entry expects"""
+    for key, value in newer.items():
+        if key[0] == 'version' and key in older:
+            value = (older[key][0], value[1])
+        older[key] = value
+
+
+class WriteBehindJournal:
+    """Queue of pending farm writes plus the thread that group-commits them"""
+
+    def __init__(self, db, interval=0.05, max_ops=1000, durability='buffered'):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'durability must be one of {DURABILITY_MODES}')
+        self.db = db
+        self.interval = interval  # seconds between flushes
+        self.max_ops = max_ops  # pending entries that trigger an early flush
+        self.durability = durability
+
+        self._pending = {}  # row key -> value
+        self._pending_users = set()
+        self._inflight_users = set()  # users whose entries are being written right now
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one flush at a time, in submission order
+        self._submitted = 0  # sequence number of the last submitted batch of entries
+        self._committed = 0  # highest sequence number known to be committed
+        self._failures = 0  # flushes that have failed, ever
+        self._error = None  # why the last flush failed
+        self._closed = False
+        # Called as callback(user_id) for a farm whose writes lost the version check
+        self.on_conflict = []
+
+        # Metrics
+        self.ops_submitted = 0
+        self.ops_coalesced = 0
+        self.rows_written = 0
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+        self.max_queue_depth = 0
+        self.conflicts = 0
+
+        self._thread = threading.Thread(target=self._run, name='farm-journal', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, writer):
+        """Queue everything a JournalWriter recorded as one atomic unit"""
+        if not writer.entries:
+            return
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Journal is closed')
+            before = len(self._pending)
+            merge(self._pending, writer.entries)
+            self._pending_users.add(writer.user_id)
+            self.ops_submitted += writer.ops
+            self.ops_coalesced += writer.ops - (len(self._pending) - before)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+            self._submitted += 1
+            ticket = self._submitted
+            # Group commit flushes as soon as anyone is waiting; whatever
+            # arrives during that commit goes into the next one
+            if len(self._pending) >= self.max_ops or self.durability == 'group':
+                self._cond.notify_all()
+
+            if self.durability == 'group':
+                # A flush that fails leaves the entries queued for the next one;
+                # stop waiting once the batch has failed FLUSH_ATTEMPTS times
+                failures = self._failures
+                while self._committed < ticket and not self._closed:
+                    if self._failures - failures >= FLUSH_ATTEMPTS:
+                        raise RuntimeError(f'Could not commit farm writes: {self._error}') from self._error
+                    self._cond.wait()
+
+    def settle(self, user_id):
+        """Flush now if user_id has writes that are not committed yet
+
+        Called by FarmDatabase before it reads or writes a farm directly,
+        so nothing ever sees the database behind the journal.
+        """
+        with self._cond:
+            waiting = user_id in self._pending_users or user_id in self._inflight_users
+        if waiting:
+            self.flush()
+
+    def flush(self):
+        """Write every pending entry in one transaction"""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                users, self._pending_users = self._pending_users, set()
+                ticket = self._submitted
+                self._inflight_users = users
+            try:
+                if batch:
+                    self._write(batch)
+            except BaseException as e:
+                # Put the entries back underneath anything newer and retry next flush
+                with self._cond:
+                    merge(batch, self._pending)
+                    self._pending = batch
+                    self._pending_users |= users
+                    self._inflight_users = set()
+                    if batch:
+                        self._failures += 1
+                        self._error = e
+                        self._cond.notify_all()
+                raise
+            with self._cond:
+                self._inflight_users = set()
+                self._committed = max(self._committed, ticket)
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        states, versions, economies = {}, {}, {}
+        saved, removed, animals = {}, {}, {}
+        events, snapshots = {}, {}
+        for key, value in batch.items():
+            kind, user_id = key[0], key[1]
+            if kind == 'state':
+                states[user_id] = value
+            elif kind == 'version':
+                versions[user_id] = value
+            elif kind == 'economy':
+                economies[user_id] = value
+            elif kind == 'cell':
+                if value is None:
+                    removed.setdefault(user_id, []).append(key[2:])
+                else:
+                    saved.setdefault(user_id, []).append(value)
+            elif kind == 'animal':
+                animals.setdefault(user_id, []).append((key[2], value))
+            elif kind == 'event':
+                events.setdefault(user_id, []).append((key[2], *value))
+            elif kind == 'farm_snapshot':
+                snapshots[user_id] = value
+
+        start = time.perf_counter()
+        with self.db.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conflicted = self.db.write_batch(conn, states, versions, economies, saved, removed,
+                                                 animals, events, snapshots)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+        elapsed = time.perf_counter() - start
+
+        for user_id in conflicted:
+            log.warning('Dropped journaled writes for farm %s: changed since version %s',
+                        user_id, versions[user_id][0])
+            for callback in self.on_conflict:
+                callback(user_id)
+        self.conflicts += len(conflicted)
+        self.commits += 1
+        self.rows_written += len(batch)
+        self.commit_seconds += elapsed
+        self.max_commit_seconds = max(self.max_commit_seconds, elapsed)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self.durability == 'group':
+                    while not self._pending and not self._closed:
+                        self._cond.wait()
+                elif len(self._pending) < self.max_ops and not self._closed:
+                    self._cond.wait(self.interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Write-behind flush failed, will retry')
+                if not closed:
+                    time.sleep(self.interval)
+            if closed:
+                return
+
+    def close(self):
+        """Flush whatever is left and stop the writer thread"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def stats(self):
+        """Queue depth, coalescing and commit latency counters"""
+        with self._cond:
+            return {
+                'durability': self.durability,
+                'queue_depth': len(self._pending),
+                'max_queue_depth': self.max_queue_depth,
+                'ops_submitted': self.ops_submitted,
+                'ops_coalesced': self.ops_coalesced,
+                'rows_written': self.rows_written,
+                'commits': self.commits,
+                'avg_commit_ms': self.commit_seconds / self.commits * 1000 if self.commits else 0.0,
+                'max_commit_ms': self.max_commit_seconds * 1000,
+                'conflicts': self.conflicts
+            }
@@ -0,0 +1,91 @@
+"""
+Per-farm index of crops keyed by the day they become ready to harvest
+"""
+import heapq
+
+from farm_grid import CellMap
+
+
+class MaturityIndex:
+    """Timing wheel of crop cells bucketed by ready day
+
+    Cells that are not ready yet sit in a bucket for their ready day; a
+    min-heap of bucket days lets advance() move whole buckets into the ready
+    set as days pass. Listing ready crops therefore costs O(ready crops),
+    and adding or dropping a crop is O(1) (plus a heap push for a new day).
+    Cells are kept in CellMaps (cell -> True for the sets), so copy() only
+    costs one entry per chunk and per pending day.
+    """
+
+    def __init__(self):
+        self.day = 0  # last day advance() was called with
+        self.buckets = {}  # ready_day -> CellMap of (grid_x, grid_y)
+        self.owned = set()  # days whose bucket no copy shares
+        self.days = []  # heap of ready days that have a bucket
+        self.ready = CellMap()
+        self.ready_day = CellMap()  # (grid_x, grid_y) -> ready_day
+
+    def copy(self):
+        index = MaturityIndex()
+        index.day = self.day
+        index.buckets = dict(self.buckets)
+        self.owned = set()
+        index.days = list(self.days)
+        index.ready = self.ready.copy()
+        index.ready_day = self.ready_day.copy()
+        return index
+
+    def _bucket(self, ready_day):
+        bucket = self.buckets.get(ready_day)
+        if bucket is None:
+            bucket = self.buckets[ready_day] = CellMap()
+            heapq.heappush(self.days, ready_day)
+        elif ready_day not in self.owned:
+            bucket = self.buckets[ready_day] = bucket.copy()
+        self.owned.add(ready_day)
+        return bucket
+
+    def add(self, cell, ready_day):
+        self.discard(cell)
+        self.ready_day[cell] = ready_day
+        if ready_day <= self.day:
+            self.ready[cell] = True
+            return
+        self._bucket(ready_day)[cell] = True
+
+    def discard(self, cell):
+        ready_day = self.ready_day.pop(cell, None)
+        if ready_day is None:
+            return
+        if ready_day <= self.day:
+            self.ready.pop(cell, None)
+            return
+        bucket = self._bucket(ready_day)
+        bucket.pop(cell, None)
+        if not bucket:
+            # The day stays in the heap and is skipped when it comes up
+            del self.buckets[ready_day]
+
+    def advance(self, day):
+        """Move every bucket due on or before `day` into the ready set; returns the cells moved"""
+        ripened = []
+        while self.days and self.days[0] <= day:
+            bucket = self.buckets.pop(heapq.heappop(self.days), None)
+            if bucket:
+                for cell in bucket:
+                    self.ready[cell] = True
+                ripened.extend(bucket)
+        self.day = max(self.day, day)
+        return ripened
+
+    def ready_cells(self, day):
+        self.advance(day)
+        return self.ready
+
+    def is_ready(self, cell, day):
+        ready_day = self.ready_day.get(cell)
+        return ready_day is not None and ready_day <= day
+
+    def ready_after(self, since_day, day):
+        """Cells that became ready after since_day, up to and including day"""
+        return [cell for cell in self.ready_cells(day) if self.ready_day[cell] > since_day]
@@ -0,0 +1,250 @@
+"""
+Lightweight in-process metrics, exported in Prometheus text format
+
+Histograms and counters are plain lists and dicts behind one lock, so
+recording a value costs a couple of microseconds and the layer can stay on
+in production. What is recorded:
+  * latency and status of every Flask request, by route (instrument_app)
+  * time, SQL statements, rows returned and rows changed for every
+    FarmRepository method and FarmDatabase method that runs SQL (instrument)
+  * connections opened (connection_opened) and statements executed, via an
+    SQLite trace callback (trace)
+Anything that already keeps its own counters (the farm cache, the journal)
+is read at scrape time through add_collector().
+
+FARM_METRICS=0 turns all of it off; FARM_SERVER_TIMING=1 also adds a
+Server-Timing header with the request's database time to every response.
+"""
+import functools
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+
+ENABLED = os.environ.get('FARM_METRICS', '1') != '0'
+SERVER_TIMING = os.environ.get('FARM_SERVER_TIMING', '0') == '1'
+
+# Upper bounds in seconds; the last bucket is +Inf
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+QUERY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def labels(self, labels):
+        """The series for one set of label values; callers on a hot path keep it"""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+        return series
+
+    def observe(self, labels, value):
+        self.observe_series(self.labels(labels), value)
+
+    def observe_series(self, series, value):
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self.series.items()):
+            base = _labels(self.label_names, labels)
+            running = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series):
+                running += count
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, le=bound)} {running}')
+            lines.append(f'{self.name}_sum{base} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{base} {running}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter keyed by a tuple of label values"""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = {}  # labels -> [value]
+
+    def labels(self, labels=()):
+        """The one-item list holding one series' value; callers on a hot path keep it"""
+        return self.series.setdefault(labels, [0])
+
+    def inc(self, labels=(), amount=1):
+        self.labels(labels)[0] += amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_labels(self.label_names, labels)} {value}'
+                     for labels, (value,) in sorted(self.series.items()))
+        return lines
+
+
+def _labels(names, values, le=None):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _ThreadState(threading.local):
+    statements = 0  # executed on this thread, ever
+    depth = 0  # instrumented calls currently on the stack
+    db_seconds = 0.0  # outermost database time in the current request
+    db_calls = 0
+    changes = 0  # rows changed on connections this thread has given back, ever
+
+
+_lock = threading.Lock()
+_local = _ThreadState()
+_collectors = []
+
+requests = Histogram('farm_http_request_seconds', 'Time spent handling a request',
+                     ('route', 'method'), REQUEST_BUCKETS)
+responses = Counter('farm_http_responses_total', 'Responses sent', ('route', 'method', 'status'))
+queries = Histogram('farm_db_call_seconds', 'Time spent in one database method call',
+                    ('method',), QUERY_BUCKETS)
+statements = Counter('farm_db_statements_total', 'SQL statements executed', ('method',))
+rows_read = Counter('farm_db_rows_read_total', 'Rows returned by database methods', ('method',))
+rows_written = Counter('farm_db_rows_written_total', 'Rows inserted, updated or deleted', ('method',))
+connections = Counter('farm_db_connections_opened_total', 'SQLite connections opened')
+METRICS = (requests, responses, queries, statements, rows_read, rows_written, connections)
+
+
+def trace(sql):
+    """SQLite trace callback: count one executed statement for the current thread"""
+    _local.statements += 1
+
+
+def connection_opened(conn):
+    """Count a new connection and start counting its statements"""
+    if ENABLED:
+        conn.set_trace_callback(trace)
+        with _lock:
+            connections.inc()
+
+
+def connection_released(changes):
+    """Count rows a borrowed connection changed, for the method that borrowed it"""
+    _local.changes += changes
+
+
+def count_rows(result):
+    """Rows a database method returned: the length of a list, else one row or none"""
+    if result is None:
+        return 0
+    return len(result) if isinstance(result, list) else 1
+
+
+def instrument(cls, names, rows=None):
+    """Wrap the named methods of cls so each call records its time, statements and rows
+
+    rows maps a method name to a function counting the rows in its result,
+    for methods that return rows some other way than count_rows() expects.
+    Only the outermost instrumented call on a thread adds to the request's
+    database time, so nested calls (a wrapper calling a repository
+    method) are not counted twice there.
+    """
+    if not ENABLED:
+        return
+    rows = rows or {}
+    for name in names:
+        method = getattr(cls, name)
+        setattr(cls, name, _timed(method, (name,), rows.get(name, count_rows)))
+
+
+def _timed(method, labels, count):
+    seconds = queries.labels(labels)
+    executed_total = statements.labels(labels)
+    read_total = rows_read.labels(labels)
+    written_total = rows_written.labels(labels)
+    observe = queries.observe_series
+
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        local = _local
+        depth = local.depth
+        before = local.statements
+        # Rows changed on the connection the method was handed (a
+        # repository's, or write_batch's argument) or borrowed and gave back
+        conn = getattr(self, 'conn', None) or next(
+            (arg for arg in args if isinstance(arg, sqlite3.Connection)), None)
+        changes = conn.total_changes if conn is not None else 0
+        released = local.changes
+        local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            local.depth = depth
+            if not depth:
+                local.db_seconds += elapsed
+                local.db_calls += 1
+        executed = local.statements - before
+        read = count(result)
+        written = local.changes - released
+        if conn is not None:
+            written += conn.total_changes - changes
+        with _lock:
+            observe(seconds, elapsed)
+            executed_total[0] += executed
+            read_total[0] += read
+            written_total[0] += written
+        return result
+    return timed
+
+
+def add_collector(collect):
+    """Register a function returning [(name, type, help, value)] to read at scrape time"""
+    _collectors.append(collect)
+
+
+def render():
+    """Every metric in Prometheus text exposition format"""
+    with _lock:
+        lines = [line for metric in METRICS for line in metric.render()]
+    for collect in _collectors:
+        for name, kind, help_text, value in collect():
+            lines.extend((f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}'))
+    return '\n'.join(lines) + '\n'
+
+
+def instrument_app(app):
+    """Time every request of a Flask app and optionally add a Server-Timing header"""
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        _local.db_seconds = 0.0
+        _local.db_calls = 0
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        with _lock:
+            requests.observe((route, request.method), elapsed)
+            responses.inc((route, request.method, response.status_code))
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = (
+                f'db;dur={_local.db_seconds * 1000:.3f};desc="{_local.db_calls} calls", '
+                f'app;dur={elapsed * 1000:.3f}')
+        return response
@@ -0,0 +1,181 @@
+"""
+In-process publish/subscribe of farm changes, for the /api/stream SSE endpoint
+
+FarmStateCache hands every committed transaction to publish_commit(),
+which only builds events for farms somebody is subscribed to, so a farm
+nobody watches costs one dict lookup per transaction. Events, as
+Server-Sent Events:
+
+    change  id: the farm version the transaction produced
+            {"v", "action", "resources": {name: new value}, "delta": {name: change},
+             "day", "season", "cells": [placement or {grid_x, grid_y, removed}],
+             "animals": {type: count}}, with only the parts that changed
+    ready   {"day", "cells": [[x, y], ...]} crops that became ready to harvest
+    tick    {"day", "season", "days", "delta", "ready_crops"} the result of advancing days
+    sync    {"v", "full", ...} what a client is missing: sent when it connects
+            (Last-Event-ID or ?since= being the last version it has) and
+            after its buffer overflowed; see sync_event()
+
+Only change events carry an id, so a reconnecting EventSource resumes
+from the last version it applied. Each subscription holds at most
+max_buffer formatted events; a client that falls that far behind loses
+them and is sent one sync instead.
+
+Events are published in the process that committed the change. With
+several worker processes (or a world tick), a client hears about changes
+made elsewhere when it next reconnects and is synced.
+"""
+import json
+import threading
+from collections import deque
+
+
+MAX_BUFFER = 64  # events held per subscriber before it is resynced instead
+HEARTBEAT_SECONDS = 15  # idle time before a keep-alive comment is sent
+STREAM_SECONDS = 300  # a stream is closed after this long; the client reconnects and resumes
+RETRY_MS = 3000  # reconnect delay suggested to EventSource
+
+
+def format_event(kind, data, event_id=None):
+    """One Server-Sent Event"""
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {kind}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def sync_event(farm, since):
+    """A sync event bringing a client at version `since` (None: nothing) up to the farm"""
+    delta = farm.delta_since(since) if since is not None else None
+    if delta is not None:
+        data = {'v': farm.version, 'full': False, **delta}
+    else:
+        data = {
+            'v': farm.version,
+            'full': True,
+            'game_state': farm.game_state(),
+            'placements': farm.placement_list(),
+            'animals': farm.animals
+        }
+    return format_event('sync', data, farm.version)
+
+
+class Subscription:
+    """One client's queue of formatted events for one farm"""
+
+    def __init__(self, user_id, max_buffer):
+        self.user_id = user_id
+        self.max_buffer = max_buffer
+        self.version = None  # last farm version the client has been sent
+        self._events = deque()  # (version or None, text)
+        self._overflowed = False
+        self._cond = threading.Condition()
+
+    def put(self, version, text):
+        """Queue one event; returns True if it overflowed the buffer"""
+        with self._cond:
+            if self._overflowed:
+                return False
+            overflowed = len(self._events) >= self.max_buffer
+            if overflowed:
+                self._events.clear()
+                self._overflowed = True
+            else:
+                self._events.append((version, text))
+            self._cond.notify()
+            return overflowed
+
+    def wait(self, timeout):
+        """Formatted events published since the last call, waiting up to `timeout`
+        seconds for one; None if the buffer overflowed and the client needs a sync"""
+        with self._cond:
+            if not self._events and not self._overflowed:
+                self._cond.wait(timeout)
+            if self._overflowed:
+                self._overflowed = False
+                return None
+            events, self._events = self._events, deque()
+
+        texts = []
+        for version, text in events:
+            if version is not None:
+                # Skip changes the client already has from the sync it was sent
+                if self.version is not None and version <= self.version:
+                    continue
+                self.version = version
+            texts.append(text)
+        return texts
+
+
+class FarmBroker:
+    """Subscriptions by farm, and the publishing side the mutation paths call"""
+
+    def __init__(self, max_buffer=MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self._subscribers = {}  # user_id -> set of Subscription
+        self._lock = threading.Lock()
+        self.published = 0
+        self.overflows = 0
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id, self.max_buffer)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, user_id, kind, data, event_id=None):
+        """Send one event to every subscriber of a farm"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        if not subscribers:
+            return
+        text = format_event(kind, data, event_id)
+        overflows = sum(subscription.put(event_id, text) for subscription in subscribers)
+        with self._lock:
+            self.published += 1
+            self.overflows += overflows
+
+    def publish_commit(self, farm, session, action):
+        """FarmStateCache listener: publish a committed transaction as change (and ready) events"""
+        if farm.user_id not in self._subscribers:
+            return
+        before = session.before
+        after = farm.game_state()
+        data = {'v': farm.version, 'action': action}
+        if session.changed_state:
+            changed = [key for key in farm.resources if after[key] != before.get(key)]
+            if changed:
+                data['resources'] = {key: after[key] for key in changed}
+                data['delta'] = {key: after[key] - before.get(key, 0) for key in changed}
+            for key in ('day', 'season', 'farm_level', 'land_size'):
+                if after[key] != before.get(key):
+                    data[key] = after[key]
+        if session.changed_cells:
+            data['cells'] = [
+                farm.placements[cell].to_dict() if cell in farm.placements
+                else {'grid_x': cell[0], 'grid_y': cell[1], 'removed': True}
+                for cell in sorted(session.changed_cells)
+            ]
+        if session.changed_animals:
+            data['animals'] = {name: farm.animals.get(name, 0) for name in session.changed_animals}
+        self.publish(farm.user_id, 'change', data, farm.version)
+
+        if after['day'] > before.get('day', after['day']):
+            ready = farm.maturity.ready_after(before['day'], after['day'])
+            if ready:
+                self.publish(farm.user_id, 'ready', {'day': after['day'], 'cells': sorted(ready)})
+
+    def stats(self):
+        with self._lock:
+            return {
+                'farms': len(self._subscribers),
+                'subscribers': sum(len(s) for s in self._subscribers.values()),
+                'published': self.published,
+                'overflows': self.overflows
+            }
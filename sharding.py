@@ -0,0 +1,260 @@
+"""
+Farms spread over several SQLite files so writes to different shards never share a lock
+
+Every user id carries its shard in the low SHARD_BITS bits,
+(local_id << SHARD_BITS) | shard, so routing a request is a bit mask and
+needs no lookup table. New users go to the shard their username hashes to,
+which also keeps usernames unique without a shared directory; users named
+after their own id (see database.PLAYER_NAME) can go to any shard.
+
+Run as a script to split an existing database (or re-split a set of shards)
+into a new set of shard files:
+    python sharding.py farm_game.db --shards 4
+    python sharding.py farm_game.shard*.db --shards 8 --dest farm_game_v2.db
+"""
+import argparse
+import csv
+import itertools
+import os
+import sqlite3
+import zlib
+from contextlib import contextmanager
+
+from database import PLAYER_NAME, FarmDatabase
+
+
+SHARD_BITS = 8  # up to 256 shards
+SHARD_MASK = (1 << SHARD_BITS) - 1
+
+
+def shard_path(db_name, shard):
+    """File holding one shard, e.g. farm_game.db -> farm_game.shard3.db"""
+    stem, ext = os.path.splitext(db_name)
+    return f'{stem}.shard{shard}{ext}'
+
+
+def shard_of(user_id):
+    return user_id & SHARD_MASK
+
+
+def shard_for_username(username, shards):
+    # crc32 rather than hash() so the choice is stable across processes
+    return zlib.crc32(username.encode('utf-8')) % shards
+
+
+def player_name_id(username):
+    """The id in a name create_user() made up from one, or None"""
+    prefix = PLAYER_NAME.format('')
+    if username.startswith(prefix) and username[len(prefix):].isdigit():
+        return int(username[len(prefix):])
+    return None
+
+
+class ShardedJournal:
+    """Routes write-behind submissions to the journal of the farm's own shard"""
+
+    def __init__(self, db):
+        self.db = db
+        # Shared with every shard's journal, see WriteBehindJournal.on_conflict
+        self.on_conflict = []
+        for shard in db.shards:
+            shard.journal.on_conflict = self.on_conflict
+
+    def submit(self, writer):
+        self.db.shard(writer.user_id).journal.submit(writer)
+
+    def settle(self, user_id):
+        self.db.shard(user_id).journal.settle(user_id)
+
+    def flush(self):
+        for shard in self.db.shards:
+            shard.journal.flush()
+
+    def close(self):
+        for shard in self.db.shards:
+            shard.journal.close()
+
+    def stats(self):
+        """Per-shard journal counters plus the total queue depth"""
+        shards = [shard.journal.stats() for shard in self.db.shards]
+        return {
+            'queue_depth': sum(s['queue_depth'] for s in shards),
+            'commits': sum(s['commits'] for s in shards),
+            'conflicts': sum(s['conflicts'] for s in shards),
+            'shards': shards
+        }
+
+
+class ShardedFarmDatabase:
+    """Same interface as FarmDatabase, over one FarmDatabase per shard file
+
+    Each shard has its own connection pool and, with write-behind enabled,
+    its own journal and writer thread.
+    """
+
+    def __init__(self, db_name='farm_game.db', shards=4, pooled=True, pool_size=8, pragmas=None):
+        if not 1 <= shards <= SHARD_MASK + 1:
+            raise ValueError(f'shards must be between 1 and {SHARD_MASK + 1}')
+        self.db_name = db_name
+        self.shards = [
+            FarmDatabase(shard_path(db_name, i), pooled=pooled, pool_size=pool_size,
+                         shard_id=i, shard_bits=SHARD_BITS, pragmas=pragmas)
+            for i in range(shards)
+        ]
+        self.journal = None
+        self._next_shard = itertools.count()
+
+    def shard(self, user_id):
+        """The FarmDatabase that owns user_id"""
+        index = shard_of(user_id)
+        if index >= len(self.shards):
+            raise KeyError(f'User {user_id} belongs to shard {index}, which does not exist')
+        return self.shards[index]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def enable_write_behind(self, **options):
+        for shard in self.shards:
+            shard.enable_write_behind(**options)
+        self.journal = ShardedJournal(self)
+
+    def create_user(self, username=None):
+        """Create a new user on the shard its username hashes to
+
+        Users created without a username are named after their id, so any
+        shard will do; they are dealt out round-robin.
+        """
+        if username is None:
+            return self.shards[next(self._next_shard) % len(self.shards)].create_user()
+        return self.shards[shard_for_username(username, len(self.shards))].create_user(username)
+
+    def get_user_id(self, username):
+        user_id = player_name_id(username)
+        if user_id is not None:
+            if shard_of(user_id) >= len(self.shards):
+                return None
+            return self.shard(user_id).get_user_id(username)
+        return self.shards[shard_for_username(username, len(self.shards))].get_user_id(username)
+
+    @contextmanager
+    def unit_of_work(self, user_id):
+        with self.shard(user_id).unit_of_work(user_id) as repo:
+            yield repo
+
+    @contextmanager
+    def read(self, user_id):
+        with self.shard(user_id).read(user_id) as repo:
+            yield repo
+
+    def settle(self, user_id):
+        self.shard(user_id).settle(user_id)
+
+    def get_game_state(self, user_id):
+        return self.shard(user_id).get_game_state(user_id)
+
+    def get_grid_placements(self, user_id):
+        return self.shard(user_id).get_grid_placements(user_id)
+
+    def get_animals(self, user_id):
+        return self.shard(user_id).get_animals(user_id)
+
+    def get_economy(self, user_id):
+        return self.shard(user_id).get_economy(user_id)
+
+
+def _columns(conn, table, skip):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})') if row[1] not in skip]
+
+
+def reshard(sources, dest, shards):
+    """Copy every farm in the source files into a fresh set of shard files
+
+    Users are re-assigned to shards by username and get new ids (users
+    named after their id are renamed to match); returns
+    {(source file, old user_id): new user_id}.
+    """
+    for i in range(shards):
+        if os.path.exists(shard_path(dest, i)):
+            raise FileExistsError(f'{shard_path(dest, i)} already exists')
+
+    target = ShardedFarmDatabase(dest, shards=shards, pooled=False)
+    conns = [shard.get_connection() for shard in target.shards]
+    next_local = [1] * shards
+    id_map = {}
+    try:
+        for conn in conns:
+            conn.execute('BEGIN IMMEDIATE')
+
+        for source in sources:
+            # Opening it through FarmDatabase brings the source up to the current schema
+            FarmDatabase(source, pooled=False)
+            src = sqlite3.connect(source)
+            state_columns = _columns(src, 'game_state', ('state_id', 'user_id'))
+            placement_columns = _columns(src, 'grid_placements', ('placement_id', 'user_id'))
+            animal_columns = _columns(src, 'farm_animals', ('animal_id', 'user_id'))
+            slot_columns = _columns(src, 'save_slots', ('user_id',))
+            event_columns = _columns(src, 'farm_events', ('user_id',))
+            farm_snapshot_columns = _columns(src, 'farm_snapshots', ('user_id',))
+
+            for old_id, username, created_at in src.execute(
+                    'SELECT user_id, username, created_at FROM users ORDER BY user_id').fetchall():
+                if player_name_id(username) is not None:
+                    # Named after its id, so it follows the id to any shard
+                    shard = len(id_map) % shards
+                    new_id = (next_local[shard] << SHARD_BITS) | shard
+                    username = PLAYER_NAME.format(new_id)
+                else:
+                    shard = shard_for_username(username, shards)
+                    new_id = (next_local[shard] << SHARD_BITS) | shard
+                next_local[shard] += 1
+                id_map[(source, old_id)] = new_id
+                conn = conns[shard]
+
+                conn.execute('INSERT INTO users (user_id, username, created_at) VALUES (?, ?, ?)',
+                             (new_id, username, created_at))
+                for table, columns in (('game_state', state_columns),
+                                       ('grid_placements', placement_columns),
+                                       ('farm_animals', animal_columns),
+                                       ('save_slots', slot_columns),
+                                       ('farm_events', event_columns),
+                                       ('farm_snapshots', farm_snapshot_columns)):
+                    rows = src.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE user_id = ?',
+                                       (old_id,)).fetchall()
+                    conn.executemany(
+                        f'INSERT INTO {table} (user_id, {", ".join(columns)}) '
+                        f'VALUES (?, {", ".join("?" * len(columns))})',
+                        [(new_id, *row) for row in rows])
+            src.close()
+
+        for conn in conns:
+            conn.commit()
+    except BaseException:
+        for conn in conns:
+            conn.rollback()
+        raise
+    finally:
+        for conn in conns:
+            conn.close()
+    return id_map
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split farm databases into shard files')
+    parser.add_argument('sources', nargs='+', help='database or shard files to read')
+    parser.add_argument('--shards', type=int, required=True)
+    parser.add_argument('--dest', default='farm_game.db',
+                        help='base name of the new shard files (default: farm_game.db)')
+    args = parser.parse_args()
+
+    id_map = reshard(args.sources, args.dest, args.shards)
+    map_path = os.path.splitext(args.dest)[0] + '.idmap.csv'
+    with open(map_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['source', 'old_user_id', 'new_user_id'])
+        for (source, old_id), new_id in sorted(id_map.items()):
+            writer.writerow([source, old_id, new_id])
+    print(f'Copied {len(id_map)} farms into {args.shards} shards; id map written to {map_path}')
+    # Session cookies hold the old ids, so existing sessions must not be reused
+    print('User ids changed: rotate the app secret key so old sessions start fresh.')
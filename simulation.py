@@ -0,0 +1,225 @@
+"""
+Day-advance simulation for farms
+
+The per-type arrays of the compiled game_models catalog are turned into
+NumPy coefficient matrices (resources x types), so advancing a farm one day
+is a few matrix-vector products over per-type count vectors instead of a
+Python loop over every crop and animal.
+"""
+import numpy as np
+
+from farm_state import RESOURCE_KEYS
+from game_models import CATALOG, RESOURCE_IDS, GameEconomy
+
+
+RESOURCE_INDEX = RESOURCE_IDS
+GOLD = RESOURCE_INDEX['gold']
+FOOD = RESOURCE_INDEX['food']
+WATER = RESOURCE_INDEX['water']
+
+CROP_NAMES = [c.key for c in CATALOG.crops]
+ANIMAL_NAMES = [a.key for a in CATALOG.animals]
+BUILDING_NAMES = [b.key for b in CATALOG.buildings]
+CROP_IDS = CATALOG.ids('crop')
+ANIMAL_IDS = CATALOG.ids('animal')
+BUILDING_IDS = CATALOG.ids('building')
+
+
+def _matrix(rows):
+    """resources x types matrix with the given rows taken from per-type catalog arrays"""
+    columns = len(next(iter(rows.values())))
+    matrix = np.zeros((len(RESOURCE_KEYS), columns))
+    for resource, values in rows.items():
+        matrix[RESOURCE_INDEX[resource]] = values
+    return matrix
+
+
+CROP_GROWTH_TIME = np.array(CATALOG.crop_growth_time)
+
+# Daily draw of a growing crop
+CROP_DRAW = _matrix({'water': CATALOG.crop_water_per_day})
+
+# Daily output of a fed animal, and what every animal costs to keep
+ANIMAL_YIELD = _matrix({'gold': CATALOG.animal_production_value})
+ANIMAL_DRAW = _matrix({
+    'gold': CATALOG.animal_upkeep_cost,
+    'food': CATALOG.animal_food_per_day,
+})
+
+BUILDING_YIELD = _matrix({'water': CATALOG.building_water})
+# Multiplier each building applies to animal production (windmill: 1.5)
+BUILDING_PRODUCTION_SPEED = np.array(CATALOG.building_production_speed)
+
+
+class FarmVectors:
+    """A farm flattened into the arrays the simulation works on"""
+
+    __slots__ = ('resources', 'day', 'crop_ids', 'ready_day',
+                 'animal_counts', 'building_counts')
+
+    def __init__(self, resources, day, crop_ids, ready_day, animal_counts, building_counts):
+        self.resources = resources  # int64[len(RESOURCE_KEYS)]
+        self.day = day
+        self.crop_ids = crop_ids  # int array, one entry per planted crop
+        self.ready_day = ready_day  # day each of those crops matures
+        self.animal_counts = animal_counts
+        self.building_counts = building_counts
+
+    @classmethod
+    def from_farm(cls, farm):
+        crops, buildings = [], []
+        for p in farm.placements.values():
+            if p.object_type == 'crop':
+                crops.append((p.object_name, p.planted_day))
+            elif p.object_type == 'building':
+                buildings.append(p.object_name)
+        return cls.from_rows([farm.resources[key] for key in RESOURCE_KEYS], farm.day,
+                             crops, buildings, farm.animals)
+
+    @classmethod
+    def from_rows(cls, resources, day, crops, buildings, animals):
+        """Build from plain rows: resource values in RESOURCE_KEYS order,
+        (crop name, planted_day) pairs, building names and {animal: count}"""
+        crop_ids, planted_day, building_ids = [], [], []
+        for name, planted in crops:
+            if name in CROP_IDS:
+                crop_ids.append(CROP_IDS[name])
+                planted_day.append(planted)
+        for name in buildings:
+            if name in BUILDING_IDS:
+                building_ids.append(BUILDING_IDS[name])
+
+        crop_ids = np.array(crop_ids, dtype=np.intp)
+        animal_counts = np.zeros(len(ANIMAL_NAMES))
+        for name, count in animals.items():
+            if name in ANIMAL_IDS:
+                animal_counts[ANIMAL_IDS[name]] = count
+
+        return cls(
+            np.array(resources, dtype=np.int64),
+            day,
+            crop_ids,
+            np.array(planted_day, dtype=np.int64) + CROP_GROWTH_TIME[crop_ids],
+            animal_counts,
+            np.bincount(np.array(building_ids, dtype=np.intp), minlength=len(BUILDING_NAMES)),
+        )
+
+
+class Simulation:
+    """Advances farms one day at a time
+
+    Each day, in order:
+      * crops that have not matured yet draw their water_per_day
+      * wells add the water they provide
+      * animals eat food_per_day; if the food stock covers the whole herd
+        they produce production_value gold (scaled by windmills), otherwise
+        they produce nothing that day
+      * every animal costs its upkeep in gold
+    Resources never go below zero. Crops mature on planted_day + growth_time.
+    """
+
+    def step(self, vectors):
+        """Advance a FarmVectors by one day in place and return the resource delta"""
+        growing = vectors.crop_ids[vectors.ready_day > vectors.day]
+        crop_counts = np.bincount(growing, minlength=len(CROP_NAMES))
+
+        draw = CROP_DRAW @ crop_counts + ANIMAL_DRAW @ vectors.animal_counts
+        gain = BUILDING_YIELD @ vectors.building_counts
+        if vectors.resources[FOOD] >= draw[FOOD]:
+            speed = np.prod(BUILDING_PRODUCTION_SPEED ** vectors.building_counts)
+            gain = gain + ANIMAL_YIELD @ vectors.animal_counts * speed
+
+        before = vectors.resources
+        vectors.resources = np.maximum(before + np.floor(gain - draw).astype(np.int64), 0)
+        vectors.day += 1
+        return vectors.resources - before
+
+    def advance(self, vectors, days):
+        """Advance a FarmVectors by `days` days in closed form
+
+        Gives exactly the same end state as calling step() `days` times, but
+        costs O(crops + maturity days) instead of O(days x crops):
+
+          * food drops by the herd's constant daily demand, so the number of
+            days the animals are fed is food // demand
+          * gold changes by a constant amount on fed days and another on
+            unfed days; fed days always come first
+          * water demand only changes on the days crops mature, so water is
+            a sequence of constant-rate segments between those days
+
+        A resource clamped at zero stays at zero while its daily change is
+        negative, so each constant-rate segment is max(0, start + length * rate).
+        """
+        start_day = vectors.day
+        end_day = start_day + days
+        before = vectors.resources
+        resources = before.copy()
+
+        # Food and gold
+        animal_draw = ANIMAL_DRAW @ vectors.animal_counts
+        food_demand = animal_draw[FOOD]
+        upkeep = int(animal_draw[GOLD])
+        if food_demand > 0:
+            fed_days = int(min(days, resources[FOOD] // food_demand))
+        else:
+            fed_days = days
+        resources[FOOD] = max(0, int(resources[FOOD] - days * food_demand))
+
+        speed = np.prod(BUILDING_PRODUCTION_SPEED ** vectors.building_counts)
+        production = int(np.floor((ANIMAL_YIELD @ vectors.animal_counts)[GOLD] * speed))
+        gold = max(0, int(resources[GOLD]) + fed_days * (production - upkeep))
+        resources[GOLD] = max(0, gold - (days - fed_days) * upkeep)
+
+        # Water, one segment per distinct maturity day inside the window
+        wells = int((BUILDING_YIELD @ vectors.building_counts)[WATER])
+        still_growing = vectors.ready_day > start_day
+        ready_days, inverse = np.unique(vectors.ready_day[still_growing], return_inverse=True)
+        crop_water = CROP_DRAW[WATER].astype(np.int64)[vectors.crop_ids[still_growing]]
+        maturing_water = np.bincount(inverse, weights=crop_water, minlength=len(ready_days))
+
+        water = int(resources[WATER])
+        demand = int(crop_water.sum())
+        day = start_day
+        for ready_day, freed in zip(ready_days.tolist(), maturing_water.tolist()):
+            if ready_day >= end_day:
+                break
+            water = max(0, water + (ready_day - day) * (wells - demand))
+            demand -= int(freed)
+            day = ready_day
+        resources[WATER] = max(0, water + (end_day - day) * (wells - demand))
+
+        vectors.resources = resources
+        vectors.day = end_day
+        return resources - before
+
+    def tick(self, farm):
+        """Simulate one day for a farm and return the resulting game state
+
+        The farm itself is not modified; callers persist the returned state
+        (for example through FarmSession.update_game_state).
+        """
+        vectors = FarmVectors.from_farm(farm)
+        delta = self.step(vectors)
+        return self._result(farm, vectors, delta)
+
+    def fast_forward(self, farm, days):
+        """Simulate `days` days for a farm at once and return the resulting game state
+
+        Like tick(), the farm itself is not modified.
+        """
+        vectors = FarmVectors.from_farm(farm)
+        delta = self.advance(vectors, days)
+        return self._result(farm, vectors, delta)
+
+    @staticmethod
+    def _result(farm, vectors, delta):
+        game_state = farm.game_state()
+        for key, value in zip(RESOURCE_KEYS, vectors.resources.tolist()):
+            game_state[key] = value
+        game_state['day'] = vectors.day
+        game_state['season'] = GameEconomy.get_season(vectors.day)
+        return {
+            'game_state': game_state,
+            'delta': dict(zip(RESOURCE_KEYS, delta.tolist())),
+            'ready_crops': int(np.count_nonzero(vectors.ready_day <= vectors.day))
+        }
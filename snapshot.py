@@ -0,0 +1,193 @@
+"""
+Compact binary snapshots of a whole farm, for save slots and export/import
+
+A snapshot is a small header followed by a zlib-compressed payload:
+
+    header    magic b'FARM', format version (B)
+    payload   state      resources (q each, RESOURCES order), day (q),
+                         farm_level (H), land_size (I), farm version (Q),
+                         string count (H), animal count (H), placement count (I)
+              strings    every object type/name/season used, as a length (B) + UTF-8
+              season     string index (H)
+              animals    string index (H), count (I) per animal type
+              placements x, y, type index, name index, land_required (H each),
+                         planted_day (q) per placement
+              data       count (I), then placement index (I), length (I) and
+                         JSON bytes for the few placements carrying extra data
+
+Names are stored once in the string table, so a placement packs into 18
+bytes before compression. Economy totals and footprints are not stored;
+they are derived again when the snapshot is restored. Format 1 stored day
+as I and planted_day as i, too narrow for the int64 SQLite holds; it can
+still be read.
+"""
+import hashlib
+import hmac
+import json
+import struct
+import zlib
+from dataclasses import dataclass
+
+from game_models import RESOURCES
+
+
+MAGIC = b'FARM'
+FORMAT_VERSION = 2
+MAX_SNAPSHOT_BYTES = 4 * 1024 * 1024  # compressed; also caps what an import may upload
+MAX_PAYLOAD_BYTES = 64 * 1024 * 1024  # decompressed
+
+HEADER = struct.Struct('<4sB')
+STATE = struct.Struct(f'<{len(RESOURCES)}qqHIQHHI')
+STRING_LENGTH = struct.Struct('<B')
+SEASON = struct.Struct('<H')
+ANIMAL = struct.Struct('<HI')
+PLACEMENT = struct.Struct('<HHHHHq')
+COUNT = struct.Struct('<I')
+DATA = struct.Struct('<II')
+OWNER = struct.Struct('<q')  # user id an exported snapshot is signed for
+SIGNATURE_BYTES = hashlib.sha256().digest_size
+# (STATE, PLACEMENT) for each format version decode() reads
+LAYOUTS = {
+    1: (struct.Struct(f'<{len(RESOURCES)}qIHIQHHI'), struct.Struct('<HHHHHi')),
+    FORMAT_VERSION: (STATE, PLACEMENT)
+}
+
+
+class SnapshotError(ValueError):
+    """Raised for blobs that are not a snapshot this version can read"""
+
+
+@dataclass(slots=True)
+class FarmSnapshot:
+    """A decoded snapshot, in the shapes FarmSession writes"""
+    game_state: dict
+    placements: list  # (grid_x, grid_y, object_type, object_name, planted_day, land_required, data)
+    animals: dict  # animal_type -> count
+    version: int  # farm version when the snapshot was taken
+
+
+def encode(farm, version=None):
+    """Pack a Farm into snapshot bytes, recording `version` instead of farm.version if given"""
+    state = dict(farm.resources, day=farm.day, season=farm.season,
+                 farm_level=farm.farm_level, land_size=farm.land_size)
+    placements = [(p.grid_x, p.grid_y, p.object_type, p.object_name, p.planted_day,
+                   p.land_required, p.data) for p in farm.placements.values()]
+    return encode_state(state, placements, farm.animals,
+                        farm.version if version is None else version)
+
+
+def encode_state(game_state, placements, animals, version):
+    """Pack a farm given in the shapes FarmSnapshot holds into snapshot bytes"""
+    strings = {}
+
+    def intern(text):
+        return strings.setdefault(text, len(strings))
+
+    season = intern(game_state['season'])
+    animal_rows = [(intern(name), count) for name, count in animals.items()]
+    rows, data = [], []
+    for index, (x, y, object_type, object_name, planted_day, land_required, extra) in enumerate(placements):
+        rows.append((x, y, intern(object_type), intern(object_name), land_required, planted_day))
+        if extra:
+            data.append((index, json.dumps(extra).encode('utf-8')))
+
+    parts = [STATE.pack(*(game_state.get(key, 0) for key in RESOURCES), game_state['day'],
+                        game_state['farm_level'], game_state['land_size'], version,
+                        len(strings), len(animal_rows), len(rows))]
+    for text in strings:
+        encoded = text.encode('utf-8')
+        parts.append(STRING_LENGTH.pack(len(encoded)) + encoded)
+    parts.append(SEASON.pack(season))
+    parts.extend(ANIMAL.pack(*animal) for animal in animal_rows)
+    parts.extend(PLACEMENT.pack(*row) for row in rows)
+    parts.append(COUNT.pack(len(data)))
+    for index, encoded in data:
+        parts.append(DATA.pack(index, len(encoded)) + encoded)
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION) + zlib.compress(b''.join(parts), 6)
+
+
+def decode(blob):
+    """Unpack snapshot bytes into a FarmSnapshot, raising SnapshotError if they are not one"""
+    if len(blob) < HEADER.size or len(blob) > MAX_SNAPSHOT_BYTES:
+        raise SnapshotError('Not a farm snapshot')
+    magic, version = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise SnapshotError('Not a farm snapshot')
+    if version not in LAYOUTS:
+        raise SnapshotError(f'Unsupported snapshot format version {version}')
+    state_layout, placement_layout = LAYOUTS[version]
+
+    try:
+        inflater = zlib.decompressobj()
+        payload = inflater.decompress(blob[HEADER.size:], MAX_PAYLOAD_BYTES)
+        if inflater.unconsumed_tail:
+            raise SnapshotError('Snapshot is too large')
+
+        values = state_layout.unpack_from(payload)
+        offset = state_layout.size
+        resources = values[:len(RESOURCES)]
+        day, farm_level, land_size, farm_version, string_count, animal_count, placement_count = \
+            values[len(RESOURCES):]
+
+        strings = []
+        for _ in range(string_count):
+            (length,) = STRING_LENGTH.unpack_from(payload, offset)
+            offset += STRING_LENGTH.size
+            strings.append(payload[offset:offset + length].decode('utf-8'))
+            offset += length
+
+        (season,) = SEASON.unpack_from(payload, offset)
+        offset += SEASON.size
+
+        animals = {}
+        for name, count in ANIMAL.iter_unpack(payload[offset:offset + animal_count * ANIMAL.size]):
+            animals[strings[name]] = count
+        offset += animal_count * ANIMAL.size
+
+        placements = []
+        for x, y, object_type, object_name, land_required, planted_day in placement_layout.iter_unpack(
+                payload[offset:offset + placement_count * placement_layout.size]):
+            placements.append([x, y, strings[object_type], strings[object_name],
+                               planted_day, land_required, None])
+        offset += placement_count * placement_layout.size
+
+        (data_count,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        for _ in range(data_count):
+            index, length = DATA.unpack_from(payload, offset)
+            offset += DATA.size
+            placements[index][6] = json.loads(payload[offset:offset + length])
+            offset += length
+
+        game_state = dict(zip(RESOURCES, resources))
+        game_state.update(day=day, season=strings[season], farm_level=farm_level,
+                          land_size=land_size)
+    except SnapshotError:
+        raise
+    except (struct.error, zlib.error, IndexError, ValueError) as e:
+        raise SnapshotError(f'Corrupt snapshot: {e}') from e
+    if len(placements) != placement_count or len(animals) != animal_count:
+        raise SnapshotError('Corrupt snapshot: truncated')
+
+    return FarmSnapshot(game_state, [tuple(p) for p in placements], animals, farm_version)
+
+
+def sign(blob, key, user_id):
+    """Append the owner's user id and an HMAC-SHA256 over both, so an exported
+    save can neither be edited nor imported into another farm"""
+    signed = blob + OWNER.pack(user_id)
+    return signed + hmac.new(key, signed, hashlib.sha256).digest()
+
+
+def verify(signed, key, user_id):
+    """Return the snapshot inside signed bytes, raising SnapshotError if the
+    signature is wrong or the snapshot was signed for another user"""
+    body, signature = signed[:-SIGNATURE_BYTES], signed[-SIGNATURE_BYTES:]
+    if len(signed) <= OWNER.size + SIGNATURE_BYTES or not hmac.compare_digest(
+            signature, hmac.new(key, body, hashlib.sha256).digest()):
+        raise SnapshotError('Snapshot signature does not match')
+    blob, (owner,) = body[:-OWNER.size], OWNER.unpack(body[-OWNER.size:])
+    if owner != user_id:
+        raise SnapshotError('Snapshot was exported from another farm')
+    return blob
@@ -0,0 +1,277 @@
+"""
+World tick: advance every farm in a database by some days, in parallel
+
+Farms are split into partitions of consecutive user ids, and a
+ProcessPoolExecutor ticks the partitions side by side. A worker walks its
+range in chunks of `chunk_size` farms. For each chunk it
+  * reads the game_state rows and streams crops, buildings and animals
+    with fetchmany() from one read snapshot
+  * advances each farm with Simulation, outside any lock
+  * writes every new state back (less the water of crops that ripened),
+    and appends a 'tick' event per farm to
+    the event log, with executemany() in a BEGIN IMMEDIATE transaction that
+    also records how far the partition has got
+The progress row commits with the results, so an interrupted run resumes
+from the first farm not yet ticked and never ticks a farm twice.
+
+FarmStateCache assumes it is the only writer, so run this while the app is
+stopped (or restart the app afterwards):
+    python world_tick.py farm_game.db --days 1 --workers 4
+    python world_tick.py farm_game.shard*.db
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import event_log
+from database import FarmDatabase
+from farm_state import RESOURCE_KEYS
+from game_models import CATALOG, GameEconomy
+from simulation import FarmVectors, Simulation
+
+
+FETCH_SIZE = 1000  # rows pulled from a cursor at a time
+TICK = event_log.ACTION_IDS['tick']
+
+
+def plan(db, days, partition_size):
+    """Return (tick_id, days, resumed) for the unfinished tick, or start a new one
+
+    A new tick cuts the farms into partitions of partition_size user ids.
+    An unfinished tick is resumed with the days it was started with.
+    """
+    with db.connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('''
+                SELECT tick_id, days FROM world_ticks WHERE finished_at IS NULL
+                ORDER BY tick_id DESC LIMIT 1
+            ''').fetchone()
+            if row is not None:
+                conn.rollback()
+                return row[0], row[1], True
+
+            tick_id = conn.execute('INSERT INTO world_ticks (days) VALUES (?)', (days,)).lastrowid
+            cursor = conn.execute('SELECT user_id FROM game_state ORDER BY user_id')
+            partitions, ids = [], []
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                ids.extend(user_id for (user_id,) in rows)
+                while len(ids) >= partition_size or (ids and not rows):
+                    part, ids = ids[:partition_size], ids[partition_size:]
+                    partitions.append((tick_id, len(partitions), part[0], part[-1], part[0]))
+                if not rows:
+                    break
+            conn.executemany('''
+                INSERT INTO world_tick_partitions
+                    (tick_id, partition, first_user_id, last_user_id, next_user_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', partitions)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    return tick_id, days, False
+
+
+def _stream(conn, sql, params):
+    cursor = conn.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def _read_chunk(conn, first_id, last_id, chunk_size):
+    """Up to chunk_size farms from first_id on, as (game_state rows, crops, buildings, animals)"""
+    states = conn.execute(f'''
+        SELECT user_id, version, {', '.join(RESOURCE_KEYS)}, day, season FROM game_state
+        WHERE user_id BETWEEN ? AND ? ORDER BY user_id LIMIT ?
+    ''', (first_id, last_id, chunk_size)).fetchall()
+    crops, buildings, animals = {}, {}, {}
+    if not states:
+        return states, crops, buildings, animals
+    last_id = states[-1][0]
+
+    for user_id, object_type, object_name, planted_day in _stream(conn, '''
+            SELECT user_id, object_type, object_name, planted_day FROM grid_placements
+            WHERE user_id BETWEEN ? AND ? AND object_type IN ('crop', 'building')
+            ''', (first_id, last_id)):
+        if object_type == 'crop':
+            crops.setdefault(user_id, []).append((object_name, planted_day))
+        else:
+            buildings.setdefault(user_id, []).append(object_name)
+    for user_id, animal_type, count in _stream(conn, '''
+            SELECT user_id, animal_type, count FROM farm_animals
+            WHERE user_id BETWEEN ? AND ?
+            ''', (first_id, last_id)):
+        animals.setdefault(user_id, {})[animal_type] = count
+    return states, crops, buildings, animals
+
+
+def _advance(simulation, days, states, crops, buildings, animals):
+    """UPDATE parameters and event log rows for every farm in a chunk, advanced by `days` days"""
+    now = datetime.now()
+    updates, events = [], []
+    for row in states:
+        user_id, version, resources, day, season = row[0], row[1], row[2:-2], row[-2], row[-1]
+        vectors = FarmVectors.from_rows(resources, day, crops.get(user_id, ()),
+                                        buildings.get(user_id, ()), animals.get(user_id, {}))
+        if days == 1:
+            simulation.step(vectors)
+        else:
+            simulation.advance(vectors, days)
+        after = vectors.resources.tolist()
+        new_season = GameEconomy.get_season(vectors.day)
+        # Crops that ripened in these days stop drawing water
+        ripened = 0
+        for object_name, planted_day in crops.get(user_id, ()):
+            crop = CATALOG.get('crop', object_name)
+            if crop and day < planted_day + crop.growth_time <= vectors.day:
+                ripened += crop.water_per_day
+        updates.append((*after, vectors.day, new_season, ripened, now, user_id, version))
+
+        changed = {key: value for key, value, old in zip(RESOURCE_KEYS, after, resources) if value != old}
+        changed['day'] = vectors.day
+        if new_season != season:
+            changed['season'] = new_season
+        events.append((user_id, version + 1, TICK, event_log.encode(changed)))
+    return updates, events
+
+
+def tick_partition(db_name, tick_id, partition, chunk_size=500):
+    """Worker: tick what is left of one partition; returns its progress row
+
+    Each chunk is read and simulated outside the write lock, so workers
+    only queue for the short bulk UPDATE. The UPDATE only matches farms
+    whose version is unchanged since the read; if another writer got in
+    between, the chunk is rolled back and done again.
+    """
+    db = FarmDatabase(db_name, pool_size=1)
+    simulation = Simulation()
+    try:
+        with db.connection() as conn:
+            days = conn.execute('SELECT days FROM world_ticks WHERE tick_id = ?',
+                                (tick_id,)).fetchone()[0]
+            while True:
+                start = time.perf_counter()
+                conn.execute('BEGIN')
+                try:
+                    next_id, last_id, finished = conn.execute('''
+                        SELECT next_user_id, last_user_id, finished_at FROM world_tick_partitions
+                        WHERE tick_id = ? AND partition = ?
+                    ''', (tick_id, partition)).fetchone()
+                    chunk = None if finished else _read_chunk(conn, next_id, last_id, chunk_size)
+                finally:
+                    conn.rollback()
+                if chunk is None:
+                    break
+                updates, events = _advance(simulation, days, *chunk)
+                upto = updates[-1][-2] if updates else last_id
+                done = len(updates) < chunk_size or upto >= last_id
+                seconds = time.perf_counter() - start
+
+                conn.execute('BEGIN IMMEDIATE')
+                start = time.perf_counter()
+                try:
+                    cursor = conn.executemany(f'''
+                        UPDATE game_state
+                        SET {', '.join(f'{key} = ?' for key in RESOURCE_KEYS)}, day = ?, season = ?,
+                            crop_water = crop_water - ?, updated_at = ?, version = version + 1
+                        WHERE user_id = ? AND version = ?
+                    ''', updates)
+                    if cursor.rowcount != len(updates):
+                        conn.rollback()
+                        continue
+                    conn.executemany('''
+                        INSERT INTO farm_events (user_id, version, action, payload) VALUES (?, ?, ?, ?)
+                    ''', events)
+                    conn.execute('''
+                        UPDATE world_tick_partitions
+                        SET next_user_id = ?, farms = farms + ?, seconds = seconds + ?,
+                            finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END
+                        WHERE tick_id = ? AND partition = ? AND next_user_id = ?
+                    ''', (upto + 1, len(updates), seconds + time.perf_counter() - start, done,
+                          tick_id, partition, next_id))
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+
+            return conn.execute('''
+                SELECT partition, first_user_id, last_user_id, farms, seconds
+                FROM world_tick_partitions WHERE tick_id = ? AND partition = ?
+            ''', (tick_id, partition)).fetchone()
+    finally:
+        db.close()
+
+
+def _finish(db, tick_id):
+    with db.connection() as conn:
+        conn.execute('''
+            UPDATE world_ticks SET finished_at = CURRENT_TIMESTAMP
+            WHERE tick_id = ? AND NOT EXISTS (
+                SELECT 1 FROM world_tick_partitions
+                WHERE tick_id = ? AND finished_at IS NULL
+            )
+        ''', (tick_id, tick_id))
+
+
+def run(db_names, days=1, workers=None, partition_size=5000, chunk_size=500):
+    """Tick every farm in db_names (one file or a set of shards) by `days` days
+
+    Prints one line per partition as it completes, then the totals, and
+    returns {db_name: tick_id}.
+    """
+    ticks, jobs = {}, []
+    for db_name in db_names:
+        db = FarmDatabase(db_name, pool_size=1)
+        tick_id, tick_days, resumed = plan(db, days, partition_size)
+        if resumed:
+            print(f'{db_name}: resuming unfinished tick {tick_id} ({tick_days} days)')
+        ticks[db_name] = (db, tick_id)
+        with db.connection() as conn:
+            jobs.extend((db_name, tick_id, partition) for (partition,) in conn.execute('''
+                SELECT partition FROM world_tick_partitions
+                WHERE tick_id = ? AND finished_at IS NULL ORDER BY partition
+            ''', (tick_id,)))
+
+    print(f'{"database":<24} {"part":>4} {"user ids":>19} {"farms":>8} {"seconds":>8} {"farms/s":>9}')
+    start = time.perf_counter()
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(tick_partition, db_name, tick_id, partition, chunk_size): db_name
+                   for db_name, tick_id, partition in jobs}
+        for future in as_completed(futures):
+            partition, first_id, last_id, farms, seconds = future.result()
+            total += farms
+            rate = farms / seconds if seconds else 0.0
+            print(f'{os.path.basename(futures[future]):<24} {partition:>4} '
+                  f'{f"{first_id}-{last_id}":>19} {farms:>8} {seconds:>8.2f} {rate:>9.0f}')
+    elapsed = time.perf_counter() - start
+
+    for db, tick_id in ticks.values():
+        _finish(db, tick_id)
+        db.close()
+    print(f'{total} farms in {len(jobs)} partitions, {elapsed:.2f}s '
+          f'({total / elapsed if elapsed else 0.0:.0f} farms/s)')
+    return {db_name: tick_id for db_name, (_, tick_id) in ticks.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Advance every farm by some days')
+    parser.add_argument('databases', nargs='+', help='database or shard files to tick')
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--partition-size', type=int, default=5000,
+                        help='farms per partition handed to a worker')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='farms per transaction within a partition')
+    args = parser.parse_args()
+    if args.days < 1:
+        parser.error('--days must be a positive integer')
+    run(args.databases, args.days, args.workers, args.partition_size, args.chunk_size)